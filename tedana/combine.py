@@ -3,18 +3,114 @@ Functions to optimally combine data across echoes.
 """
 import logging
 import numpy as np
-from tedana.utils import unmask
+from tedana import decay
+from tedana.utils import EchoGroups
 from tedana.due import due, Doi
 
 LGR = logging.getLogger(__name__)
 RepLGR = logging.getLogger('REPORT')
 RefLGR = logging.getLogger('REFERENCES')
 
+# Maximum number of elements of the data to copy at once when combining
+_BLOCK_ELEMENTS = 10000000
+
+
+def _normalize_weights(alpha):
+    """
+    Normalize combination weights so that they sum to one across echoes.
+
+    Parameters
+    ----------
+    alpha : (M [x T] x E) :obj:`numpy.ndarray`
+        Unnormalized weights, with echoes along the last axis. Modified in
+        place.
+
+    Returns
+    -------
+    alpha : (M [x T] x E) :obj:`numpy.ndarray`
+        Normalized weights. Where all weights are zero, echoes are weighted
+        equally, and a warning is logged with the number of voxels affected.
+    """
+    alpha_sum = alpha.sum(axis=-1, keepdims=True)
+    zero_sum = alpha_sum == 0
+    if np.any(zero_sum):
+        n_zero = np.sum(zero_sum.reshape(zero_sum.shape[0], -1).any(axis=1))
+        LGR.warning('All combination weights are zero in {0} voxel(s); '
+                    'weighting echoes equally there'.format(n_zero))
+        # If all values across echos are 0, set to 1 to avoid
+        # divide-by-zero errors
+        alpha[np.broadcast_to(zero_sum, alpha.shape)] = 1.
+        alpha_sum[zero_sum] = alpha.shape[-1]
+    alpha /= alpha_sum
+    return alpha
+
+
+def _combine_weighted(data, alpha, out=None):
+    """
+    Compute the weighted sum of data across echoes.
+
+    Parameters
+    ----------
+    data : (M x E x T) array_like
+        Masked data.
+    alpha : (M x E) or (M x T x E) array_like
+        Normalized voxel-wise or voxel- and volume-wise weights.
+    out : (M x T) :obj:`numpy.ndarray` or None, optional
+        Array in which to place the result. Default is None.
+
+    Returns
+    -------
+    out : (M x T) :obj:`numpy.ndarray`
+        Data combined across echoes.
+    """
+    n_samp, n_echos, n_vols = data.shape
+    if out is None:
+        out = np.empty((n_samp, n_vols))
+    out[:] = 0
+    # accumulate one echo at a time so that no (M x E x T) temporary is built
+    for i_echo in range(n_echos):
+        if alpha.ndim == 2:
+            out += alpha[:, i_echo, np.newaxis] * data[:, i_echo, :]
+        else:
+            out += alpha[:, :, i_echo] * data[:, i_echo, :]
+    return out
+
+
+def _report_combine(combmode):
+    """
+    Log the description of a combination method to the report.
+
+    Parameters
+    ----------
+    combmode : {'t2s', 'paid'}
+        How data were combined.
+    """
+    if combmode == 't2s':
+        RepLGR.info("Multi-echo data were then optimally combined using the "
+                    "T2* combination method (Posse et al., 1999).")
+        RefLGR.info("Posse, S., Wiese, S., Gembris, D., Mathiak, K., Kessler, "
+                    "C., Grosse‐Ruyken, M. L., ... & Kiselev, V. G. (1999). "
+                    "Enhancement of BOLD‐contrast sensitivity by single‐shot "
+                    "multi‐echo functional MR imaging. Magnetic Resonance in "
+                    "Medicine: An Official Journal of the International Society "
+                    "for Magnetic Resonance in Medicine, 42(1), 87-97.")
+    elif combmode == 'paid':
+        RepLGR.info("Multi-echo data were then optimally combined using the "
+                    "parallel-acquired inhomogeneity desensitized (PAID) "
+                    "combination method.")
+        RefLGR.info("Poser, B. A., Versluis, M. J., Hoogduin, J. M., & Norris, "
+                    "D. G. (2006). BOLD contrast sensitivity enhancement and "
+                    "artifact reduction with multiecho EPI: parallel‐acquired "
+                    "inhomogeneity‐desensitized fMRI. "
+                    "Magnetic Resonance in Medicine: An Official Journal of the "
+                    "International Society for Magnetic Resonance in Medicine, "
+                    "55(6), 1227-1235.")
+
 
 @due.dcite(Doi('10.1002/(SICI)1522-2594(199907)42:1<87::AID-MRM13>3.0.CO;2-O'),
            description='T2* method of combining data across echoes using '
                        'monoexponential equation.')
-def _combine_t2s(data, tes, ft2s):
+def _combine_t2s(data, tes, ft2s, out=None, report=True):
     """
     Combine data across echoes using weighted averaging according to voxel-
     (and sometimes volume-) wise estimates of T2*.
@@ -27,42 +123,27 @@ def _combine_t2s(data, tes, ft2s):
         Echo times in milliseconds.
     ft2s : (M [x T] X 1) array_like
         Either voxel-wise or voxel- and volume-wise estimates of T2*.
+    out : (M x T) :obj:`numpy.ndarray` or None, optional
+        Array in which to place the result. Default is None.
+    report : :obj:`bool`, optional
+        Whether to log the method to the report. Default is True.
 
     Returns
     -------
     combined : (M x T) :obj:`numpy.ndarray`
         Data combined across echoes according to T2* estimates.
     """
-    RepLGR.info("Multi-echo data were then optimally combined using the "
-                "T2* combination method (Posse et al., 1999).")
-    RefLGR.info("Posse, S., Wiese, S., Gembris, D., Mathiak, K., Kessler, "
-                "C., Grosse‐Ruyken, M. L., ... & Kiselev, V. G. (1999). "
-                "Enhancement of BOLD‐contrast sensitivity by single‐shot "
-                "multi‐echo functional MR imaging. Magnetic Resonance in "
-                "Medicine: An Official Journal of the International Society "
-                "for Magnetic Resonance in Medicine, 42(1), 87-97.")
-    n_vols = data.shape[-1]
-    alpha = tes * np.exp(-tes / ft2s)
-    if alpha.ndim == 2:
-        # Voxel-wise T2 estimates
-        alpha = np.tile(alpha[:, :, np.newaxis], (1, 1, n_vols))
-    elif alpha.ndim == 3:
-        # Voxel- and volume-wise T2 estimates
-        # alpha is currently (S, T, E) but should be (S, E, T) like mdata
-        alpha = np.swapaxes(alpha, 1, 2)
-
-        # If all values across echos are 0, set to 1 to avoid
-        # divide-by-zero errors
-        ax0_idx, ax2_idx = np.where(np.all(alpha == 0, axis=1))
-        alpha[ax0_idx, :, ax2_idx] = 1.
-    combined = np.average(data, axis=1, weights=alpha)
-    return combined
+    if report:
+        _report_combine('t2s')
+    # (M x E) for voxel-wise or (M x T x E) for volume-wise T2* estimates
+    alpha = _normalize_weights(tes * np.exp(-tes / ft2s))
+    return _combine_weighted(data, alpha, out=out)
 
 
 @due.dcite(Doi('10.1002/mrm.20900'),
            description='PAID method of combining data across echoes using just '
                        'SNR/signal and TE.')
-def _combine_paid(data, tes):
+def _combine_paid(data, tes, out=None, report=True):
     """
     Combine data across echoes using SNR/signal and TE via the
     parallel-acquired inhomogeneity desensitized (PAID) ME-fMRI combination
@@ -74,31 +155,29 @@ def _combine_paid(data, tes):
         Masked data.
     tes : (1 x E) array_like
         Echo times in milliseconds.
+    out : (M x T) :obj:`numpy.ndarray` or None, optional
+        Array in which to place the result. Default is None.
+    report : :obj:`bool`, optional
+        Whether to log the method to the report. Default is True.
 
     Returns
     -------
     combined : (M x T) :obj:`numpy.ndarray`
         Data combined across echoes according to SNR/signal.
     """
-    RepLGR.info("Multi-echo data were then optimally combined using the "
-                "parallel-acquired inhomogeneity desensitized (PAID) "
-                "combination method.")
-    RefLGR.info("Poser, B. A., Versluis, M. J., Hoogduin, J. M., & Norris, "
-                "D. G. (2006). BOLD contrast sensitivity enhancement and "
-                "artifact reduction with multiecho EPI: parallel‐acquired "
-                "inhomogeneity‐desensitized fMRI. "
-                "Magnetic Resonance in Medicine: An Official Journal of the "
-                "International Society for Magnetic Resonance in Medicine, "
-                "55(6), 1227-1235.")
-    n_vols = data.shape[-1]
-    snr = data.mean(axis=-1) / data.std(axis=-1)
-    alpha = snr * tes
-    alpha = np.tile(alpha[:, :, np.newaxis], (1, 1, n_vols))
-    combined = np.average(data, axis=1, weights=alpha)
-    return combined
+    if report:
+        _report_combine('paid')
+    n_samp, n_echos, _ = data.shape
+    snr = np.empty((n_samp, n_echos))
+    for i_echo in range(n_echos):
+        echo_data = data[:, i_echo, :]
+        snr[:, i_echo] = echo_data.mean(axis=-1) / echo_data.std(axis=-1)
+    alpha = _normalize_weights(snr * tes)
+    return _combine_weighted(data, alpha, out=out)
 
 
-def make_optcom(data, tes, adaptive_mask, t2s=None, combmode='t2s', verbose=True):
+def make_optcom(data, tes, adaptive_mask, t2s=None, combmode='t2s', verbose=True,
+                echo_groups=None, out=None):
     """
     Optimally combine BOLD data across TEs, using only those echos with reliable signal
     across at least three echos. If the number of echos providing reliable signal is greater
@@ -121,6 +200,12 @@ def make_optcom(data, tes, adaptive_mask, t2s=None, combmode='t2s', verbose=True
         is not required. Default is 't2s'.
     verbose : :obj:`bool`, optional
         Whether to print status updates. Default is True.
+    echo_groups : :obj:`tedana.utils.EchoGroups` or None, optional
+        Index of samples by number of good echoes, built from `adaptive_mask`
+        if not provided. Default is None.
+    out : (S x T) array_like or None, optional
+        Array (e.g., a :obj:`numpy.memmap`) into which the combined data are
+        written. Default is None, which allocates a new array.
 
     Returns
     -------
@@ -136,7 +221,9 @@ def make_optcom(data, tes, adaptive_mask, t2s=None, combmode='t2s', verbose=True
                 w(T_2^*)_n = \\frac{TE_n * exp(\\frac{-TE}\
                 {T_{2(est)}^*})}{\\sum TE_n * exp(\\frac{-TE}{T_{2(est)}^*})}
     2.  Perform weighted average per voxel and TR across TEs based on weights
-        estimated in the previous step.
+        estimated in the previous step. Where the weights of every echo are
+        zero (e.g., where T2* is zero), the echoes are averaged with equal
+        weights instead, and a warning is logged with the number of voxels.
     """
     if data.ndim != 3:
         raise ValueError('Input data must be 3D (S x E x T)')
@@ -153,6 +240,13 @@ def make_optcom(data, tes, adaptive_mask, t2s=None, combmode='t2s', verbose=True
                          'voxels/samples: {0} != {1}'.format(
                              adaptive_mask.shape[0], data.shape[0]))
 
+    if echo_groups is None:
+        echo_groups = EchoGroups(adaptive_mask)
+    elif echo_groups.n_samples != data.shape[0]:
+        raise ValueError('Echo groups and data do not have same number of '
+                         'voxels/samples: {0} != {1}'.format(
+                             echo_groups.n_samples, data.shape[0]))
+
     if combmode not in ['t2s', 'paid']:
         raise ValueError("Argument 'combmode' must be either 't2s' or 'paid'")
     elif combmode == 't2s' and t2s is None:
@@ -173,21 +267,153 @@ def make_optcom(data, tes, adaptive_mask, t2s=None, combmode='t2s', verbose=True
                    'estimates')
         LGR.info(msg)
 
-    mask = adaptive_mask >= 3
-    data = data[mask, :, :]  # mask out unstable voxels/samples
     tes = np.array(tes)[np.newaxis, ...]  # (1 x E) array_like
-    combined = np.zeros((data.shape[0], data.shape[2]))
-    for echo in np.unique(adaptive_mask[mask]):
-        echo_idx = adaptive_mask[mask] == echo
+    if out is None:
+        combined = np.zeros((data.shape[0], data.shape[2]))
+    elif out.shape != (data.shape[0], data.shape[2]):
+        raise ValueError('Output array must have shape {0}, not '
+                         '{1}'.format((data.shape[0], data.shape[2]), out.shape))
+    else:
+        combined = out
+        combined[:] = 0
+    report = True
+    for echo, echo_idx in echo_groups:
+        if echo < 3:
+            continue
+        # combine a block of voxels at a time to bound the size of the copies
+        block_size = max(1, _BLOCK_ELEMENTS // (echo * data.shape[2]))
+        for start in range(0, len(echo_idx), block_size):
+            block_idx = echo_idx[start:start + block_size]
+            combined[block_idx, :] = _combine_echo_group(
+                data[block_idx, :echo, :], tes[:, :echo], combmode,
+                t2s=None if combmode == 'paid' else t2s[block_idx],
+                report=report)
+            report = False
 
-        if combmode == 'paid':
-            combined[echo_idx, :] = _combine_paid(data[echo_idx, :echo, :],
-                                                  tes[:echo])
-        else:
-            t2s_ = t2s[mask, ..., np.newaxis]  # mask out empty voxels/samples
+    return combined
+
+
+def _combine_echo_group(data, tes, combmode, t2s=None, report=True):
+    """
+    Optimally combine samples that share the same number of good echoes.
+
+    Parameters
+    ----------
+    data : (M x E x T) array_like
+        Data from the good echoes of each sample.
+    tes : (1 x E) :obj:`numpy.ndarray`
+        Echo times of the good echoes.
+    combmode : {'t2s', 'paid'}
+        How to combine data.
+    t2s : (M [x T]) :obj:`numpy.ndarray` or None, optional
+        Estimated T2* values. Only required if combmode = 't2s'.
+        Default is None.
+    report : :obj:`bool`, optional
+        Whether to log the method to the report. Default is True.
+
+    Returns
+    -------
+    combined : (M x T) :obj:`numpy.ndarray`
+        Optimally combined data.
+    """
+    if combmode == 'paid':
+        return _combine_paid(data, tes, report=report)
+    return _combine_t2s(data, tes, t2s[..., np.newaxis], report=report)
+
+
+def make_optcom_ts(data, tes, mask, adaptive_mask, fittype, combmode='t2s',
+                   maps_out=None, chunk_size=None, n_jobs=1):
+    """
+    Fit voxel- and volume-wise T2* and optimally combine BOLD data in a
+    single pass over chunks of samples.
+
+    Parameters
+    ----------
+    data : (S x E x T) :obj:`numpy.ndarray`
+        Concatenated BOLD data.
+    tes : (E,) :obj:`numpy.ndarray`
+        Array of TEs, in milliseconds.
+    mask : (S,) :obj:`numpy.ndarray`
+        Boolean array indicating samples that are consistently (i.e., across
+        time AND echoes) non-zero
+    adaptive_mask : (S,) :obj:`numpy.ndarray`
+        Adaptive mask of the data indicating the number of echos with signal at each voxel
+    fittype : {'loglin', 'curvefit', 'dictionary'}
+        The type of model fit to use
+    combmode : {'t2s', 'paid'}, optional
+        How to combine data. Default is 't2s'.
+    maps_out : :obj:`list` of four (S x T) array_like or None, optional
+        Arrays (e.g., :obj:`numpy.memmap` objects) into which the limited T2*,
+        limited S0, full T2* and full S0 timeseries are written. Default is
+        None, which discards the timeseries once each chunk is combined.
+    chunk_size : :obj:`int` or None, optional
+        Number of masked samples to fit and combine at once. Peak memory use
+        scales with the chunk size. Default is None, which picks a chunk size
+        that bounds the size of each chunk's copy of the data.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to use for fitting. Default is 1.
+
+    Returns
+    -------
+    combined : (S x T) :obj:`numpy.ndarray`
+        Optimally combined data, identical to fitting with
+        :func:`tedana.decay.fit_decay_ts` and combining with
+        :func:`make_optcom` using the full T2* timeseries.
+
+    See Also
+    --------
+    :func:`tedana.decay.fit_decay_ts`, :func:`make_optcom`
+    """
+    if data.ndim != 3:
+        raise ValueError('Input data must be 3D (S x E x T)')
+
+    if len(tes) != data.shape[1]:
+        raise ValueError('Number of echos provided does not match second '
+                         'dimension of input data: {0} != '
+                         '{1}'.format(len(tes), data.shape[1]))
+
+    if not (data.shape[0] == mask.shape[0] == adaptive_mask.shape[0]):
+        raise ValueError('First dimensions (number of samples) of data ({0}), '
+                         'mask ({1}), and adaptive_mask ({2}) do not '
+                         'match'.format(data.shape[0], mask.shape[0], adaptive_mask.shape[0]))
+
+    if combmode not in ['t2s', 'paid']:
+        raise ValueError("Argument 'combmode' must be either 't2s' or 'paid'")
+
+    n_samples, n_echos, n_vols = data.shape
+    if maps_out is not None:
+        if len(maps_out) != 4 or any(arr.shape != (n_samples, n_vols) for arr in maps_out):
+            raise ValueError('Argument "maps_out" must contain four arrays of shape '
+                             '{0}'.format((n_samples, n_vols)))
+        for arr in maps_out:
+            arr[~mask] = 0
+
+    if combmode == 'paid':
+        LGR.info('Optimally combining data with parallel-acquired '
+                 'inhomogeneity desensitized (PAID) method')
+    else:
+        LGR.info('Optimally combining data with voxel- and volume-wise T2* '
+                 'estimates')
+
+    if chunk_size is None:
+        chunk_size = _BLOCK_ELEMENTS // (n_echos * n_vols)
 
-            combined[echo_idx, :] = _combine_t2s(
-                data[echo_idx, :echo, :], tes[:, :echo], t2s_[echo_idx, ...])
+    tes_row = np.array(tes)[np.newaxis, ...]  # (1 x E) array_like
+    mask_idx = np.arange(n_samples)[mask]
+    combined = np.zeros((n_samples, n_vols))
+    report = True
+    for chunk_idx, chunk_maps in decay._fit_decay_chunks(
+            data, np.array(tes), mask_idx, adaptive_mask, fittype,
+            chunk_size=chunk_size, n_jobs=n_jobs, volumewise=True):
+        if maps_out is not None:
+            for arr, chunk_map in zip(maps_out, chunk_maps):
+                arr[chunk_idx, :] = chunk_map
+        for echo, echo_idx in EchoGroups(adaptive_mask[chunk_idx]):
+            if echo < 3:
+                continue
+            combined[chunk_idx[echo_idx], :] = _combine_echo_group(
+                data[chunk_idx[echo_idx], :echo, :], tes_row[:, :echo],
+                combmode, t2s=chunk_maps[2][echo_idx], report=report)
+            report = False
 
-    combined = unmask(combined, mask)
     return combined
@@ -2,8 +2,11 @@
 Functions to estimate S0 and T2* from multi-echo data.
 """
 import logging
-import scipy
+from functools import lru_cache
+
 import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+
 from tedana import utils
 
 LGR = logging.getLogger(__name__)
@@ -28,7 +31,146 @@ def monoexponential(tes, s0, t2star):
     return s0 * np.exp(-tes / t2star)
 
 
-def fit_monoexponential(data_cat, echo_times, adaptive_mask):
+def _fit_monoexponential_lm(data, echo_times, s0, t2star, s0_min,
+                            max_iter=100, tol=1e-8):
+    """
+    Fit a monoexponential model to many voxels at once with a bounded
+    Levenberg-Marquardt solver.
+
+    Parameters
+    ----------
+    data : (N x E) array_like
+        Signal to fit for each of `N` voxels.
+    echo_times : (E,) array_like
+        Echo times
+    s0 : (N,) array_like
+        Initial S0 estimates
+    t2star : (N,) array_like
+        Initial T2* estimates
+    s0_min : (N,) array_like
+        Lower bound on S0 for each voxel. T2* is bounded below by zero.
+    max_iter : :obj:`int`, optional
+        Maximum number of iterations. Default is 100.
+    tol : :obj:`float`, optional
+        Relative tolerance on the change in the cost and in the parameters
+        used to declare convergence. Default is 1e-8.
+
+    Returns
+    -------
+    s0 : (N,) :obj:`numpy.ndarray`
+        Fitted S0 values
+    t2star : (N,) :obj:`numpy.ndarray`
+        Fitted T2* values
+    converged : (N,) :obj:`numpy.ndarray`
+        Boolean array indicating voxels where the fit converged. Values for
+        voxels where it did not are not meaningful.
+
+    Notes
+    -----
+    Each voxel is updated with its own damping parameter and stops being
+    updated once it has converged, so the result for a voxel does not depend
+    on which other voxels are fit alongside it.
+    """
+    data = np.asarray(data, dtype=float)
+    echo_times = np.asarray(echo_times, dtype=float)
+    s0 = np.array(s0, dtype=float)
+    t2star = np.array(t2star, dtype=float)
+    s0_min = np.asarray(s0_min, dtype=float)
+
+    converged = np.zeros(s0.shape[0], dtype=bool)
+    # Starting points outside of the bounds are failures, as with curve_fit
+    active = (np.isfinite(s0) & np.isfinite(t2star) &
+              (s0 >= s0_min) & (t2star > 0))
+    damping = np.full(s0.shape[0], 1e-3)
+    cost = np.full(s0.shape[0], np.inf)
+    cost[active] = ((data[active] - monoexponential(
+        echo_times, s0[active, None], t2star[active, None])) ** 2).sum(axis=1)
+    converged[active & (cost == 0)] = True
+    active &= ~converged
+
+    for _ in range(max_iter):
+        idx = np.where(active)[0]
+        if not idx.size:
+            break
+        s0_, t2s_, lam, cost_ = s0[idx], t2star[idx], damping[idx], cost[idx]
+        y = data[idx]
+
+        # analytic Jacobian of the model with respect to S0 and T2*
+        jac_s0 = np.exp(-echo_times / t2s_[:, None])
+        jac_t2s = s0_[:, None] * jac_s0 * echo_times / t2s_[:, None] ** 2
+        resid = y - s0_[:, None] * jac_s0
+
+        # solve the damped 2 x 2 normal equations in closed form
+        a = (jac_s0 ** 2).sum(axis=1) * (1 + lam)
+        b = (jac_s0 * jac_t2s).sum(axis=1)
+        c = (jac_t2s ** 2).sum(axis=1) * (1 + lam)
+        g_s0 = (jac_s0 * resid).sum(axis=1)
+        g_t2s = (jac_t2s * resid).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            det = a * c - b ** 2
+            new_s0 = np.maximum(s0_ + (c * g_s0 - b * g_t2s) / det, s0_min[idx])
+            # keep T2* strictly positive by stepping at most most of the way
+            # to its bound, since the Jacobian vanishes as T2* goes to zero
+            new_t2s = t2s_ + np.maximum((a * g_t2s - b * g_s0) / det,
+                                        -0.995 * t2s_)
+            new_cost = ((y - monoexponential(
+                echo_times, new_s0[:, None], new_t2s[:, None])) ** 2).sum(axis=1)
+        improved = new_cost < cost_
+
+        small_cost = cost_ - new_cost <= tol * cost_
+        small_step = ((np.abs(new_s0 - s0_) <= tol * (np.abs(s0_) + tol)) &
+                      (np.abs(new_t2s - t2s_) <= tol * (np.abs(t2s_) + tol)))
+        # the damping only grows without bound at a (possibly bounded) minimum
+        stalled = ~improved & (lam >= 1e16)
+        done = (improved & (small_cost | small_step)) | stalled
+
+        s0[idx[improved]] = new_s0[improved]
+        t2star[idx[improved]] = new_t2s[improved]
+        cost[idx[improved]] = new_cost[improved]
+        damping[idx] = np.where(improved, lam / 10., lam * 10.)
+        converged[idx[done]] = True
+        active[idx[done]] = False
+
+    converged &= np.isfinite(s0) & np.isfinite(t2star)
+    return s0, t2star, converged
+
+
+def _report_decay_fit(fittype):
+    """
+    Log the description of a decay model fit to the report.
+
+    Parameters
+    ----------
+    fittype : {loglin, curvefit, dictionary}
+        The type of model fit used
+    """
+    if fittype == 'loglin':
+        RepLGR.info("A monoexponential model was fit to the data at each voxel "
+                    "using log-linear regression in order to estimate T2* and S0 "
+                    "maps. For each voxel, the value from the adaptive mask was "
+                    "used to determine which echoes would be used to estimate T2* "
+                    "and S0.")
+    elif fittype == 'curvefit':
+        RepLGR.info("A monoexponential model was fit to the data at each voxel "
+                    "using nonlinear model fitting in order to estimate T2* and S0 "
+                    "maps, using T2*/S0 estimates from a log-linear fit as "
+                    "initial values. For each voxel, the value from the adaptive "
+                    "mask was used to determine which echoes would be used to "
+                    "estimate T2* and S0. In cases of model fit failure, T2*/S0 "
+                    "estimates from the log-linear fit were retained instead.")
+    elif fittype == 'dictionary':
+        RepLGR.info("A monoexponential model was fit to the data at each voxel "
+                    "by matching the data against a dictionary of decay curves "
+                    "in order to estimate T2* and S0 maps, with T2* refined "
+                    "between dictionary entries. For each voxel, the value "
+                    "from the adaptive mask was used to determine which echoes "
+                    "would be used to estimate T2* and S0. In cases of model "
+                    "fit failure, T2*/S0 estimates from a log-linear fit were "
+                    "retained instead.")
+
+
+def fit_monoexponential(data_cat, echo_times, adaptive_mask, report=True,
+                        echo_groups=None):
     """
     Fit monoexponential decay model with nonlinear curve-fitting.
 
@@ -37,148 +179,423 @@ def fit_monoexponential(data_cat, echo_times, adaptive_mask):
     data_cat
     echo_times
     adaptive_mask
+    report
+    echo_groups : :obj:`tedana.utils.EchoGroups` or None, optional
+        Index of samples by number of good echoes, built from `adaptive_mask`
+        if not provided. Default is None.
 
     Returns
     -------
     t2s_limited, s0_limited, t2s_full, s0_full
     """
-    RepLGR.info("A monoexponential model was fit to the data at each voxel "
-                "using nonlinear model fitting in order to estimate T2* and S0 "
-                "maps, using T2*/S0 estimates from a log-linear fit as "
-                "initial values. For each voxel, the value from the adaptive "
-                "mask was used to determine which echoes would be used to "
-                "estimate T2* and S0. In cases of model fit failure, T2*/S0 "
-                "estimates from the log-linear fit were retained instead.")
-    n_samp, n_echos, n_vols = data_cat.shape
-
-    # Currently unused
-    # fit_data = np.mean(data_cat, axis=2)
-    # fit_sigma = np.std(data_cat, axis=2)
+    if report:
+        _report_decay_fit('curvefit')
+    echo_times = np.asarray(echo_times, dtype=float)
+    if echo_groups is None:
+        echo_groups = utils.EchoGroups(adaptive_mask)
 
     t2s_limited, s0_limited, t2s_full, s0_full = fit_loglinear(
-        data_cat, echo_times, adaptive_mask, report=False)
+        data_cat, echo_times, adaptive_mask, report=False,
+        echo_groups=echo_groups)
+
+    for echo_num, voxel_idx in _get_fit_groups(echo_groups):
+        # The least-squares fit across all volumes has the same solution as
+        # the fit to the temporal mean of each echo, so only the mean and the
+        # lower bound on S0 (the minimum of the data) are needed.
+        data_3d = data_cat[voxel_idx, :echo_num, :]
+        data_mean = data_3d.mean(axis=-1)
+        s0_min = data_3d.min(axis=(1, 2))
+        del data_3d
+
+        # perform a monoexponential fit of echo times against MR signal
+        # using loglin estimates as initial starting points for fit
+        s0_fit, t2s_fit, converged = _fit_monoexponential_lm(
+            data_mean, echo_times[:echo_num], s0_full[voxel_idx],
+            t2s_full[voxel_idx], s0_min)
+        # If the fit fails to converge, fall back to loglinear estimate
+        s0_full[voxel_idx[converged]] = s0_fit[converged]
+        t2s_full[voxel_idx[converged]] = t2s_fit[converged]
+        fail_count = np.sum(~converged)
+
+        if fail_count:
+            fail_percent = 100 * fail_count / len(voxel_idx)
+            LGR.debug('With {0} echoes, monoexponential fit failed on {1}/{2} '
+                      '({3:.2f}%) voxel(s), used log linear estimate '
+                      'instead'.format(echo_num, fail_count, len(voxel_idx), fail_percent))
+
+    return _assemble_decay_maps(t2s_full, s0_full, echo_groups)
+
+
+def _get_fit_groups(echo_groups):
+    """
+    Get the groups of samples to fit with each number of echoes.
+
+    Parameters
+    ----------
+    echo_groups : :obj:`tedana.utils.EchoGroups`
+        Index of samples by number of good echoes
 
-    echos_to_run = np.unique(adaptive_mask)
+    Returns
+    -------
+    fit_groups : :obj:`list` of (:obj:`int`, :obj:`numpy.ndarray`) tuples
+        Number of echoes and indices of the samples to fit with them. Samples
+        with fewer than two good echoes are fit with the first two echoes.
+    """
+    echos_to_run = echo_groups.echo_counts
     if 1 in echos_to_run:
         echos_to_run = np.sort(np.unique(np.append(echos_to_run, 2)))
     echos_to_run = echos_to_run[echos_to_run >= 2]
 
-    t2s_asc_maps = np.zeros([n_samp, len(echos_to_run)])
-    s0_asc_maps = np.zeros([n_samp, len(echos_to_run)])
-    echo_masks = np.zeros([n_samp, len(echos_to_run)], dtype=bool)
-
-    for i_echo, echo_num in enumerate(echos_to_run):
+    fit_groups = []
+    for echo_num in echos_to_run:
         if echo_num == 2:
-            voxel_idx = np.where(adaptive_mask <= echo_num)[0]
+            voxel_idx = echo_groups.between(0, echo_num)
         else:
-            voxel_idx = np.where(adaptive_mask == echo_num)[0]
+            voxel_idx = echo_groups[echo_num]
+        fit_groups.append((echo_num, voxel_idx))
+    return fit_groups
 
-        # Create echo masks to assign values to limited vs full maps later
-        echo_mask = np.squeeze(echo_masks[..., i_echo])
-        echo_mask[adaptive_mask == echo_num] = True
-        echo_masks[..., i_echo] = echo_mask
 
-        data_2d = data_cat[:, :echo_num, :].reshape(len(data_cat), -1).T
-        echo_times_1d = np.repeat(echo_times[:echo_num], n_vols)
-
-        # perform a monoexponential fit of echo times against MR signal
-        # using loglin estimates as initial starting points for fit
-        fail_count = 0
-        for voxel in voxel_idx:
-            try:
-                popt, cov = scipy.optimize.curve_fit(
-                    monoexponential, echo_times_1d, data_2d[:, voxel],
-                    p0=(s0_full[voxel], t2s_full[voxel]),
-                    bounds=((np.min(data_2d[:, voxel]), 0),
-                            (np.inf, np.inf)))
-                s0_full[voxel] = popt[0]
-                t2s_full[voxel] = popt[1]
-            except (RuntimeError, ValueError):
-                # If curve_fit fails to converge, fall back to loglinear estimate
-                fail_count += 1
+def _assemble_decay_maps(t2s, s0, echo_groups):
+    """
+    Build limited and full maps from per-sample estimates.
 
-        if fail_count:
-            fail_percent = 100 * fail_count / len(voxel_idx)
-            LGR.debug('With {0} echoes, monoexponential fit failed on {1}/{2} '
-                      '({3:.2f}%) voxel(s), used log linear estimate '
-                      'instead'.format(echo_num, fail_count, len(voxel_idx), fail_percent))
+    Parameters
+    ----------
+    t2s, s0 : (S,) :obj:`numpy.ndarray`
+        T2* and S0 estimated for each sample from the groups returned by
+        :func:`_get_fit_groups`. Modified in place.
+    echo_groups : :obj:`tedana.utils.EchoGroups`
+        Index of samples by number of good echoes
 
-        t2s_asc_maps[:, i_echo] = t2s_full
-        s0_asc_maps[:, i_echo] = s0_full
+    Returns
+    -------
+    t2s_limited, s0_limited, t2s_full, s0_full : (S,) :obj:`numpy.ndarray`
+        The limited maps are zero where there are fewer than two good echoes.
+        The full maps keep the estimate from the first two echoes where there
+        is one good echo.
+    """
+    # samples without any good echoes are not fit
+    t2s[echo_groups[0]] = 0
+    s0[echo_groups[0]] = 0
 
     # create limited T2* and S0 maps
-    t2s_limited = utils.unmask(t2s_asc_maps[echo_masks], adaptive_mask > 1)
-    s0_limited = utils.unmask(s0_asc_maps[echo_masks], adaptive_mask > 1)
+    t2s_limited, s0_limited = t2s.copy(), s0.copy()
+    t2s_limited[echo_groups[1]] = 0
+    s0_limited[echo_groups[1]] = 0
 
-    # create full T2* maps with S0 estimation errors
-    t2s_full, s0_full = t2s_limited.copy(), s0_limited.copy()
-    t2s_full[adaptive_mask == 1] = t2s_asc_maps[adaptive_mask == 1, 0]
-    s0_full[adaptive_mask == 1] = s0_asc_maps[adaptive_mask == 1, 0]
+    return t2s_limited, s0_limited, t2s, s0
 
-    return t2s_limited, s0_limited, t2s_full, s0_full
 
+@lru_cache(maxsize=None)
+def _get_loglin_pinv(echo_times, echo_num):
+    """
+    Get the pseudo-inverse of the log-linear design matrix for the first
+    `echo_num` echoes.
+
+    Parameters
+    ----------
+    echo_times : :obj:`tuple`
+        Echo times
+    echo_num : :obj:`int`
+        Number of echoes to use
 
-def fit_loglinear(data_cat, echo_times, adaptive_mask, report=True):
+    Returns
+    -------
+    pinv : (2 x echo_num) :obj:`numpy.ndarray`
+        Read-only pseudo-inverse of the (echo_num x 2) design matrix with an
+        intercept column and a column of negative echo times.
+    """
+    x = np.column_stack([np.ones(echo_num), [-te for te in echo_times[:echo_num]]])
+    pinv = np.linalg.pinv(x)
+    pinv.flags.writeable = False
+    return pinv
+
+
+def fit_loglinear(data_cat, echo_times, adaptive_mask, report=True,
+                  echo_groups=None):
     """
     """
     if report:
-        RepLGR.info("A monoexponential model was fit to the data at each voxel "
-                    "using log-linear regression in order to estimate T2* and S0 "
-                    "maps. For each voxel, the value from the adaptive mask was "
-                    "used to determine which echoes would be used to estimate T2* "
-                    "and S0.")
+        _report_decay_fit('loglin')
     n_samp, n_echos, n_vols = data_cat.shape
+    if echo_groups is None:
+        echo_groups = utils.EchoGroups(adaptive_mask)
+    fit_groups = _get_fit_groups(echo_groups)
+
+    # The least-squares solution with the design matrix repeated across
+    # volumes only depends on the temporal mean of the log data at each echo
+    n_fit_echos = max([echo_num for echo_num, _ in fit_groups], default=0)
+    log_means = np.empty((n_samp, n_fit_echos))
+    for i_echo in range(n_fit_echos):
+        log_means[:, i_echo] = np.log(np.abs(data_cat[:, i_echo, :]) + 1).mean(axis=-1)
+
+    t2s_full = np.zeros(n_samp)
+    s0_full = np.zeros(n_samp)
+    for echo_num, voxel_idx in fit_groups:
+        # perform log linear fit of echo times against MR signal, using the
+        # cached pseudo-inverse of the (echos x intercept/TEs) design matrix
+        pinv = _get_loglin_pinv(tuple(echo_times), echo_num)
+        betas = np.zeros((2, len(voxel_idx)))
+        for j_echo in range(echo_num):
+            betas += pinv[:, j_echo, None] * log_means[voxel_idx, j_echo]
+        t2s_full[voxel_idx] = 1. / betas[1, :].T
+        s0_full[voxel_idx] = np.exp(betas[0, :]).T
+
+    return _assemble_decay_maps(t2s_full, s0_full, echo_groups)
+
+
+@lru_cache(maxsize=None)
+def _get_decay_dictionary(echo_times, echo_num, n_atoms=500):
+    """
+    Get a dictionary of normalized monoexponential decay curves for the first
+    `echo_num` echoes.
 
-    echos_to_run = np.unique(adaptive_mask)
-    if 1 in echos_to_run:
-        echos_to_run = np.sort(np.unique(np.append(echos_to_run, 2)))
-    echos_to_run = echos_to_run[echos_to_run >= 2]
+    Parameters
+    ----------
+    echo_times : :obj:`tuple`
+        Echo times
+    echo_num : :obj:`int`
+        Number of echoes to use
+    n_atoms : :obj:`int`, optional
+        Number of T2* values in the dictionary. Default is 500.
 
-    t2s_asc_maps = np.zeros([n_samp, len(echos_to_run)])
-    s0_asc_maps = np.zeros([n_samp, len(echos_to_run)])
-    echo_masks = np.zeros([n_samp, len(echos_to_run)], dtype=bool)
+    Returns
+    -------
+    log_t2s : (n_atoms,) :obj:`numpy.ndarray`
+        Log of the T2* values in the dictionary, evenly spaced between 1/20 and
+        20 times the longest echo time.
+    atoms : (n_atoms x echo_num) :obj:`numpy.ndarray`
+        Read-only unit-norm decay curves, ``exp(-TE / T2*)``, for each T2*
+    atom_norms : (n_atoms,) :obj:`numpy.ndarray`
+        Read-only norms of the decay curves before normalization
+    """
+    tes = np.asarray(echo_times[:echo_num], dtype=float)
+    log_t2s = np.linspace(np.log(tes.max() / 20.), np.log(tes.max() * 20.), n_atoms)
+    atoms = np.exp(-tes[None, :] / np.exp(log_t2s)[:, None])
+    atom_norms = np.linalg.norm(atoms, axis=1)
+    atoms /= atom_norms[:, None]
+    log_t2s.flags.writeable = False
+    atoms.flags.writeable = False
+    atom_norms.flags.writeable = False
+    return log_t2s, atoms, atom_norms
+
+
+def _refine_decay_match(data_mean, echo_times, log_t2star, s0_fixed, max_step,
+                        n_iter=3):
+    """
+    Refine T2* estimates with Newton steps on the least-squares cost.
 
-    for i_echo, echo_num in enumerate(echos_to_run):
-        if echo_num == 2:
-            voxel_idx = np.where(adaptive_mask <= echo_num)[0]
-        else:
-            voxel_idx = np.where(adaptive_mask == echo_num)[0]
+    Parameters
+    ----------
+    data_mean : (N x E) :obj:`numpy.ndarray`
+        Mean signal for each sample and echo
+    echo_times : (E,) :obj:`numpy.ndarray`
+        Echo times
+    log_t2star : (N,) :obj:`numpy.ndarray`
+        Initial estimates of log T2*
+    s0_fixed : (N,) :obj:`numpy.ndarray`
+        S0 for samples where it is held at its lower bound, and NaN for
+        samples where it is the least-squares S0 for each T2*
+    max_step : :obj:`float`
+        Largest change in log T2* allowed in each step
+    n_iter : :obj:`int`, optional
+        Number of Newton steps. Default is 3.
 
-        # Create echo masks to assign values to limited vs full maps later
-        echo_mask = np.squeeze(echo_masks[..., i_echo])
-        echo_mask[adaptive_mask == echo_num] = True
-        echo_masks[..., i_echo] = echo_mask
+    Returns
+    -------
+    log_t2star : (N,) :obj:`numpy.ndarray`
+        Refined estimates of log T2*
 
-        # perform log linear fit of echo times against MR signal
-        # make DV matrix: samples x (time series * echos)
-        data_2d = data_cat[voxel_idx, :echo_num, :].reshape(len(voxel_idx), -1).T
-        log_data = np.log(np.abs(data_2d) + 1)
+    Notes
+    -----
+    With the decay curve ``a = exp(-TE / T2*)``, ``p = data . a`` and
+    ``q = a . a``, the cost with the least-squares S0 is minimized by
+    maximizing ``2 log(p) - log(q)``, and the cost with S0 held at ``c`` is
+    ``c**2 q - 2 c p``. Both are differentiated with respect to log T2*.
+    """
+    log_t2star = log_t2star.copy()
+    fixed = np.isfinite(s0_fixed)
+    c = s0_fixed[fixed]
+    for _ in range(n_iter):
+        rate = echo_times[None, :] * np.exp(-log_t2star)[:, None]
+        a = np.exp(-rate)
+        da = a * rate
+        d2a = da * (rate - 1)
+        p, dp, d2p = [np.sum(data_mean * x, axis=1) for x in (a, da, d2a)]
+        q = np.sum(a ** 2, axis=1)
+        dq = 2 * np.sum(a * da, axis=1)
+        d2q = 2 * np.sum(da ** 2 + a * d2a, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # gradient and curvature of the objective to maximize
+            grad = 2 * dp / p - dq / q
+            curv = 2 * (d2p / p - (dp / p) ** 2) - (d2q / q - (dq / q) ** 2)
+            grad[fixed] = 2 * c * dp[fixed] - c ** 2 * dq[fixed]
+            curv[fixed] = 2 * c * d2p[fixed] - c ** 2 * d2q[fixed]
+            step = np.where(curv < 0, -grad / curv, 0)
+        log_t2star += np.clip(np.nan_to_num(step), -max_step, max_step)
+    return log_t2star
+
+
+def _match_decay_dictionary(data_mean, echo_times, s0_min=None, block_size=2000):
+    """
+    Estimate T2* and S0 by matching decay curves against a dictionary.
 
-        # make IV matrix: intercept/TEs x (time series * echos)
-        x = np.column_stack([np.ones(echo_num), [-te for te in echo_times[:echo_num]]])
-        X = np.repeat(x, n_vols, axis=0)
+    Parameters
+    ----------
+    data_mean : (N x E) :obj:`numpy.ndarray`
+        Mean signal for each sample and echo
+    echo_times : (E,) array_like
+        Echo times
+    s0_min : (N,) array_like or None, optional
+        Lower bound on S0 for each sample. Default is None, which does not
+        bound S0.
+    block_size : :obj:`int`, optional
+        Number of samples to match at once, which bounds the size of the
+        (samples x atoms) correlation matrix. Default is 2000.
 
-        # Log-linear fit
-        betas = np.linalg.lstsq(X, log_data, rcond=None)[0]
-        t2s = 1. / betas[1, :].T
-        s0 = np.exp(betas[0, :]).T
+    Returns
+    -------
+    s0, t2star : (N,) :obj:`numpy.ndarray`
+        Estimated S0 and T2* values
+    matched : (N,) :obj:`numpy.ndarray`
+        Boolean array of samples whose best match is inside the dictionary.
+        Estimates for other samples, whose best T2* is at or beyond the ends
+        of the dictionary or whose data do not correlate positively with any
+        decay curve, are not meaningful.
 
-        t2s_asc_maps[voxel_idx, i_echo] = t2s
-        s0_asc_maps[voxel_idx, i_echo] = s0
+    Notes
+    -----
+    For a fixed T2*, the least-squares S0 is the projection of the data onto
+    the decay curve, so the best-fitting T2* is the dictionary atom with the
+    largest correlation with the data. If that S0 is below `s0_min`, S0 is
+    held at `s0_min` and the atom with the lowest cost for that S0 is used
+    instead, as in the bounded nonlinear fit. The T2* estimate is refined
+    between grid points by fitting a parabola to the scores of the best atom
+    and its two neighbours, and then by Newton steps on the least-squares
+    cost.
+    """
+    n_samp, echo_num = data_mean.shape
+    echo_times = np.asarray(echo_times[:echo_num], dtype=float)
+    log_t2s, atoms, atom_norms = _get_decay_dictionary(tuple(echo_times), echo_num)
+    step = log_t2s[1] - log_t2s[0]
+    n_atoms = len(log_t2s)
+    if s0_min is None:
+        s0_min = np.full(n_samp, -np.inf)
+    else:
+        s0_min = np.asarray(s0_min, dtype=float)
+
+    log_t2star = np.empty(n_samp)
+    bounded = np.zeros(n_samp, dtype=bool)
+    matched = np.zeros(n_samp, dtype=bool)
+    for start in range(0, n_samp, block_size):
+        block = slice(start, start + block_size)
+        score = data_mean[block] @ atoms.T
+        best = np.argmax(score, axis=1)
+        positive = score[np.arange(len(best)), best] > 0
+
+        # hold S0 at its lower bound where the least-squares S0 is below it,
+        # and score atoms by their negative cost with that S0
+        block_bounded = score[np.arange(len(best)), best] / atom_norms[best] < s0_min[block]
+        if block_bounded.any():
+            c = s0_min[block][block_bounded, None]
+            score[block_bounded] = (2 * c * atom_norms * score[block_bounded] -
+                                    c ** 2 * atom_norms ** 2)
+            best[block_bounded] = np.argmax(score[block_bounded], axis=1)
+        bounded[block] = block_bounded
+        log_t2star[block] = log_t2s[best]
+
+        inner = (best > 0) & (best < n_atoms - 1)
+        matched[block] = inner & (positive | block_bounded)
+        rows = np.where(inner)[0]
+        c_lo = score[rows, best[inner] - 1]
+        c_mid = score[rows, best[inner]]
+        c_hi = score[rows, best[inner] + 1]
+        curv = c_lo - 2 * c_mid + c_hi
+        offset = np.zeros(len(rows))
+        np.divide(0.5 * (c_lo - c_hi), curv, out=offset, where=curv < 0)
+        log_t2star[start + rows] += np.clip(offset, -0.5, 0.5) * step
+
+    s0_fixed = np.where(bounded, s0_min, np.nan)
+    log_t2star[matched] = _refine_decay_match(
+        data_mean[matched], echo_times, log_t2star[matched], s0_fixed[matched],
+        max_step=step)
+
+    t2star = np.exp(log_t2star)
+    decay = np.exp(-echo_times[None, :] / t2star[:, None])
+    s0 = np.sum(decay * data_mean, axis=1) / np.sum(decay ** 2, axis=1)
+    s0[bounded] = s0_min[bounded]
+    return s0, t2star, matched
+
+
+def fit_dictionary(data_cat, echo_times, adaptive_mask, report=True,
+                   echo_groups=None):
+    """
+    Fit monoexponential decay model by matching against a dictionary of decay
+    curves.
 
-    # create limited T2* and S0 maps
-    t2s_limited = utils.unmask(t2s_asc_maps[echo_masks], adaptive_mask > 1)
-    s0_limited = utils.unmask(s0_asc_maps[echo_masks], adaptive_mask > 1)
+    Parameters
+    ----------
+    data_cat : (S x E x T) :obj:`numpy.ndarray`
+        Multi-echo data
+    echo_times : (E,) array_like
+        Echo times
+    adaptive_mask : (S,) :obj:`numpy.ndarray`
+        Number of echoes with good signal in each sample
+    report : :obj:`bool`, optional
+        Whether to log the method to the report. Default is True.
+    echo_groups : :obj:`tedana.utils.EchoGroups` or None, optional
+        Index of samples by number of good echoes, built from `adaptive_mask`
+        if not provided. Default is None.
 
-    # create full T2* maps with S0 estimation errors
-    t2s_full, s0_full = t2s_limited.copy(), s0_limited.copy()
-    t2s_full[adaptive_mask == 1] = t2s_asc_maps[adaptive_mask == 1, 0]
-    s0_full[adaptive_mask == 1] = s0_asc_maps[adaptive_mask == 1, 0]
+    Returns
+    -------
+    t2s_limited, s0_limited, t2s_full, s0_full
 
-    return t2s_limited, s0_limited, t2s_full, s0_full
+    Notes
+    -----
+    Like the nonlinear fit, this minimizes the squared error of the
+    monoexponential model in the original signal space, with S0 bounded
+    below by the minimum of the data, and falls back to the log-linear
+    estimates for samples where the fit fails. The fit fails where the best
+    T2* is at or beyond the ends of the dictionary (1/20 to 20 times the
+    longest echo time used).
+    """
+    if report:
+        _report_decay_fit('dictionary')
+    echo_times = np.asarray(echo_times, dtype=float)
+    if echo_groups is None:
+        echo_groups = utils.EchoGroups(adaptive_mask)
+
+    t2s_limited, s0_limited, t2s_full, s0_full = fit_loglinear(
+        data_cat, echo_times, adaptive_mask, report=False,
+        echo_groups=echo_groups)
+
+    for echo_num, voxel_idx in _get_fit_groups(echo_groups):
+        # as in fit_monoexponential, only the temporal mean and the lower
+        # bound on S0 (the minimum of the data) are needed
+        data_3d = data_cat[voxel_idx, :echo_num, :]
+        data_mean = data_3d.mean(axis=-1)
+        s0_min = data_3d.min(axis=(1, 2))
+        del data_3d
+
+        s0_fit, t2s_fit, matched = _match_decay_dictionary(
+            data_mean, echo_times[:echo_num], s0_min=s0_min)
+        # If the match fails, fall back to loglinear estimate
+        s0_full[voxel_idx[matched]] = s0_fit[matched]
+        t2s_full[voxel_idx[matched]] = t2s_fit[matched]
+        fail_count = np.sum(~matched)
+
+        if fail_count:
+            fail_percent = 100 * fail_count / len(voxel_idx)
+            LGR.debug('With {0} echoes, dictionary fit failed on {1}/{2} '
+                      '({3:.2f}%) voxel(s), used log linear estimate '
+                      'instead'.format(echo_num, fail_count, len(voxel_idx), fail_percent))
+
+    return _assemble_decay_maps(t2s_full, s0_full, echo_groups)
 
 
-def fit_decay(data, tes, mask, adaptive_mask, fittype):
+def fit_decay(data, tes, mask, adaptive_mask, fittype, n_jobs=1):
     """
     Fit voxel-wise monoexponential decay models to `data`
 
@@ -195,8 +612,13 @@ def fit_decay(data, tes, mask, adaptive_mask, fittype):
     adaptive_mask : (S,) array_like
         Valued array indicating number of echos that have sufficient signal in
         given sample
-    fittype : {loglin, curvefit}
+    fittype : {loglin, curvefit, dictionary}
         The type of model fit to use
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to use. Masked samples are split into
+        chunks, which are fit in parallel from a memory-mapped copy of `data`.
+        Results do not depend on the number of workers. -1 uses all CPUs.
+        Default is 1.
 
     Returns
     -------
@@ -238,40 +660,183 @@ def fit_decay(data, tes, mask, adaptive_mask, fittype):
                          'mask ({1}), and adaptive_mask ({2}) do not '
                          'match'.format(data.shape[0], mask.shape[0], adaptive_mask.shape[0]))
 
-    data = data.copy()
     if data.ndim == 2:
         data = data[:, :, None]
 
-    # Mask the inputs
-    data_masked = data[mask, :, :]
-    adaptive_mask_masked = adaptive_mask[mask]
+    # index samples the same way that masking the data would
+    mask_idx = np.arange(data.shape[0])[mask]
+
+    maps = [np.zeros(len(mask_idx)) for _ in range(4)]
+    start = 0
+    for chunk_idx, chunk_maps in _fit_decay_chunks(data, tes, mask_idx, adaptive_mask,
+                                                   fittype, n_jobs=n_jobs):
+        for map_, chunk_map in zip(maps, chunk_maps):
+            map_[start:start + len(chunk_idx)] = chunk_map
+        start += len(chunk_idx)
+    t2s_limited, s0_limited, t2s_full, s0_full = maps
+
+    t2s_limited = utils.unmask(t2s_limited, mask)
+    s0_limited = utils.unmask(s0_limited, mask)
+    t2s_full = utils.unmask(t2s_full, mask)
+    s0_full = utils.unmask(s0_full, mask)
+
+    return t2s_limited, s0_limited, t2s_full, s0_full
+
+
+def _fit_decay_masked(data, tes, adaptive_mask, fittype, report=True):
+    """
+    Fit monoexponential decay models to masked data and clean up the
+    resulting maps.
+
+    Parameters
+    ----------
+    data : (M x E x T) array_like
+        Masked multi-echo data array
+    tes : (E,) :obj:`list`
+        Echo times
+    adaptive_mask : (M,) array_like
+        Masked adaptive mask
+    fittype : {loglin, curvefit, dictionary}
+        The type of model fit to use
+    report : :obj:`bool`, optional
+        Whether to log the method to the report. Default is True.
 
+    Returns
+    -------
+    t2s_limited, s0_limited, t2s_full, s0_full : (M,) :obj:`numpy.ndarray`
+        Limited and full T2* and S0 maps, as described in :func:`fit_decay`.
+    """
     if fittype == 'loglin':
         t2s_limited, s0_limited, t2s_full, s0_full = fit_loglinear(
-            data_masked, tes, adaptive_mask_masked)
+            data, tes, adaptive_mask, report=report)
     elif fittype == 'curvefit':
         t2s_limited, s0_limited, t2s_full, s0_full = fit_monoexponential(
-            data_masked, tes, adaptive_mask_masked)
+            data, tes, adaptive_mask, report=report)
+    elif fittype == 'dictionary':
+        t2s_limited, s0_limited, t2s_full, s0_full = fit_dictionary(
+            data, tes, adaptive_mask, report=report)
     else:
         raise ValueError('Unknown fittype option: {}'.format(fittype))
 
     t2s_limited[np.isinf(t2s_limited)] = 500.  # why 500?
     # let's get rid of negative values, but keep zeros where limited != full
-    t2s_limited[(adaptive_mask_masked > 1) & (t2s_limited <= 0)] = 1.
+    t2s_limited[(adaptive_mask > 1) & (t2s_limited <= 0)] = 1.
     s0_limited[np.isnan(s0_limited)] = 0.  # why 0?
     t2s_full[np.isinf(t2s_full)] = 500.  # why 500?
     t2s_full[t2s_full <= 0] = 1.  # let's get rid of negative values!
     s0_full[np.isnan(s0_full)] = 0.  # why 0?
 
-    t2s_limited = utils.unmask(t2s_limited, mask)
-    s0_limited = utils.unmask(s0_limited, mask)
-    t2s_full = utils.unmask(t2s_full, mask)
-    s0_full = utils.unmask(s0_full, mask)
-
     return t2s_limited, s0_limited, t2s_full, s0_full
 
 
-def fit_decay_ts(data, tes, mask, adaptive_mask, fittype):
+def _fit_decay_chunk(data, tes, sample_idx, adaptive_mask, fittype,
+                     volumewise=False, report=False):
+    """
+    Fit monoexponential decay models to a chunk of samples.
+
+    Parameters
+    ----------
+    data : (S x E x T) array_like
+        Multi-echo data array
+    tes : (E,) :obj:`list`
+        Echo times
+    sample_idx : (N,) array_like
+        Indices of the samples in the chunk
+    adaptive_mask : (S,) array_like
+        Adaptive mask
+    fittype : {loglin, curvefit, dictionary}
+        The type of model fit to use
+    volumewise : :obj:`bool`, optional
+        Whether to fit each volume separately. Default is False.
+    report : :obj:`bool`, optional
+        Whether to log the method to the report. Default is False.
+
+    Returns
+    -------
+    maps : :obj:`list` of four (N [x T]) :obj:`numpy.ndarray`
+        Limited T2*, limited S0, full T2* and full S0 maps for the chunk
+    """
+    n_echos, n_vols = data.shape[1:]
+    data_chunk = data[sample_idx, :, :]
+    adaptive_mask_chunk = adaptive_mask[sample_idx]
+    if volumewise:
+        # treat each volume of each sample as a single-volume sample
+        data_chunk = data_chunk.transpose(0, 2, 1).reshape(-1, n_echos)[:, :, None]
+        adaptive_mask_chunk = np.repeat(adaptive_mask_chunk, n_vols)
+
+    maps = _fit_decay_masked(data_chunk, tes, adaptive_mask_chunk, fittype,
+                             report=report)
+    if volumewise:
+        maps = [map_.reshape(len(sample_idx), n_vols) for map_ in maps]
+    return list(maps)
+
+
+def _fit_decay_chunks(data, tes, sample_idx, adaptive_mask, fittype,
+                      chunk_size=None, n_jobs=1, volumewise=False):
+    """
+    Fit monoexponential decay models to chunks of samples, optionally in
+    parallel.
+
+    Parameters
+    ----------
+    data : (S x E x T) array_like
+        Multi-echo data array
+    tes : (E,) :obj:`list`
+        Echo times
+    sample_idx : (N,) array_like
+        Indices of the samples to fit
+    adaptive_mask : (S,) array_like
+        Adaptive mask
+    fittype : {loglin, curvefit, dictionary}
+        The type of model fit to use
+    chunk_size : :obj:`int` or None, optional
+        Number of samples per chunk. Default is None, which splits the samples
+        evenly across workers.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes. Default is 1.
+    volumewise : :obj:`bool`, optional
+        Whether to fit each volume separately. Default is False.
+
+    Yields
+    ------
+    chunk_idx : :obj:`numpy.ndarray`
+        Indices of the samples in the chunk, in the order of `sample_idx`.
+    maps : :obj:`list` of :obj:`numpy.ndarray`
+        Maps for the chunk, as returned by :func:`_fit_decay_chunk`.
+    """
+    n_workers = effective_n_jobs(n_jobs)
+    if chunk_size is None:
+        chunk_size = int(np.ceil(len(sample_idx) / n_workers))
+    chunk_size = max(chunk_size, 1)
+    chunks = [sample_idx[start:start + chunk_size]
+              for start in range(0, len(sample_idx), chunk_size)]
+
+    if n_workers == 1:
+        for i_chunk, chunk_idx in enumerate(chunks):
+            yield chunk_idx, _fit_decay_chunk(data, tes, chunk_idx, adaptive_mask,
+                                              fittype, volumewise=volumewise,
+                                              report=(i_chunk == 0))
+        return
+
+    # Workers do not share our report handlers, so log the method here.
+    # Each worker is sent only the samples in its chunk, so that at most one
+    # batch of chunks is copied to the workers at a time, rather than the
+    # full data for every chunk.
+    _report_decay_fit(fittype)
+    with Parallel(n_jobs=n_workers) as parallel:
+        for start in range(0, len(chunks), n_workers):
+            batch = chunks[start:start + n_workers]
+            results = parallel(
+                delayed(_fit_decay_chunk)(data[chunk_idx], tes, np.arange(len(chunk_idx)),
+                                          adaptive_mask[chunk_idx], fittype,
+                                          volumewise=volumewise)
+                for chunk_idx in batch)
+            for chunk_idx, maps in zip(batch, results):
+                yield chunk_idx, maps
+
+
+def fit_decay_ts(data, tes, mask, adaptive_mask, fittype, chunk_size=None,
+                 out=None, n_jobs=1):
     """
     Fit voxel- and timepoint-wise monoexponential decay models to `data`
 
@@ -290,6 +855,17 @@ def fit_decay_ts(data, tes, mask, adaptive_mask, fittype):
         given sample
     fittype : :obj: `str`
         The type of model fit to use
+    chunk_size : :obj:`int` or None, optional
+        Number of masked samples to fit at once. Peak memory use scales with
+        the chunk size. Default is None, which fits all samples in one pass.
+    out : :obj:`tuple` of four (S x T) array_like or None, optional
+        Arrays (e.g., :obj:`numpy.memmap` objects) into which the limited T2*,
+        limited S0, full T2* and full S0 timeseries are written. Default is
+        None, which allocates new arrays.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to use. Chunks of samples are fit in
+        parallel from a memory-mapped copy of `data`. Results do not depend on
+        the number of workers. -1 uses all CPUs. Default is 1.
 
     Returns
     -------
@@ -307,21 +883,42 @@ def fit_decay_ts(data, tes, mask, adaptive_mask, fittype):
         Full S0 timeseries. For voxels affected by dropout, with good signal
         from only one echo, the full timeseries uses the single echo's value
         at that voxel/volume.
-    """
-    n_samples, _, n_vols = data.shape
-    tes = np.array(tes)
 
-    t2s_limited_ts = np.zeros([n_samples, n_vols])
-    s0_limited_ts = np.copy(t2s_limited_ts)
-    t2s_full_ts = np.copy(t2s_limited_ts)
-    s0_full_ts = np.copy(t2s_limited_ts)
+    Notes
+    -----
+    Each volume of each sample is treated as a separate sample with a single
+    volume, so all voxel- and volume-wise estimates in a chunk are computed
+    by one call to the fitting function.
+    """
+    if data.shape[1] != len(tes):
+        raise ValueError('Second dimension of data ({0}) does not match number '
+                         'of echoes provided (tes; {1})'.format(data.shape[1], len(tes)))
+    elif not (data.shape[0] == mask.shape[0] == adaptive_mask.shape[0]):
+        raise ValueError('First dimensions (number of samples) of data ({0}), '
+                         'mask ({1}), and adaptive_mask ({2}) do not '
+                         'match'.format(data.shape[0], mask.shape[0], adaptive_mask.shape[0]))
 
-    for vol in range(n_vols):
-        t2s_limited, s0_limited, t2s_full, s0_full = fit_decay(
-            data[:, :, vol][:, :, None], tes, mask, adaptive_mask, fittype)
-        t2s_limited_ts[:, vol] = t2s_limited
-        s0_limited_ts[:, vol] = s0_limited
-        t2s_full_ts[:, vol] = t2s_full
-        s0_full_ts[:, vol] = s0_full
+    n_samples, n_echos, n_vols = data.shape
+    tes = np.array(tes)
 
+    if out is None:
+        out = [np.zeros([n_samples, n_vols]) for _ in range(4)]
+    elif len(out) != 4 or any(arr.shape != (n_samples, n_vols) for arr in out):
+        raise ValueError('Argument "out" must contain four arrays of shape '
+                         '{0}'.format((n_samples, n_vols)))
+
+    # index samples the same way that masking the data would
+    mask_idx = np.arange(n_samples)[mask]
+    unmasked = np.ones(n_samples, dtype=bool)
+    unmasked[mask_idx] = False
+    for arr in out:
+        arr[unmasked] = 0
+
+    for chunk_idx, maps in _fit_decay_chunks(data, tes, mask_idx, adaptive_mask,
+                                             fittype, chunk_size=chunk_size,
+                                             n_jobs=n_jobs, volumewise=True):
+        for arr, map_ in zip(out, maps):
+            arr[chunk_idx, :] = map_
+
+    t2s_limited_ts, s0_limited_ts, t2s_full_ts, s0_full_ts = out
     return t2s_limited_ts, s0_limited_ts, t2s_full_ts, s0_full_ts
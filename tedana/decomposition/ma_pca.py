@@ -2,15 +2,16 @@
 PCA based on Moving Average (stationary Gaussian) process
 """
 import logging
+from functools import lru_cache
 
 import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
 
-from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 
-from scipy.linalg import svd
-from scipy.signal import detrend, fftconvolve
-from scipy.fftpack import fftshift, fftn
+from scipy.linalg import eigh, svd
+from scipy.signal import detrend
+from scipy.fftpack import next_fast_len
 
 LGR = logging.getLogger(__name__)
 
@@ -119,6 +120,72 @@ def _parzen_win(n_points):
     return parzen_w
 
 
+@lru_cache(maxsize=32)
+def _get_ent_rate_kernel(dims, sm_window):
+    """
+    Build the FFT sizes, lag indices and weights used by :func:`ent_rate_sp`
+    for volumes of a given shape.
+
+    Parameters
+    ----------
+    dims : :obj:`tuple` of :obj:`int`
+        Shape of the volume
+    sm_window : bool
+        Whether to apply Parzen windows
+
+    Returns
+    -------
+    fft_shape : :obj:`tuple` of :obj:`int`
+        Zero-padded shape of the FFT of the volume
+    corr_idx : :obj:`tuple` of array_like
+        Indices of lags -(N - 1) to N - 1 along each axis in the circular
+        autocorrelation
+    corr_weights : (2 * X - 1 x 2 * Y - 1 x 2 * Z - 1) array_like
+        Bias-correcting and Parzen window weights of each lag
+    freq_weights : (Z,) array_like
+        Number of frequencies represented by each frequency along the last
+        axis of the real FFT of the autocorrelation
+
+    Notes
+    -----
+    The kernels are cached, since the same shapes recur across components
+    and subsampling depths, so the returned arrays are read-only.
+    Lags along the third axis are folded onto their absolute values, and the
+    largest one is left out, as in the slice-by-slice correlation of the
+    original implementation.
+    """
+    fft_shape = tuple(next_fast_len(2 * n - 1) for n in dims)
+    lags = [np.abs(np.arange(-(n - 1), n)) for n in dims]
+    corr_idx = np.ix_(
+        np.arange(-(dims[0] - 1), dims[0]) % fft_shape[0],
+        np.arange(-(dims[1] - 1), dims[1]) % fft_shape[1],
+        lags[2] % fft_shape[2])
+
+    # Correct the bias from the number of products summed at each lag, and
+    # apply Parzen windows, one separable factor per spatial direction
+    M = [int(i) for i in np.ceil(np.array(dims) / 10)]
+    corr_weights = np.ones([2 * n - 1 for n in dims])
+    for i_dim, n in enumerate(dims):
+        shape = [1, 1, 1]
+        shape[i_dim] = -1
+        corr_weights /= (n - lags[i_dim]).reshape(shape)
+        if sm_window:
+            parzen_w = np.zeros((2 * n - 1, ))
+            parzen_w[(n - M[i_dim] - 1):(n + M[i_dim])] = _parzen_win(2 * M[i_dim] + 1)
+            corr_weights *= parzen_w.reshape(shape)
+    corr_weights[:, :, lags[2] == dims[2] - 1] = 0
+
+    # The spectrum of the real autocorrelation is conjugate symmetric, so the
+    # half-spectrum along the last (odd-length) axis covers every frequency
+    # but the first twice
+    freq_weights = np.full(dims[2], 2.)
+    freq_weights[0] = 1.
+
+    for arr in corr_idx + (corr_weights, freq_weights):
+        arr.flags.writeable = False
+    return fft_shape, corr_idx, corr_weights, freq_weights
+
+
 def ent_rate_sp(data, sm_window):
     """
     Calculate the entropy rate of a stationary Gaussian random process using
@@ -163,65 +230,21 @@ def ent_rate_sp(data, sm_window):
         raise ValueError('Divide by zero encountered.')
     data = data / data_std
 
-    if sm_window:
-        M = [int(i) for i in np.ceil(np.array(dims) / 10)]
-
-        # Get Parzen window for each spatial direction
-        parzen_w_3 = np.zeros((2 * dims[2] - 1, ))
-        parzen_w_3[(dims[2] - M[2] - 1):(dims[2] + M[2])] = _parzen_win(2 * M[2] + 1)
-
-        parzen_w_2 = np.zeros((2 * dims[1] - 1, ))
-        parzen_w_2[(dims[1] - M[1] - 1):(dims[1] + M[1])] = _parzen_win(2 * M[1] + 1)
-
-        parzen_w_1 = np.zeros((2 * dims[0] - 1, ))
-        parzen_w_1[(dims[0] - M[0] - 1):(dims[0] + M[0])] = _parzen_win(2 * M[0] + 1)
-
-    # Apply windows to 3D
-    # TODO: replace correlate2d with 3d if possible
-    data_corr = np.zeros((2 * dims[0] - 1, 2 * dims[1] - 1, 2 * dims[2] - 1))
-    for m3 in range(dims[2] - 1):
-        temp = np.zeros((2 * dims[0] - 1, 2 * dims[1] - 1))
-        for k in range(dims[2] - m3):
-            temp += fftconvolve(data[:, :, k + m3], data[::-1, ::-1, k])
-            # default option:
-            # computes raw correlations with NO normalization
-            # -- Matlab help on xcorr
-        data_corr[:, :, (dims[2] - 1) - m3] = temp
-        data_corr[:, :, (dims[2] - 1) + m3] = temp
-
-    # Create bias-correcting vectors
-    v1 = np.hstack((np.arange(1, dims[0] + 1),
-                    np.arange(dims[0] - 1, 0, -1)))[np.newaxis, :]
-    v2 = np.hstack((np.arange(1, dims[1] + 1),
-                    np.arange(dims[1] - 1, 0, -1)))[np.newaxis, :]
-    v3 = np.arange(dims[2], 0, -1)
-
-    vd = np.dot(v1.T, v2)
-    vcu = np.zeros((2 * dims[0] - 1, 2 * dims[1] - 1, 2 * dims[2] - 1))
-    for m3 in range(dims[2]):
-        vcu[:, :, (dims[2] - 1) - m3] = vd * v3[m3]
-        vcu[:, :, (dims[2] - 1) + m3] = vd * v3[m3]
-
-    data_corr /= vcu
-
-    # Scale Parzen windows
-    parzen_window_2D = np.dot(parzen_w_1[np.newaxis, :].T,
-                              parzen_w_2[np.newaxis, :])
-    parzen_window_3D = np.zeros((2 * dims[0] - 1, 2 * dims[1] - 1, 2 * dims[2] - 1))
-    for m3 in range(dims[2] - 1):
-        parzen_window_3D[:, :, (dims[2] - 1) - m3] = np.dot(
-            parzen_window_2D, parzen_w_3[dims[2] - 1 - m3])
-        parzen_window_3D[:, :, (dims[2] - 1) + m3] = np.dot(
-            parzen_window_2D, parzen_w_3[dims[2] - 1 + m3])
-
-    # Apply 3D Parzen Window
-    data_corr *= parzen_window_3D
-    data_fft = abs(fftshift(fftn(data_corr)))
+    # Raw (unnormalized) autocorrelation from a single zero-padded FFT of the
+    # data, bias corrected and windowed
+    fft_shape, corr_idx, corr_weights, freq_weights = _get_ent_rate_kernel(
+        dims, bool(sm_window))
+    data_fft = np.fft.rfftn(data, fft_shape)
+    data_corr = np.fft.irfftn(np.abs(data_fft) ** 2, fft_shape)[corr_idx]
+    data_corr *= corr_weights
+
+    data_fft = np.abs(np.fft.rfftn(data_corr))
     data_fft[data_fft < 1e-4] = 1e-4
 
     # Estimation of the entropy rate
-    ent_rate = 0.5 * np.log(2 * np.pi * np.exp(1)) + np.sum(np.log(abs(
-        (data_fft)))[:]) / 2 / np.sum(abs(data_fft)[:])
+    ent_rate = 0.5 * np.log(2 * np.pi * np.exp(1)) + np.dot(
+        np.log(data_fft).sum(axis=(0, 1)), freq_weights) / 2 / np.dot(
+        data_fft.sum(axis=(0, 1)), freq_weights)
 
     return ent_rate
 
@@ -289,7 +312,7 @@ def _subsampling(data, sub_depth):
     Returns
     -------
     out : ndarray
-        Subsampled data
+        Subsampled data, as a view of `data`
     """
 
     # First index from which to start subsampling for each dimension
@@ -297,9 +320,7 @@ def _subsampling(data, sub_depth):
     ndims = data.shape
 
     if data.ndim == 3 and np.min(ndims) != 1:  # 3D
-        out = data[np.arange(
-            idx_0[0], ndims[0], sub_depth), :, :][:, np.arange(
-                idx_0[1], ndims[1], sub_depth), :][:, :, np.arange(idx_0[2], ndims[2], sub_depth)]
+        out = data[idx_0[0]::sub_depth, idx_0[1]::sub_depth, idx_0[2]::sub_depth]
     else:
         raise ValueError('Unrecognized matrix dimension! )'
                          'Input array must be 3D with min dimension > 1.')
@@ -323,12 +344,11 @@ def _kurtn(data):
         tedana, this will be the kurtosis of each PCA component.
     """
 
-    kurt = np.zeros((data.shape[1], 1))
-
-    for i in range(data.shape[1]):
-        data_norm = detrend(data[:, i], type='constant')
-        data_norm /= np.std(data_norm)
-        kurt[i] = np.mean(data_norm**4) - 3
+    # samples of each vector along the first axis
+    data_norm = np.moveaxis(data, 1, -1).reshape(-1, data.shape[1])
+    data_norm = detrend(data_norm, axis=0, type='constant')
+    data_norm /= np.std(data_norm, axis=0)
+    kurt = (np.mean(data_norm**4, axis=0) - 3)[:, np.newaxis]
 
     kurt[kurt < 0] = 0
 
@@ -378,6 +398,62 @@ def _icatb_svd(data, n_comps=None):
     return V, Lambda
 
 
+def _pca_from_svd(data, V, Lambda, n_comps):
+    """
+    Run PCA on input data, given the SVD of the uncentered data from
+    :func:`_icatb_svd`.
+
+    Parameters
+    ----------
+    data : (S x T) array
+        The data that `V` and `Lambda` were computed from
+    V : (T x T) array
+        Eigenvectors from SVD, in ascending order of eigenvalues
+    Lambda : (T,) array
+        Eigenvalues from SVD, in ascending order
+    n_comps : int
+        Number of PCA components to be kept
+
+    Returns
+    -------
+    u : (S x C) array
+        Component weight map for each component, from the centered data.
+    s : (C,) array
+        Variance explained for each component.
+    varex_norm : (C,) array
+        Explained variance ratio.
+    v : (T x C) array
+        Component timeseries.
+
+    Notes
+    -----
+    The covariance of the centered data is a rank-one update of the
+    eigendecomposition from the SVD, so only a (T x T) eigenproblem is
+    solved. The results match those of
+    ``sklearn.decomposition.PCA(n_components=n_comps, svd_solver='full')`` up
+    to the sign of each component. Signs are chosen so that the largest
+    absolute weight of each component in the centered data is positive.
+    """
+    n_samples = data.shape[0]
+    data_mean = data.mean(axis=0)
+    cov = (np.dot(V * Lambda, V.T) -
+           np.outer(data_mean, data_mean) * n_samples / (n_samples - 1))
+    eigvals, eigvecs = eigh(cov)
+    eigvals = np.maximum(eigvals[::-1], 0)
+    s = eigvals[:n_comps]
+    v = eigvecs[:, ::-1][:, :n_comps]
+    varex_norm = s / eigvals.sum()
+
+    # flip signs so the largest absolute weight in the centered data is positive
+    data_v_c = np.dot(data, v) - np.dot(data_mean, v)
+    max_idx = np.abs(data_v_c).argmax(axis=0)
+    signs = np.sign(data_v_c[max_idx, np.arange(n_comps)])
+    v = v * signs
+    u = data_v_c * (signs / s)
+
+    return u, s, varex_norm, v
+
+
 def _eigensp_adj(lam, n, p):
     """
     Eigen spectrum adjustment for EVD on finite samples.
@@ -434,7 +510,45 @@ def _eigensp_adj(lam, n, p):
     return lam_adj
 
 
-def ma_pca(data_nib, mask_nib, criteria='mdl'):
+def _itc_criteria(eigenvalues, n_samples):
+    """
+    Compute the information theoretic criteria for each number of components.
+
+    Parameters
+    ----------
+    eigenvalues : (p,) array-like
+        Adjusted eigenvalues, in descending order.
+    n_samples : int
+        Effective number of i.i.d. samples.
+
+    Returns
+    -------
+    itc : (3 x p - 1) array-like
+        AIC, KIC and MDL for 1 to p - 1 components.
+
+    Notes
+    -----
+    The log-likelihood with k components compares the geometric and
+    arithmetic means of the p - k smallest eigenvalues. Both means come from
+    cumulative sums of the (log-)eigenvalues, which avoids the underflow of
+    a product of many eigenvalues.
+    """
+    p = eigenvalues.shape[0]
+    k = np.arange(1, p)
+    # sums over the eigenvalues from the k-th one onward
+    log_sums = np.cumsum(np.log(eigenvalues)[::-1])[::-1][k]
+    sums = np.cumsum(eigenvalues[::-1])[::-1][k]
+    LH = log_sums / (p - k) - np.log(sums / (p - k))
+    mlh = 0.5 * n_samples * (p - k) * LH
+    df = 1 + 0.5 * k * (2 * p - k + 1)
+    aic = (-2 * mlh) + (2 * df)
+    kic = (-2 * mlh) + (3 * df)
+    mdl = -mlh + (0.5 * df * np.log(n_samples))
+
+    return np.row_stack([aic, kic, mdl])
+
+
+def ma_pca(data_nib, mask_nib, criteria='mdl', n_jobs=1):
     """
     Run Singular Value Decomposition (SVD) on input data,
     automatically select components based on a Moving Average
@@ -450,6 +564,10 @@ def ma_pca(data_nib, mask_nib, criteria='mdl'):
     criteria : string in ['aic', 'kic', mdl']
                Criteria to select the number of components;
                default='mdl'.
+    n_jobs : int
+             Number of worker processes used to estimate the subsampling
+             depth of the Gaussian components. -1 uses all available CPUs;
+             default=1.
 
     Returns
     -------
@@ -469,22 +587,85 @@ def ma_pca(data_nib, mask_nib, criteria='mdl'):
           middle in terms of aggressiveness.
     mdl : Minimum Description Length. Most aggressive
           (and recommended) option.
+
+    The rows of `u` follow the voxels of the mask in column-major (Fortran)
+    order. :func:`ma_pca_masked` runs the same analysis on masked data in
+    any voxel order, without loading the full data into memory.
     """
 
-    data_nib = data_nib.get_data()
-    mask_nib = mask_nib.get_data()
-    [Nx, Ny, Nz, Nt] = data_nib.shape
-    data_nib_V = np.reshape(data_nib, (Nx * Ny * Nz, Nt), order='F')
-    maskvec = np.reshape(mask_nib, Nx * Ny * Nz, order='F')
-    data_non_normalized = data_nib_V[maskvec == 1, :]
-    scaler = StandardScaler(with_mean=True, with_std=True)
+    mask = np.asarray(mask_nib.dataobj) == 1
+    # voxels of the mask in column-major order
+    coords = np.vstack(np.unravel_index(
+        np.flatnonzero(mask.ravel(order='F')), mask.shape, order='F')).T
+    data = np.asarray(data_nib.dataobj)[tuple(coords.T)]
+
+    return ma_pca_masked(data, mask, coords=coords, criteria=criteria,
+                         n_jobs=n_jobs)
+
+
+def ma_pca_masked(data, mask, coords=None, criteria='mdl', n_jobs=1):
+    """
+    Run Singular Value Decomposition (SVD) on masked input data,
+    automatically select components based on a Moving Average
+    (stationary Gaussian) process. Finally perform PCA with
+    selected number of components.
+
+    Parameters
+    ----------
+    data : (M x T) array-like
+           Data of the `M` voxels in `mask` to compute the PCA on.
+    mask : (X x Y x Z) array-like
+           Boolean mask of the voxels in `data`.
+    coords : (M x 3) array-like or None
+             Voxel indices of each row of `data` in `mask`. If None
+             (default), the rows of `data` are the voxels of `mask` in
+             row-major (C) order, as in ``data_4d[mask]``.
+    criteria : string in ['aic', 'kic', mdl']
+               Criteria to select the number of components;
+               default='mdl'.
+    n_jobs : int
+             Number of worker processes used to estimate the subsampling
+             depth of the Gaussian components. -1 uses all available CPUs;
+             default=1.
+
+    Returns
+    -------
+    u : (M x C) array-like
+        Component weight map for each component, in the order of `data`.
+    s : (C,) array-like
+        Variance explained for each component.
+    varex_norm : (n_components,) array-like
+        Explained variance ratio.
+    v : (T x C) array-like
+        Component timeseries.
+
+    Notes
+    -----
+    See :func:`ma_pca` for the criteria. Spatial subsampling works directly
+    on the voxel indices, so the full field of view is only built for the
+    component maps whose entropy rates are estimated.
+    """
+
+    mask = np.asarray(mask).astype(bool)
+    if mask.ndim != 3:
+        raise ValueError('Mask must be 3D, not {0}D'.format(mask.ndim))
+    if coords is None:
+        coords = np.vstack(np.nonzero(mask)).T
+    else:
+        coords = np.asarray(coords)
+    n_voxels, Nt = data.shape
+    if coords.shape != (n_voxels, 3):
+        raise ValueError('Voxel indices must have shape {0}, not '
+                         '{1}'.format((n_voxels, 3), coords.shape))
+    coords_idx = tuple(coords.T)
     # TODO: determine if tedana is already normalizing before this
-    data = scaler.fit_transform(data_non_normalized)  # This was X_sc
-    data = data_non_normalized
+    scaler = StandardScaler(with_mean=True, with_std=True)
 
     LGR.info('Performing SVD on original OC data...')
     V, EigenValues = _icatb_svd(data, Nt)
     LGR.info('SVD done on original OC data')
+    # kept to derive the final PCA without another SVD of the full data
+    data_V, data_EigenValues = V, EigenValues
 
     # Reordering of values
     EigenValues = EigenValues[::-1]
@@ -514,39 +695,48 @@ def ma_pca(data_nib, mask_nib, criteria='mdl'):
 
     # Estimate the subsampling depth for effectively i.i.d. samples
     LGR.info('Estimating the subsampling depth for effective i.i.d samples...')
-    mask_ND = np.reshape(maskvec, (Nx, Ny, Nz), order='F')
-    sub_depth = len(idx)
-    sub_iid_sp = np.zeros((sub_depth, ))
-    for i in range(sub_depth):
-        x_single = np.zeros(Nx * Ny * Nz)
-        x_single[maskvec == 1] = dataN[:, idx[i]]
-        x_single = np.reshape(x_single, (Nx, Ny, Nz), order='F')
-        sub_iid_sp[i] = _est_indp_sp(x_single)[0] + 1
-        if i > 6:
-            tmp_sub_sp = sub_iid_sp[0:i]
-            tmp_sub_median = np.round(np.median(tmp_sub_sp))
-            if np.sum(tmp_sub_sp == tmp_sub_median) > 6:
-                sub_iid_sp = tmp_sub_sp
+    dim_n = mask.ndim
+    sub_iid_sp = np.zeros((len(idx), ))
+    # components are estimated in batches of one per worker, and the results
+    # are checked in order, so that the early stop gives the same depths as a
+    # serial loop
+    n_workers = effective_n_jobs(n_jobs)
+    n_done = 0
+    with Parallel(n_jobs=n_workers) as parallel:
+        while n_done < len(idx):
+            batch = idx[n_done:n_done + n_workers]
+            x_batch = []
+            for comp in batch:
+                x_single = np.zeros(mask.shape)
+                x_single[coords_idx] = dataN[:, comp]
+                x_batch.append(x_single)
+            results = parallel(delayed(_est_indp_sp)(x_single) for x_single in x_batch)
+            stop = False
+            for n_iters, _ in results:
+                i = n_done
+                sub_iid_sp[i] = n_iters + 1
+                n_done += 1
+                if i > 6:
+                    tmp_sub_sp = sub_iid_sp[0:i]
+                    tmp_sub_median = np.round(np.median(tmp_sub_sp))
+                    if np.sum(tmp_sub_sp == tmp_sub_median) > 6:
+                        sub_iid_sp = tmp_sub_sp
+                        stop = True
+                        break
+            if stop:
                 break
-        dim_n = x_single.ndim
 
     sub_iid_sp_median = int(np.round(np.median(sub_iid_sp)))
-    if np.floor(np.power(np.sum(maskvec) / Nt, 1 / dim_n)) < sub_iid_sp_median:
-        sub_iid_sp_median = int(np.floor(np.power(np.sum(maskvec) / Nt, 1 / dim_n)))
-    N = np.round(np.sum(maskvec) / np.power(sub_iid_sp_median, dim_n))
+    if np.floor(np.power(n_voxels / Nt, 1 / dim_n)) < sub_iid_sp_median:
+        sub_iid_sp_median = int(np.floor(np.power(n_voxels / Nt, 1 / dim_n)))
+    N = np.round(n_voxels / np.power(sub_iid_sp_median, dim_n))
 
     if sub_iid_sp_median != 1:
-        mask_s = _subsampling(mask_ND, sub_iid_sp_median)
-        mask_s_1d = np.reshape(mask_s, np.prod(mask_s.shape), order='F')
-        dat = np.zeros((int(np.sum(mask_s_1d)), Nt))
+        # the subsampled voxels are those on every sub_iid_sp_median-th
+        # index along each axis, as in _subsampling. Their order does not
+        # affect the SVD.
         LGR.info('Generating subsampled i.i.d. OC data...')
-        for i in range(Nt):
-            x_single = np.zeros((Nx * Ny * Nz, ))
-            x_single[maskvec == 1] = data[:, i]
-            x_single = np.reshape(x_single, (Nx, Ny, Nz), order='F')
-            dat0 = _subsampling(x_single, sub_iid_sp_median)
-            dat0 = np.reshape(dat0, np.prod(dat0.shape), order='F')
-            dat[:, i] = dat0[mask_s_1d == 1]
+        dat = data[np.all(coords % sub_iid_sp_median == 0, axis=1)]
 
         # Perform Variance Normalization
         dat = scaler.fit_transform(dat)
@@ -572,20 +762,7 @@ def ma_pca(data_nib, mask_nib, criteria='mdl'):
         EigenValues[np.real(EigenValues) <= np.finfo(float).eps] = np.min(
             EigenValues[np.real(EigenValues) >= np.finfo(float).eps])
     LGR.info('Estimating the dimension ...')
-    p = Nt
-    aic = np.zeros(p - 1)
-    kic = np.zeros(p - 1)
-    mdl = np.zeros(p - 1)
-
-    for k_idx, k in enumerate(np.arange(1, p)):
-        LH = np.log(np.prod(np.power(EigenValues[k:], 1 / (p - k))) / np.mean(EigenValues[k:]))
-        mlh = 0.5 * N * (p - k) * LH
-        df = 1 + 0.5 * k * (2 * p - k + 1)
-        aic[k_idx] = (-2 * mlh) + (2 * df)
-        kic[k_idx] = (-2 * mlh) + (3 * df)
-        mdl[k_idx] = -mlh + (0.5 * df * np.log(N))
-
-    itc = np.row_stack([aic, kic, mdl])
+    itc = _itc_criteria(EigenValues, N)
 
     if criteria == 'aic':
         criteria_idx = 0
@@ -604,11 +781,6 @@ def ma_pca(data_nib, mask_nib, criteria='mdl'):
     LGR.info('Estimated components is found out to be %d' % comp_est)
 
     # PCA with estimated number of components
-    ppca = PCA(n_components=comp_est, svd_solver='full', copy=False)
-    ppca.fit(data)
-    v = ppca.components_.T
-    s = ppca.explained_variance_
-    u = np.dot(np.dot(data, v), np.diag(1. / s))
-    varex_norm = ppca.explained_variance_ratio_
+    u, s, varex_norm, v = _pca_from_svd(data, data_V, data_EigenValues, comp_est)
 
     return u, s, varex_norm, v
@@ -6,7 +6,8 @@ import os.path as op
 
 import numpy as np
 import pandas as pd
-from scipy import stats
+from nilearn._utils import check_niimg
+from scipy import linalg, stats
 from sklearn.decomposition import PCA
 
 from tedana import metrics, utils, io
@@ -18,6 +19,9 @@ LGR = logging.getLogger(__name__)
 RepLGR = logging.getLogger('REPORT')
 RefLGR = logging.getLogger('REFERENCES')
 
+# number of copies of each block of voxels held at a time by stream_pca
+STREAM_BLOCK_COPIES = 4
+
 
 def low_mem_pca(data):
     """
@@ -46,9 +50,325 @@ def low_mem_pca(data):
     return u, s, v
 
 
+def gram_pca(data, n_components=None, chunk_size=None):
+    """
+    Run PCA on input data from the eigendecomposition of its Gram matrix.
+
+    The (T x T) cross-product of the column-centered data is accumulated over
+    chunks of samples, which is much cheaper than an SVD of the full data when
+    there are far more samples than time points.
+
+    Parameters
+    ----------
+    data : (S [*E] x T) array_like
+        Optimally combined (S x T) or full multi-echo (S*E x T) data.
+    n_components : :obj:`int` or None, optional
+        Number of components to retain. Default is None, which retains T - 1
+        components.
+    chunk_size : :obj:`int` or None, optional
+        Number of samples to process at a time. Default is None, which
+        processes all samples at once.
+
+    Returns
+    -------
+    u : (S [*E] x C) array_like
+        Component weight map for each component.
+    s : (C,) array_like
+        Variance explained for each component.
+    v : (T x C) array_like
+        Component timeseries.
+
+    Notes
+    -----
+    Components match those of :obj:`sklearn.decomposition.PCA` up to the sign
+    of each component, and the weights are those of the centered data, as in
+    the sklearn solver of :func:`tedpca`. Signs are chosen so that the
+    largest absolute weight of each component is positive.
+    """
+    n_samples, n_vols = data.shape
+    if n_components is None:
+        n_components = n_vols - 1
+    if not 0 < n_components <= min(n_samples, n_vols):
+        raise ValueError('n_components ({0}) must be between 1 and {1}'.format(
+            n_components, min(n_samples, n_vols)))
+    if chunk_size is None:
+        chunk_size = n_samples
+    elif chunk_size < 1:
+        raise ValueError('chunk_size must be a positive integer, not '
+                         '{0}'.format(chunk_size))
+    chunks = [slice(start, start + chunk_size)
+              for start in range(0, n_samples, chunk_size)]
+
+    mean = np.zeros(n_vols)
+    for chunk in chunks:
+        mean += data[chunk].sum(axis=0)
+    mean /= n_samples
+    u = np.zeros((n_samples, n_components))
+    return _gram_pca_chunks(lambda chunk: data[chunk], chunks, mean, u)
+
+
+def _gram_pca_chunks(get_chunk, chunks, mean, u):
+    """
+    Decompose data supplied in chunks of samples from its Gram matrix.
+
+    Parameters
+    ----------
+    get_chunk : callable
+        Function returning the (s x T) data for a slice of samples.
+    chunks : :obj:`list` of :obj:`slice`
+        Consecutive slices covering all samples.
+    mean : (T,) array_like
+        Mean of each column of the data.
+    u : (S x C) array_like
+        Array into which the component weight maps are written.
+
+    Returns
+    -------
+    u : (S x C) array_like
+        Component weight map for each component.
+    s : (C,) array_like
+        Variance explained for each component.
+    v : (T x C) array_like
+        Component timeseries.
+    """
+    n_samples, n_components = u.shape
+    n_vols = mean.shape[0]
+    gram = np.zeros((n_vols, n_vols))
+    for chunk in chunks:
+        data_c = get_chunk(chunk) - mean
+        gram += np.dot(data_c.T, data_c)
+
+    # eigenvalues in descending order are the squared singular values
+    eigvals, eigvecs = linalg.eigh(gram)
+    eigvals = np.maximum(eigvals[::-1][:n_components], 0)
+    v = eigvecs[:, ::-1][:, :n_components]
+    s = eigvals / (n_samples - 1)
+
+    # weights of the components in the centered data, with signs flipped so
+    # that the largest absolute weight of each component is positive
+    max_abs, max_sign = np.zeros(n_components), np.ones(n_components)
+    mean_v = np.dot(mean, v)
+    for chunk in chunks:
+        u[chunk] = np.dot(get_chunk(chunk), v) - mean_v
+        idx = np.abs(u[chunk]).argmax(axis=0)
+        chunk_max = u[chunk][idx, np.arange(n_components)]
+        larger = np.abs(chunk_max) > max_abs
+        max_abs[larger] = np.abs(chunk_max[larger])
+        max_sign[larger] = np.sign(chunk_max[larger])
+    v = v * max_sign
+    for chunk in chunks:
+        u[chunk] *= max_sign / s
+    return u, s, v
+
+
+def _get_stream_chunk_size(n_vols, mem_limit):
+    """
+    Get the number of voxels per block that keeps streaming PCA within a
+    memory budget.
+
+    Parameters
+    ----------
+    n_vols : :obj:`int`
+        Number of volumes in the data.
+    mem_limit : :obj:`float` or None
+        Memory budget in megabytes. If None, blocks of
+        :obj:`tedana.metrics.kundu_fit.LOW_MEM_CHUNK_SIZE` voxels are used.
+
+    Returns
+    -------
+    chunk_size : :obj:`int`
+        Number of voxels per block.
+    """
+    if mem_limit is None:
+        return metrics.kundu_fit.LOW_MEM_CHUNK_SIZE
+    elif mem_limit <= 0:
+        raise ValueError('mem_limit must be positive, not {0}'.format(mem_limit))
+    # the Gram matrix and the eigenvectors are held throughout, and each
+    # block is copied a few times while it is normalized and projected
+    fixed_bytes = 3 * n_vols * n_vols * 8
+    block_bytes = STREAM_BLOCK_COPIES * n_vols * 8
+    return max(1, int((mem_limit * 2**20 - fixed_bytes) // block_bytes))
+
+
+def stream_pca(data, mask, n_components=None, mem_limit=None, out_dir=None):
+    """
+    Run PCA on variance-normalized data streamed in blocks of voxels.
+
+    The data are read a block of masked voxels at a time, so `data` may be a
+    :obj:`numpy.memmap` that never has to be loaded in full. Each block is
+    variance normalized like the in-memory PCA in :func:`tedpca`, with
+    statistics precomputed in a first pass, and the component weight maps
+    are written to a memory-mapped array.
+
+    Parameters
+    ----------
+    data : (S x T) array_like
+        Optimally combined data.
+    mask : (S,) array_like
+        Boolean mask array.
+    n_components : :obj:`int` or None, optional
+        Number of components to retain. Default is None, which retains T - 1
+        components.
+    mem_limit : :obj:`float` or None, optional
+        Approximate memory budget, in megabytes, for the blocks of data held
+        in memory at a time. Default is None, which uses blocks of
+        :obj:`tedana.metrics.kundu_fit.LOW_MEM_CHUNK_SIZE` voxels.
+    out_dir : :obj:`str` or None, optional
+        Directory in which to create the memory-mapped weight maps. Default is
+        None, which uses the system's temporary directory.
+
+    Returns
+    -------
+    u : (M x C) :obj:`numpy.memmap`
+        Component weight map for each component in the mask.
+    s : (C,) array_like
+        Variance explained for each component.
+    v : (T x C) array_like
+        Component timeseries.
+
+    Notes
+    -----
+    The results match those of :func:`gram_pca` on the masked data, after
+    each voxel's time series and then the whole data set are z-scored.
+    """
+    mask_idx = np.where(mask)[0]
+    n_samples, n_vols = mask_idx.size, data.shape[1]
+    if n_components is None:
+        n_components = n_vols - 1
+    if not 0 < n_components <= min(n_samples, n_vols):
+        raise ValueError('n_components ({0}) must be between 1 and {1}'.format(
+            n_components, min(n_samples, n_vols)))
+    chunk_size = _get_stream_chunk_size(n_vols, mem_limit)
+    chunks = [slice(start, start + chunk_size)
+              for start in range(0, n_samples, chunk_size)]
+    LGR.info('Computing PCA in {0} blocks of up to {1} voxels'.format(
+        len(chunks), chunk_size))
+
+    # first pass: statistics for variance normalizing each time series, and
+    # then everything
+    ts_mean = np.zeros(n_samples)
+    ts_std = np.zeros(n_samples)
+    z_sum, z_ss = 0., 0.
+    col_sum = np.zeros(n_vols)
+    for chunk in chunks:
+        block = data[mask_idx[chunk]]
+        ts_mean[chunk] = block.mean(axis=1)
+        ts_std[chunk] = block.std(axis=1)
+        block_z = (block - ts_mean[chunk, None]) / ts_std[chunk, None]
+        z_sum += block_z.sum()
+        z_ss += (block_z ** 2).sum()
+        col_sum += block_z.sum(axis=0)
+    n_elem = n_samples * n_vols
+    z_mean = z_sum / n_elem
+    z_std = np.sqrt(z_ss / n_elem - z_mean ** 2)
+    mean = (col_sum / n_samples - z_mean) / z_std
+
+    def get_chunk(chunk):
+        block = data[mask_idx[chunk]]
+        block_z = (block - ts_mean[chunk, None]) / ts_std[chunk, None]
+        return (block_z - z_mean) / z_std
+
+    u = utils.spill_array((n_samples, n_components), out_dir=out_dir)
+    return _gram_pca_chunks(get_chunk, chunks, mean, u)
+
+
+def _stream_component_maps(data, mask, comp_ts_z, mem_limit=None, out_dir=None):
+    """
+    Compute normalized component weight maps of data in blocks of voxels.
+
+    Parameters
+    ----------
+    data : (S x T) array_like
+        Optimally combined data.
+    mask : (S,) array_like
+        Boolean mask array.
+    comp_ts_z : (T x C) array_like
+        Z-scored component time series.
+    mem_limit : :obj:`float` or None, optional
+        Approximate memory budget in megabytes. Default is None.
+    out_dir : :obj:`str` or None, optional
+        Directory in which to create the memory-mapped maps. Default is None.
+
+    Returns
+    -------
+    comp_maps : (M x C) :obj:`numpy.memmap`
+        Same as ``computefeats2(data, comp_ts_z, mask)``.
+    """
+    mask_idx = np.where(mask)[0]
+    chunk_size = _get_stream_chunk_size(data.shape[1], mem_limit)
+    chunks = [slice(start, start + chunk_size)
+              for start in range(0, mask_idx.size, chunk_size)]
+    comp_maps = utils.spill_array((mask_idx.size, comp_ts_z.shape[1]),
+                                  out_dir=out_dir)
+    maps_sum = np.zeros(comp_ts_z.shape[1])
+    maps_ss = np.zeros(comp_ts_z.shape[1])
+    for chunk in chunks:
+        comp_maps[chunk] = computefeats2(data[mask_idx[chunk]], comp_ts_z,
+                                         normalize=False)
+        maps_sum += comp_maps[chunk].sum(axis=0)
+        maps_ss += (comp_maps[chunk] ** 2).sum(axis=0)
+    # z-scoring the maps and adding back mean / std, as computefeats2 does,
+    # is the same as dividing by the standard deviation
+    maps_mean = maps_sum / mask_idx.size
+    maps_std = np.sqrt(maps_ss / mask_idx.size - maps_mean ** 2)
+    for chunk in chunks:
+        comp_maps[chunk] /= maps_std
+    return comp_maps
+
+
+def _stream_kept_data(voxel_comp_weights, varex, comp_ts, acc, mem_limit=None,
+                      out_dir=None):
+    """
+    Reconstruct and variance normalize the data from accepted components in
+    blocks of voxels.
+
+    Parameters
+    ----------
+    voxel_comp_weights : (M x C) array_like
+        Component weight map for each component.
+    varex : (C,) array_like
+        Variance explained for each component.
+    comp_ts : (T x C) array_like
+        Component timeseries.
+    acc : (A,) array_like
+        Indices of the accepted components.
+    mem_limit : :obj:`float` or None, optional
+        Approximate memory budget in megabytes. Default is None.
+    out_dir : :obj:`str` or None, optional
+        Directory in which to create the memory-mapped data. Default is None.
+
+    Returns
+    -------
+    kept_data : (M x T) :obj:`numpy.memmap`
+        Same as the in-memory reconstruction in :func:`tedpca`, with each
+        voxel's time series and then the whole data set z-scored.
+    """
+    n_voxels, n_vols = voxel_comp_weights.shape[0], comp_ts.shape[0]
+    chunk_size = _get_stream_chunk_size(n_vols, mem_limit)
+    chunks = [slice(start, start + chunk_size)
+              for start in range(0, n_voxels, chunk_size)]
+    kept_data = utils.spill_array((n_voxels, n_vols), out_dir=out_dir)
+    kept_sum, kept_ss = 0., 0.
+    for chunk in chunks:
+        block = np.dot(voxel_comp_weights[chunk][:, acc] * varex[None, acc],
+                       comp_ts[:, acc].T)
+        block = stats.zscore(block, axis=1)  # variance normalize time series
+        kept_data[chunk] = block
+        kept_sum += block.sum()
+        kept_ss += (block ** 2).sum()
+    # variance normalize everything, in place
+    kept_mean = kept_sum / kept_data.size
+    kept_std = np.sqrt(kept_ss / kept_data.size - kept_mean ** 2)
+    for chunk in chunks:
+        kept_data[chunk] -= kept_mean
+        kept_data[chunk] /= kept_std
+    return kept_data
+
+
 def tedpca(data_cat, data_oc, combmode, mask, adaptive_mask, t2sG,
            ref_img, tes, algorithm='mdl', kdaw=10., rdaw=1.,
-           out_dir='.', verbose=False, low_mem=False):
+           out_dir='.', verbose=False, low_mem=False, dependence_model=None,
+           pca_solver='sklearn', mem_limit=None, n_jobs=1):
     """
     Use principal components analysis (PCA) to identify and remove thermal
     noise from multi-echo data.
@@ -89,8 +409,32 @@ def tedpca(data_cat, data_oc, combmode, mask, adaptive_mask, t2sG,
     verbose : :obj:`bool`, optional
         Whether to output files from fitmodels_direct or not. Default: False
     low_mem : :obj:`bool`, optional
-        Whether to use incremental PCA (for low-memory systems) or not.
-        Default: False
+        Whether to use incremental PCA and compute component metrics in chunks
+        of voxels (for low-memory systems) or not. Unless `pca_solver` is
+        'stream', the masked `data_oc` is still loaded into memory for the
+        PCA. Default: False
+    dependence_model : :obj:`tedana.metrics.DependenceModel` or None, optional
+        Model used to compute Kappa and Rho for the PCA components. If None
+        (default), it is built from `data_cat`, `data_oc`, and `adaptive_mask`.
+    pca_solver : {'sklearn', 'gram', 'stream'}, optional
+        How to decompose the data for the Kundu selection algorithms. 'sklearn'
+        (default) uses :obj:`sklearn.decomposition.PCA`, or IncrementalPCA if
+        `low_mem` is True. 'gram' uses :func:`gram_pca`, which gives the same
+        components faster when there are far more voxels than volumes, and
+        works in chunks of voxels if `low_mem` is True. 'stream' uses
+        :func:`stream_pca`, which reads `data_oc` in blocks of voxels, so that
+        `data_oc` can be a :obj:`numpy.memmap` that is never loaded in full.
+        Not used by the mdl, aic, and kic algorithms.
+    mem_limit : :obj:`float` or None, optional
+        Approximate memory budget, in megabytes, for the blocks of voxels held
+        in memory by the 'stream' PCA solver, which covers the PCA fit, the
+        component maps and the reconstruction of the kept data. Default is
+        None, which uses blocks of
+        :obj:`tedana.metrics.kundu_fit.LOW_MEM_CHUNK_SIZE` voxels.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes used by the mdl, aic, and kic algorithms
+        to estimate the number of independent samples. -1 uses all available
+        CPUs. Default is 1.
 
     Returns
     -------
@@ -178,19 +522,34 @@ def tedpca(data_cat, data_oc, combmode, mask, adaptive_mask, t2sG,
                 "the optimally combined data for dimensionality "
                 "reduction.".format(alg_str))
 
+    if pca_solver not in ('sklearn', 'gram', 'stream'):
+        raise ValueError('PCA solver "{0}" not recognized. Must be one of '
+                         "'sklearn', 'gram', or 'stream'".format(pca_solver))
+    streaming = (algorithm not in ['mdl', 'aic', 'kic'] and
+                 pca_solver == 'stream')
+
     n_samp, n_echos, n_vols = data_cat.shape
 
     LGR.info('Computing PCA of optimally combined multi-echo data')
-    data = data_oc[mask, :]
+    if not streaming:
+        data = data_oc[mask, :]
 
-    data_z = ((data.T - data.T.mean(axis=0)) / data.T.std(axis=0)).T  # var normalize ts
-    data_z = (data_z - data_z.mean()) / data_z.std()  # var normalize everything
+        data_z = ((data.T - data.T.mean(axis=0)) / data.T.std(axis=0)).T  # var normalize ts
+        data_z = (data_z - data_z.mean()) / data_z.std()  # var normalize everything
 
     if algorithm in ['mdl', 'aic', 'kic']:
-        data_img = io.new_nii_like(ref_img, utils.unmask(data, mask))
-        mask_img = io.new_nii_like(ref_img, mask.astype(int))
-        voxel_comp_weights, varex, varex_norm, comp_ts = ma_pca.ma_pca(
-            data_img, mask_img, algorithm)
+        mask_vol = mask.reshape(check_niimg(ref_img).shape[:3])
+        # the rows of the weights follow the rows of data, in mask order
+        voxel_comp_weights, varex, varex_norm, comp_ts = ma_pca.ma_pca_masked(
+            data, mask_vol, criteria=algorithm, n_jobs=n_jobs)
+    elif streaming:
+        voxel_comp_weights, varex, comp_ts = stream_pca(
+            data_oc, mask, mem_limit=mem_limit, out_dir=out_dir)
+        varex_norm = varex / varex.sum()
+    elif pca_solver == 'gram':
+        voxel_comp_weights, varex, comp_ts = gram_pca(
+            data_z, chunk_size=(metrics.kundu_fit.LOW_MEM_CHUNK_SIZE if low_mem else None))
+        varex_norm = varex / varex.sum()
     elif low_mem:
         voxel_comp_weights, varex, comp_ts = low_mem_pca(data_z)
         varex_norm = varex / varex.sum()
@@ -206,10 +565,14 @@ def tedpca(data_cat, data_oc, combmode, mask, adaptive_mask, t2sG,
     # Compute Kappa and Rho for PCA comps
     # Normalize each component's time series
     vTmixN = stats.zscore(comp_ts, axis=0)
-    comptable, _, _, _ = metrics.dependence_metrics(
-                data_cat, data_oc, comp_ts, adaptive_mask, tes, ref_img,
-                reindex=False, mmixN=vTmixN, algorithm=None,
-                label='mepca_', out_dir=out_dir, verbose=verbose)
+    if dependence_model is None:
+        dependence_model = metrics.DependenceModel(
+            data_cat, data_oc, adaptive_mask, tes, ref_img,
+            chunk_size=(metrics.kundu_fit.LOW_MEM_CHUNK_SIZE if low_mem else None),
+            out_dir=out_dir)
+    comptable, _, _, _ = dependence_model.score(
+                comp_ts, reindex=False, mmixN=vTmixN, algorithm=None,
+                label='mepca_', verbose=verbose)
 
     # varex_norm from PCA overrides varex_norm from dependence_metrics,
     # but we retain the original
@@ -219,7 +582,12 @@ def tedpca(data_cat, data_oc, combmode, mask, adaptive_mask, t2sG,
 
     # write component maps to 4D image
     comp_ts_z = stats.zscore(comp_ts, axis=0)
-    comp_maps = utils.unmask(computefeats2(data_oc, comp_ts_z, mask), mask)
+    if streaming:
+        comp_maps = _stream_component_maps(data_oc, mask, comp_ts_z,
+                                           mem_limit=mem_limit, out_dir=out_dir)
+    else:
+        comp_maps = computefeats2(data_oc, comp_ts_z, mask)
+    comp_maps = utils.unmask(comp_maps, mask)
     io.filewrite(comp_maps, op.join(out_dir, 'pca_components.nii.gz'), ref_img)
 
     # Select components using decision tree
@@ -242,16 +610,25 @@ def tedpca(data_cat, data_oc, combmode, mask, adaptive_mask, t2sG,
 
     comptable['Description'] = 'PCA fit to optimally combined data.'
     mmix_dict = {}
-    mmix_dict['Method'] = ('Principal components analysis implemented by '
-                           'sklearn. Components are sorted by variance '
-                           'explained in descending order. '
-                           'Component signs are flipped to best match the '
-                           'data.')
+    if algorithm not in ['mdl', 'aic', 'kic'] and pca_solver != 'sklearn':
+        implementation = ('computed from the eigendecomposition of the '
+                          'data\'s Gram matrix')
+    else:
+        implementation = 'implemented by sklearn'
+    mmix_dict['Method'] = ('Principal components analysis {0}. Components '
+                           'are sorted by variance explained in descending '
+                           'order. Component signs are flipped to best match '
+                           'the data.'.format(implementation))
     io.save_comptable(comptable, op.join(out_dir, 'pca_decomposition.json'),
                       label='pca', metadata=mmix_dict)
 
     acc = comptable[comptable.classification == 'accepted'].index.values
     n_components = acc.size
+    if streaming:
+        kept_data = _stream_kept_data(voxel_comp_weights, varex, comp_ts, acc,
+                                      mem_limit=mem_limit, out_dir=out_dir)
+        return kept_data, n_components
+
     voxel_kept_comp_weighted = (voxel_comp_weights[:, acc] * varex[None, acc])
     kept_data = np.dot(voxel_kept_comp_weighted, comp_ts[:, acc].T)
 
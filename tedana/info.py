@@ -35,7 +35,8 @@ REQUIRES = [
     'scipy',
     'pandas',
     'matplotlib',
-    'threadpoolctl'
+    'threadpoolctl',
+    'joblib'
 ]
 
 TESTS_REQUIRES = [
@@ -2,9 +2,9 @@
 # ex: set sts=4 ts=4 sw=4 et:
 
 from .kundu_fit import (
-    dependence_metrics, kundu_metrics
+    DependenceModel, dependence_metrics, kundu_metrics
 )
 
 __all__ = [
-    'dependence_metrics', 'kundu_metrics'
+    'DependenceModel', 'dependence_metrics', 'kundu_metrics'
 ]
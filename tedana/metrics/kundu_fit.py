@@ -6,10 +6,11 @@ import os.path as op
 
 import numpy as np
 import pandas as pd
+from nilearn._utils import check_niimg
 from scipy import stats
 
 from tedana import io, utils
-from tedana.stats import getfbounds, computefeats2, get_coeffs
+from tedana.stats import getfbounds, computefeats2, get_coeffs, get_coeffs_chunked
 
 
 LGR = logging.getLogger(__name__)
@@ -18,11 +19,672 @@ RefLGR = logging.getLogger('REFERENCES')
 
 F_MAX = 500
 Z_MAX = 8
+# number of voxels processed at a time by dependence_metrics in low-memory mode
+LOW_MEM_CHUNK_SIZE = 20000
+
+# voxel-wise maps that dependence_metrics can generate, and the maps that
+# each one is derived from
+METRIC_MAP_INPUTS = {
+    'WTS': [],
+    'tsoc_B': [],
+    'PSC': ['tsoc_B'],
+    'Z_maps': [],
+    'F_R2_maps': [],
+    'F_S0_maps': [],
+    'Z_clmaps': ['Z_maps'],
+    'F_R2_clmaps': ['F_R2_maps'],
+    'F_S0_clmaps': ['F_S0_maps'],
+    'Br_R2_clmaps': ['tsoc_B', 'F_R2_clmaps'],
+    'Br_S0_clmaps': ['tsoc_B', 'F_S0_clmaps'],
+}
+# maps used by each decision tree
+SELECTION_MAPS = {
+    # WTS, tsoc_B, PSC, and F_S0_maps are not used by Kundu v2.5
+    'kundu_v2': ['Z_maps', 'F_R2_maps',
+                 'Z_clmaps', 'F_R2_clmaps', 'F_S0_clmaps',
+                 'Br_R2_clmaps', 'Br_S0_clmaps'],
+    'kundu_v3': ['WTS', 'tsoc_B', 'PSC',
+                 'Z_maps', 'F_R2_maps', 'F_S0_maps',
+                 'Z_clmaps', 'F_R2_clmaps', 'F_S0_clmaps',
+                 'Br_R2_clmaps', 'Br_S0_clmaps'],
+    None: [],
+}
+
+
+def _fit_te_models(betas, X1, X2):
+    """
+    Fit TE-independence (S0) and TE-dependence (R2) models to echo-wise
+    component betas.
+
+    Parameters
+    ----------
+    betas : (S x E x C) array_like
+        Echo-wise parameter estimates for each component
+    X1 : (S x E) array_like
+        Design of the TE-independence model, i.e. the mean signal of each echo
+    X2 : (S x E) array_like
+        Design of the TE-dependence model, i.e. the mean signal of each echo
+        scaled by its echo time
+
+    Returns
+    -------
+    F_S0, F_R2 : (S x C) :obj:`numpy.ndarray`
+        F-statistics of the S0 and R2 models
+    pred_S0, pred_R2 : (S x E x C) :obj:`numpy.ndarray`
+        Predicted betas from the S0 and R2 models
+    """
+    n_voxels, n_echos, n_components = betas.shape
+    alpha = np.zeros([n_voxels, n_components])
+    for i_echo in range(n_echos):
+        alpha += np.abs(betas[:, i_echo, :])**2
+
+    out = []
+    for X in (X1, X2):
+        # (S x C) model coefficient maps
+        coeffs = np.zeros([n_voxels, n_components])
+        for i_echo in range(n_echos):
+            coeffs += betas[:, i_echo, :] * X[:, i_echo, np.newaxis]
+        coeffs /= (X**2).sum(axis=1)[:, np.newaxis]
+
+        pred = X[:, :, np.newaxis] * coeffs[:, np.newaxis, :]
+        SSE = np.zeros([n_voxels, n_components])  # (S x C) prediction error maps
+        for i_echo in range(n_echos):
+            SSE += (betas[:, i_echo, :] - pred[:, i_echo, :])**2
+        F = (alpha - SSE) * (n_echos - 1) / SSE
+        out.append((F, pred))
+
+    (F_S0, pred_S0), (F_R2, pred_R2) = out
+    return F_S0, F_R2, pred_S0, pred_R2
+
+
+def _get_component_weights(tsoc, mmix, mmixN):
+    """
+    Compute the component weights (features) and parameter estimates of
+    optimally combined data.
+
+    Parameters
+    ----------
+    tsoc : (S x T) array_like
+        Optimally combined data
+    mmix : (T x C) array_like
+        Mixing matrix
+    mmixN : (T x C) array_like
+        Z-scored mixing matrix
+
+    Returns
+    -------
+    WTS : (S x C) :obj:`numpy.ndarray`
+        Un-normalized weights of `mmixN` in `tsoc`
+    tsoc_B : (S x C) :obj:`numpy.ndarray`
+        Parameter estimates of `mmix` in the demeaned `tsoc`
+    """
+    WTS = computefeats2(tsoc, mmixN, mask=None, normalize=False)
+    tsoc_dm = tsoc - tsoc.mean(axis=-1, keepdims=True)
+    tsoc_B = get_coeffs(tsoc_dm, mmix, mask=None, add_const=False)
+    return WTS, tsoc_B
+
+
+def _update_moments(moments, x):
+    """
+    Merge the column-wise moments of a chunk of samples into running moments.
+
+    Parameters
+    ----------
+    moments : :obj:`tuple` or None
+        Number of samples, mean, and sums of squared and cubed deviations from
+        the mean of each column of the previous chunks, as returned by this
+        function. None for the first chunk.
+    x : (S x C) array_like
+        Chunk of samples
+
+    Returns
+    -------
+    moments : :obj:`tuple`
+        Number of samples, mean, and sums of squared and cubed deviations from
+        the mean of each column of all chunks
+
+    Notes
+    -----
+    Uses the pairwise update of Chan, Golub, & LeVeque (1983), which is
+    numerically stable regardless of the number of chunks.
+    """
+    n_b = x.shape[0]
+    mean_b = x.mean(axis=0)
+    dev = x - mean_b
+    M2_b = (dev**2).sum(axis=0)
+    M3_b = (dev**3).sum(axis=0)
+    if moments is None:
+        return n_b, mean_b, M2_b, M3_b
+
+    n_a, mean_a, M2_a, M3_a = moments
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    M2 = M2_a + M2_b + delta**2 * n_a * n_b / n
+    M3 = (M3_a + M3_b + delta**3 * n_a * n_b * (n_a - n_b) / n**2 +
+          3 * delta * (n_a * M2_b - n_b * M2_a) / n)
+    return n, mean, M2, M3
+
+
+def _resolve_metric_maps(metric_maps):
+    """
+    Find all maps needed to generate the requested metric maps.
+
+    Parameters
+    ----------
+    metric_maps : :obj:`list` of :obj:`str`
+        Names of requested maps, from :obj:`METRIC_MAP_INPUTS`
+
+    Returns
+    -------
+    required : :obj:`set` of :obj:`str`
+        Names of the requested maps and all maps they are derived from
+    """
+    required = set()
+    pending = list(metric_maps)
+    while pending:
+        name = pending.pop()
+        if name not in METRIC_MAP_INPUTS:
+            raise ValueError('Metric map "{0}" not recognized. Must be one of '
+                             '{1}'.format(name, sorted(METRIC_MAP_INPUTS)))
+        if name not in required:
+            required.add(name)
+            pending.extend(METRIC_MAP_INPUTS[name])
+    return required
+
+
+def _unique_log_stats(values, sel):
+    """
+    Count, mean, and variance of the log10 of the unique selected values in
+    each column.
+
+    Parameters
+    ----------
+    values : (S x C) array_like
+        Values, where `S` is samples and `C` is columns
+    sel : (S x C) array_like
+        Boolean array indicating which values to use in each column
+
+    Returns
+    -------
+    n, mean, var : (C,) :obj:`numpy.ndarray`
+        Number of unique selected values in each column, and the mean and
+        unbiased variance of their log10. Mean and variance are NaN for columns
+        with too few values.
+    """
+    n_cols = values.shape[1]
+    # selected values, grouped by column and sorted within each column
+    sel = np.asarray(sel, dtype=bool).T
+    vals = np.asarray(values).T[sel]
+    counts = sel.sum(axis=1)
+    bounds = np.cumsum(counts)
+    for start, stop in zip(bounds - counts, bounds):
+        vals[start:stop].sort()
+    cols = np.repeat(np.arange(n_cols), counts)
+    is_unique = np.ones(vals.size, dtype=bool)
+    is_unique[1:] = (cols[1:] != cols[:-1]) | (vals[1:] != vals[:-1])
+    cols, vals = cols[is_unique], vals[is_unique]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log10(vals)
+        n = np.bincount(cols, minlength=n_cols)
+        mean = np.bincount(cols, weights=logs, minlength=n_cols) / n
+        var = np.bincount(cols, weights=(logs - mean[cols]) ** 2,
+                          minlength=n_cols) / (n - 1)
+    return n, mean, var
+
+
+class DependenceModel(object):
+    """
+    TE-dependence and -independence models of multi-echo data, for scoring
+    components.
+
+    The masked data and the voxel-wise design of the models do not depend on
+    the components, so they are computed once and reused by every call to
+    :meth:`score`.
+
+    Parameters
+    ----------
+    catd : (S x E x T) array_like
+        Input data, where `S` is samples, `E` is echos, and `T` is time
+    tsoc : (S x T) array_like
+        Optimally combined data
+    adaptive_mask : (S) array_like
+        Adaptive mask, where each voxel's value is the number of echoes with
+        "good signal".
+    tes : list
+        List of echo times associated with `catd`, in milliseconds
+    ref_img : str or img_like
+        Reference image to dictate how outputs are saved to disk
+    echo_groups : :obj:`tedana.utils.EchoGroups` or None, optional
+        Index of samples by number of good echoes, built from `adaptive_mask`
+        if not provided. Default is None.
+    chunk_size : :obj:`int` or None, optional
+        Number of masked voxels to process at a time. If None (default), all
+        voxels are processed at once, and the masked data are copied for the
+        length of each call to :meth:`score`.
+        Otherwise, the metrics are computed in two passes over chunks of
+        voxels read from `catd` and `tsoc`, which may be memory-mapped, and
+        the voxel-wise maps are written to temporary files in `out_dir` rather
+        than held in memory.
+    out_dir : :obj:`str`, optional
+        Output directory for generated files. Default is current working
+        directory.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to use for spatial clustering of the
+        component maps. Results do not depend on the number of workers. -1
+        uses all CPUs. Default is 1.
+
+    Attributes
+    ----------
+    mask : (S,) :obj:`numpy.ndarray`
+        Boolean array of voxels with at least three good echoes, in which
+        components are scored
+    """
+    def __init__(self, catd, tsoc, adaptive_mask, tes, ref_img,
+                 echo_groups=None, chunk_size=None, out_dir='.', n_jobs=1):
+        if not (catd.shape[0] == adaptive_mask.shape[0] == tsoc.shape[0]):
+            raise ValueError('First dimensions (number of samples) of catd ({0}), '
+                             'tsoc ({1}), and adaptive_mask ({2}) do not '
+                             'match'.format(catd.shape[0], tsoc.shape[0],
+                                            adaptive_mask.shape[0]))
+        elif catd.shape[1] != len(tes):
+            raise ValueError('Second dimension of catd ({0}) does not match '
+                             'number of echoes provided (tes; '
+                             '{1})'.format(catd.shape[1], len(tes)))
+        elif catd.shape[2] != tsoc.shape[1]:
+            raise ValueError('Number of volumes in catd ({0}) and '
+                             'tsoc ({1}) do not match.'.format(catd.shape[2],
+                                                               tsoc.shape[1]))
+
+        if echo_groups is None:
+            echo_groups = utils.EchoGroups(adaptive_mask)
+        elif echo_groups.n_samples != adaptive_mask.shape[0]:
+            raise ValueError('Number of samples in echo_groups ({0}) and '
+                             'adaptive_mask ({1}) do not match'.format(
+                                 echo_groups.n_samples, adaptive_mask.shape[0]))
+
+        # Use adaptive_mask as mask
+        self.mask = adaptive_mask >= 3
+        self._mask_idx = np.where(self.mask)[0]
+        # indices of masked samples grouped by number of good echoes
+        self._masked_groups = echo_groups.subset(self._mask_idx)
+        self._ref_img = ref_img
+        self._mask_vol = None
+        self._out_dir = out_dir
+        self._n_jobs = n_jobs
+
+        n_voxels, n_echos = self._mask_idx.shape[0], catd.shape[1]
+        if chunk_size is None:
+            chunk_size = max(n_voxels, 1)
+        elif chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer, '
+                             'not {0}'.format(chunk_size))
+        self._chunks = [slice(start, min(start + chunk_size, n_voxels))
+                        for start in range(0, n_voxels, chunk_size)]
+        self._streaming = len(self._chunks) > 1
+        if self._streaming:
+            LGR.info('Computing component metrics in {0} chunks of up to {1} '
+                     'voxels'.format(len(self._chunks), chunk_size))
+        # the data are only referenced here, and masked copies are made while
+        # scoring, so that they are not held between calls
+        self._data = {'catd': catd, 'tsoc': tsoc}
+        self._masked = {}
+
+        # means over TEs for TE-dependence analysis, and of the optimal
+        # combination for PSC
+        self._mu = np.empty((n_voxels, n_echos))
+        self._tsoc_mean = np.empty((n_voxels, 1))
+        for chunk in self._chunks:
+            self._mu[chunk] = self._get_chunk('catd', chunk).mean(
+                axis=-1, dtype=float)
+            self._tsoc_mean[chunk] = self._get_chunk('tsoc', chunk).mean(
+                axis=-1, keepdims=True)
+        self._masked.clear()
+
+        # set up design matrices
+        self._tes = np.reshape(tes, (n_echos, 1))
+        self._X1 = self._mu  # Model 1: TE-independence model
+        self._X2 = self._tes.T * self._mu  # Model 2: TE-dependence model
+        self._fmin, _, _ = getfbounds(n_echos)
+
+    def _get_chunk(self, name, chunk):
+        """Get a chunk of masked voxels of 'catd' or 'tsoc'."""
+        arr = self._data[name]
+        if self._streaming:
+            return arr[self._mask_idx[chunk]]
+        # mask everything we can, once per call
+        if name not in self._masked:
+            self._masked[name] = arr[self.mask, ...]
+        return self._masked[name][chunk]
+
+    def _new_map(self, shape, dtype=float):
+        """Allocate a map, which is spilled to disk when streaming."""
+        if self._streaming:
+            return utils.spill_array(shape, dtype, out_dir=self._out_dir)
+        return np.zeros(shape, dtype)
+
+    def _get_mask_vol(self):
+        """Get the mask as a 3D volume, for spatial clustering."""
+        if self._mask_vol is None:
+            self._mask_vol = self.mask.reshape(
+                check_niimg(self._ref_img).shape[:3])
+        return self._mask_vol
+
+    def _reorder_components(self, arr, sort_idx):
+        """Reorder the last (component) axis of a map, a chunk at a time."""
+        if not isinstance(arr, np.memmap):
+            return arr[..., sort_idx]
+        out = self._new_map(arr.shape, arr.dtype)
+        for chunk in self._chunks:
+            out[chunk] = arr[chunk][..., sort_idx]
+        return out
+
+    def score(self, mmix, mmixN=None, reindex=False, algorithm=None,
+              metric_maps=None, label=None, verbose=False):
+        """
+        Fit TE-dependence and -independence models to components.
+
+        Parameters
+        ----------
+        mmix : (T x C) array_like
+            Mixing matrix for converting input data to component space, where
+            `C` is components and `T` is the same as in `catd`
+        mmixN : (T x C) array_like, optional
+            Z-scored mixing matrix. Default: None
+        reindex : bool, optional
+            Whether to sort components in descending order by Kappa.
+            Default: False
+        algorithm : {'kundu_v2', 'kundu_v3', None}, optional
+            Decision tree to be applied to metrics. Determines which maps will
+            be generated and stored in seldict. Default: None
+        metric_maps : :obj:`list` of :obj:`str` or None, optional
+            Names of the maps to generate and store in seldict, from
+            :obj:`METRIC_MAP_INPUTS`. Only these maps, and the maps they are
+            derived from, are computed. If None (default), the maps used by
+            `algorithm` (:obj:`SELECTION_MAPS`) are generated.
+        label : :obj:`str` or None, optional
+            Prefix to apply to generated files. Default is None.
+        verbose : :obj:`bool`, optional
+            Whether or not to generate additional files. Default is False.
+
+        Returns
+        -------
+        comptable : (C x X) :obj:`pandas.DataFrame`
+            Component metric table. One row for each component, with a column
+            for each metric. The index is the component number.
+        seldict : :obj:`dict` or None
+            Dictionary containing component-specific metric maps to be used
+            for component selection. Cluster maps (``*_clmaps``) are
+            :obj:`tedana.utils.PackedMaps`. If no maps are requested (e.g., if
+            `algorithm` is None), then seldict will be None as well.
+        betas : (S x E x C) :obj:`numpy.ndarray`
+            Echo-wise parameter estimates of masked voxels. Memory-mapped if
+            the model was built with a `chunk_size` smaller than the number of
+            masked voxels.
+        mmix_corrected : :obj:`numpy.ndarray`
+            Mixing matrix after sign correction and resorting (if reindex is
+            True).
+        """
+        if mmix.shape[0] != self._data['tsoc'].shape[1]:
+            raise ValueError('Number of volumes in data ({0}) and mmix ({1}) '
+                             'do not match.'.format(self._data['tsoc'].shape[1],
+                                                    mmix.shape[0]))
+        try:
+            return self._score(mmix, mmixN=mmixN, reindex=reindex,
+                               algorithm=algorithm, metric_maps=metric_maps,
+                               label=label, verbose=verbose)
+        finally:
+            # drop the masked copies of the data until the next call
+            self._masked.clear()
+
+    def _score(self, mmix, mmixN=None, reindex=False, algorithm=None,
+               metric_maps=None, label=None, verbose=False):
+        """Score components, as described in :meth:`score`."""
+
+        # only compute the maps that were requested, and the maps they depend on
+        if metric_maps is None:
+            if algorithm not in SELECTION_MAPS:
+                raise ValueError('Algorithm "{0}" not recognized.'.format(algorithm))
+            metric_maps = SELECTION_MAPS[algorithm]
+        required = _resolve_metric_maps(metric_maps)
+        if verbose:
+            required |= _resolve_metric_maps(['Z_maps'])
+
+        RepLGR.info("A series of TE-dependence metrics were calculated for "
+                    "each component, including Kappa, Rho, and variance "
+                    "explained.")
+
+        n_voxels, n_echos = self._mu.shape
+        n_components = mmix.shape[1]
+
+        # voxel-wise maps, which are spilled to disk when streaming, and
+        # cluster maps, which are packed into bits
+        maps = {name: (utils.PackedMaps.zeros((n_voxels, n_components))
+                       if name.endswith('_clmaps') else
+                       self._new_map((n_voxels, n_components)))
+                for name in required}
+        if mmixN is None:
+            mmixN = mmix
+
+        # first pass: component weights (features) of the optimal combination,
+        # their moments across voxels, and the total variance. The weights are
+        # kept for the second pass unless they are cheaper to recompute than
+        # to spill to disk.
+        if 'WTS' in maps:
+            WTS = maps['WTS']
+        elif not self._streaming or 'Z_maps' in maps:
+            WTS = self._new_map((n_voxels, n_components))
+        else:
+            WTS = None
+        moments = None
+        tsoc_B_ss = np.zeros(n_components)
+        WTS_ss = np.zeros(n_components)
+        for chunk in self._chunks:
+            chunk_WTS, chunk_B = _get_component_weights(
+                self._get_chunk('tsoc', chunk), mmix, mmixN)
+            moments = _update_moments(moments, chunk_WTS)
+            tsoc_B_ss += (chunk_B**2).sum(axis=0)
+            WTS_ss += (chunk_WTS**2).sum(axis=0)
+            if WTS is not None:
+                WTS[chunk] = chunk_WTS
+            if 'tsoc_B' in maps:
+                maps['tsoc_B'][chunk] = chunk_B
+        _, WTS_mean, WTS_M2, WTS_M3 = moments
+
+        # compute skews to determine signs based on unnormalized weights,
+        # correct mmix & WTS signs based on spatial distribution tails
+        signs = WTS_M3 / np.abs(WTS_M3)
+        mmix_corrected = mmix * signs
+        WTS_mean = WTS_mean * signs
+        WTS_std = np.sqrt(WTS_M2 / n_voxels)
+        varex = tsoc_B_ss / tsoc_B_ss.sum() * 100.
+        varex_norm = WTS_ss / WTS_ss.sum()
+
+        # second pass: Betas for TE-dependence analysis
+        block_size = max(1, 10000000 // (n_echos * n_components))
+        betas = self._new_map((n_voxels, n_echos, n_components))
+        fit_groups = 'F_R2_maps' in maps or 'F_S0_maps' in maps or verbose
+        if verbose:
+            pred_R2_maps = self._new_map((n_voxels, n_echos, n_components))
+            pred_S0_maps = self._new_map((n_voxels, n_echos, n_components))
+
+        LGR.info('Fitting TE- and S0-dependent models to components')
+        max_echo = self._masked_groups.echo_counts[-1] if n_voxels else None
+        kappa_sum = np.zeros(n_components)
+        rho_sum = np.zeros(n_components)
+        weight_sum = np.zeros(n_components)
+        for chunk in self._chunks:
+            n_chunk = chunk.stop - chunk.start
+            if WTS is None:
+                chunk_WTS = computefeats2(self._get_chunk('tsoc', chunk), mmixN,
+                                          mask=None, normalize=False)
+            else:
+                chunk_WTS = WTS[chunk]
+            chunk_WTS = chunk_WTS * signs
+            if 'WTS' in maps:
+                maps['WTS'][chunk] = chunk_WTS
+            if 'PSC' in maps:
+                # compute PSC dataset - shouldn't have to refit data
+                maps['PSC'][chunk] = (maps['tsoc_B'][chunk] /
+                                      self._tsoc_mean[chunk] * 100 * signs)
+
+            # compute weights as Z-values
+            chunk_Z = np.clip((chunk_WTS - WTS_mean) / WTS_std, -Z_MAX, Z_MAX)
+            norm_weights = chunk_Z**2.
+            if 'Z_maps' in maps:
+                maps['Z_maps'][chunk] = chunk_Z
+            del chunk_WTS, chunk_Z
+
+            chunk_betas = get_coeffs_chunked(self._get_chunk('catd', chunk),
+                                             mmix_corrected, add_const=True,
+                                             chunk_size=block_size)
+            betas[chunk] = chunk_betas
+            X1, X2 = self._X1[chunk], self._X2[chunk]
+
+            # Kappa and Rho are averaged over F-statistics computed with the
+            # largest number of echoes for every voxel, so that model is fit
+            # everywhere and reused for the voxels that have all of those echoes
+            chunk_groups = self._masked_groups.window(chunk.start, chunk.stop)
+            max_idx = chunk_groups[max_echo]
+            F_S0_all = np.empty([n_chunk, n_components])
+            F_R2_all = np.empty([n_chunk, n_components])
+            for start in range(0, n_chunk, block_size):
+                block = slice(start, start + block_size)
+                F_S0, F_R2, pred_S0, pred_R2 = _fit_te_models(
+                    chunk_betas[block, :max_echo, :], X1[block, :max_echo],
+                    X2[block, :max_echo])
+                F_S0_all[block] = F_S0
+                F_R2_all[block] = F_R2
+                if verbose:
+                    block_idx = np.arange(start, start + F_S0.shape[0])
+                    keep = np.isin(block_idx, max_idx)
+                    pred_S0_maps[chunk.start + block_idx[keep], :max_echo, :] = pred_S0[keep]
+                    pred_R2_maps[chunk.start + block_idx[keep], :max_echo, :] = pred_R2[keep]
+
+            # fit the voxels with fewer echoes only if their maps are needed
+            chunk_F_maps = [(maps[name], F_all)
+                            for name, F_all in [('F_S0_maps', F_S0_all),
+                                                ('F_R2_maps', F_R2_all)]
+                            if name in maps]
+            for F_map, F_all in chunk_F_maps:
+                F_map[chunk.start + max_idx] = F_all[max_idx]
+            for j_echo, group_idx in (chunk_groups if fit_groups else []):
+                if j_echo == max_echo:
+                    continue
+                for start in range(0, len(group_idx), block_size):
+                    block_idx = group_idx[start:start + block_size]
+                    F_S0, F_R2, pred_S0, pred_R2 = _fit_te_models(
+                        chunk_betas[block_idx, :j_echo, :],
+                        X1[block_idx, :j_echo], X2[block_idx, :j_echo])
+                    if 'F_S0_maps' in maps:
+                        maps['F_S0_maps'][chunk.start + block_idx] = F_S0
+                    if 'F_R2_maps' in maps:
+                        maps['F_R2_maps'][chunk.start + block_idx] = F_R2
+                    if verbose:
+                        pred_S0_maps[chunk.start + block_idx, :j_echo, :] = pred_S0
+                        pred_R2_maps[chunk.start + block_idx, :j_echo, :] = pred_R2
+
+            # accumulate Kappa and Rho as weighted sums over voxels
+            kappa_sum += (np.minimum(F_R2_all, F_MAX) * norm_weights).sum(axis=0)
+            rho_sum += (np.minimum(F_S0_all, F_MAX) * norm_weights).sum(axis=0)
+            weight_sum += norm_weights.sum(axis=0)
+            del chunk_betas, norm_weights, F_S0_all, F_R2_all
+
+        kappas = kappa_sum / weight_sum
+        rhos = rho_sum / weight_sum
+        del WTS
+
+        # tabulate component values
+        comptable = np.vstack([kappas, rhos, varex, varex_norm]).T
+        if reindex:
+            # re-index all components in descending Kappa order
+            sort_idx = comptable[:, 0].argsort()[::-1]
+            comptable = comptable[sort_idx, :]
+            mmix_corrected = mmix_corrected[:, sort_idx]
+            betas = self._reorder_components(betas, sort_idx)
+            for name in maps:
+                if not name.endswith('_clmaps'):
+                    maps[name] = self._reorder_components(maps[name], sort_idx)
+
+            if verbose:
+                pred_R2_maps = self._reorder_components(pred_R2_maps, sort_idx)
+                pred_S0_maps = self._reorder_components(pred_S0_maps, sort_idx)
+
+        if verbose:
+            # Echo-specific weight maps for each of the ICA components.
+            io.filewrite(utils.unmask(betas, self.mask),
+                         op.join(self._out_dir, '{0}betas_catd.nii'.format(label)),
+                         self._ref_img)
+
+            # Echo-specific maps of predicted values for R2 and S0 models for each
+            # component.
+            io.filewrite(utils.unmask(pred_R2_maps, self.mask),
+                         op.join(self._out_dir, '{0}R2_pred.nii'.format(label)), self._ref_img)
+            io.filewrite(utils.unmask(pred_S0_maps, self.mask),
+                         op.join(self._out_dir, '{0}S0_pred.nii'.format(label)), self._ref_img)
+            # Weight maps used to average metrics across voxels
+            io.filewrite(utils.unmask(maps['Z_maps'] ** 2., self.mask),
+                         op.join(self._out_dir, '{0}metric_weights.nii'.format(label)),
+                         self._ref_img)
+            del pred_R2_maps, pred_S0_maps
+
+        comptable = pd.DataFrame(comptable,
+                                 columns=['kappa', 'rho',
+                                          'variance explained',
+                                          'normalized variance explained'])
+        comptable.index.name = 'component'
+
+        # Generate clustering criteria for component selection
+        clmaps = [name for name in maps if name.endswith('_clmaps')]
+        if clmaps:
+            LGR.info('Performing spatial clustering of components')
+            csize = np.max([int(n_voxels * 0.0005) + 5, 20])
+            LGR.debug('Using minimum cluster size: {}'.format(csize))
+            mask_vol = self._get_mask_vol()
+
+            # Cluster-extent threshold and binarize F-maps
+            for model in ['R2', 'S0']:
+                name = 'F_{0}_clmaps'.format(model)
+                if name in maps:
+                    utils.threshold_maps(maps['F_{0}_maps'.format(model)], csize,
+                                         mask_vol, threshold=self._fmin, out=maps[name],
+                                         n_jobs=self._n_jobs)
+
+            # Cluster-extent threshold and binarize Z-maps with CDT of p < 0.05
+            if 'Z_clmaps' in maps:
+                utils.threshold_maps(maps['Z_maps'], csize, mask_vol,
+                                     threshold=1.95, out=maps['Z_clmaps'],
+                                     n_jobs=self._n_jobs)
+
+            # Cluster-extent threshold and binarize ranked signal-change map
+            if 'Br_R2_clmaps' in maps or 'Br_S0_clmaps' in maps:
+                tsoc_B = maps['tsoc_B']
+                tsoc_Brank = self._new_map((n_voxels, n_components))
+                for i_comp in range(n_components):
+                    tsoc_Brank[:, i_comp] = stats.rankdata(np.abs(tsoc_B[:, i_comp]))
+                for model in ['R2', 'S0']:
+                    name = 'Br_{0}_clmaps'.format(model)
+                    if name in maps:
+                        countsig = maps['F_{0}_clmaps'.format(model)].count()
+                        utils.threshold_maps(
+                            tsoc_Brank, csize, mask_vol,
+                            threshold=(max(tsoc_B.shape) - countsig),
+                            out=maps[name], n_jobs=self._n_jobs)
+                del tsoc_Brank
+
+        if metric_maps:
+            seldict = {name: maps[name] for name in metric_maps}
+        else:
+            seldict = None
+
+        return comptable, seldict, betas, mmix_corrected
 
 
 def dependence_metrics(catd, tsoc, mmix, adaptive_mask, tes, ref_img,
                        reindex=False, mmixN=None, algorithm=None, label=None,
-                       out_dir='.', verbose=False):
+                       out_dir='.', verbose=False, echo_groups=None,
+                       chunk_size=None, n_jobs=1, metric_maps=None):
     """
     Fit TE-dependence and -independence models to components.
 
@@ -56,6 +718,24 @@ def dependence_metrics(catd, tsoc, mmix, adaptive_mask, tes, ref_img,
         directory.
     verbose : :obj:`bool`, optional
         Whether or not to generate additional files. Default is False.
+    echo_groups : :obj:`tedana.utils.EchoGroups` or None, optional
+        Index of samples by number of good echoes, built from `adaptive_mask`
+        if not provided. Default is None.
+    chunk_size : :obj:`int` or None, optional
+        Number of masked voxels to process at a time. If None (default), all
+        voxels are processed at once. Otherwise, the metrics are computed in
+        two passes over chunks of voxels, so `catd` and `tsoc` may be
+        memory-mapped, and the voxel-wise maps are written to temporary files
+        in `out_dir` rather than held in memory.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to use for spatial clustering of the
+        component maps. Results do not depend on the number of workers. -1
+        uses all CPUs. Default is 1.
+    metric_maps : :obj:`list` of :obj:`str` or None, optional
+        Names of the maps to generate and store in seldict, from
+        :obj:`METRIC_MAP_INPUTS`. Only these maps, and the maps they are
+        derived from, are computed. If None (default), the maps used by
+        `algorithm` (:obj:`SELECTION_MAPS`) are generated.
 
     Returns
     -------
@@ -64,259 +744,27 @@ def dependence_metrics(catd, tsoc, mmix, adaptive_mask, tes, ref_img,
         each metric. The index is the component number.
     seldict : :obj:`dict` or None
         Dictionary containing component-specific metric maps to be used for
-        component selection. If `algorithm` is None, then seldict will be None as
-        well.
-    betas : :obj:`numpy.ndarray`
+        component selection. Cluster maps (``*_clmaps``) are
+        :obj:`tedana.utils.PackedMaps`. If no maps are requested (e.g., if
+        `algorithm` is None), then seldict will be None as well.
+    betas : (S x E x C) :obj:`numpy.ndarray`
+        Echo-wise parameter estimates of masked voxels. Memory-mapped if
+        `chunk_size` is smaller than the number of masked voxels.
     mmix_corrected : :obj:`numpy.ndarray`
         Mixing matrix after sign correction and resorting (if reindex is True).
     """
-    # Use adaptive_mask as mask
-    mask = adaptive_mask >= 3
-
-    if not (catd.shape[0] == adaptive_mask.shape[0] == tsoc.shape[0]):
-        raise ValueError('First dimensions (number of samples) of catd ({0}), '
-                         'tsoc ({1}), and adaptive_mask ({2}) do not '
-                         'match'.format(catd.shape[0], tsoc.shape[0],
-                                        adaptive_mask.shape[0]))
-    elif catd.shape[1] != len(tes):
-        raise ValueError('Second dimension of catd ({0}) does not match '
-                         'number of echoes provided (tes; '
-                         '{1})'.format(catd.shape[1], len(tes)))
-    elif not (catd.shape[2] == tsoc.shape[1] == mmix.shape[0]):
+    if not (catd.shape[2] == tsoc.shape[1] == mmix.shape[0]):
         raise ValueError('Number of volumes in catd ({0}), '
                          'tsoc ({1}), and mmix ({2}) do not '
                          'match.'.format(catd.shape[2], tsoc.shape[1],
                                          mmix.shape[0]))
 
-    RepLGR.info("A series of TE-dependence metrics were calculated for "
-                "each component, including Kappa, Rho, and variance "
-                "explained.")
-
-    # mask everything we can
-    tsoc = tsoc[mask, :]
-    catd = catd[mask, ...]
-
-    # demean optimal combination
-    tsoc_dm = tsoc - tsoc.mean(axis=-1, keepdims=True)
-
-    # compute un-normalized weight dataset (features)
-    if mmixN is None:
-        mmixN = mmix
-    WTS = computefeats2(tsoc, mmixN, mask=None, normalize=False)
-
-    # compute PSC dataset - shouldn't have to refit data
-    tsoc_B = get_coeffs(tsoc_dm, mmix, mask=None, add_const=False)
-    del tsoc_dm
-    tsoc_Babs = np.abs(tsoc_B)
-    PSC = tsoc_B / tsoc.mean(axis=-1, keepdims=True) * 100
-
-    # compute skews to determine signs based on unnormalized weights,
-    # correct mmix & WTS signs based on spatial distribution tails
-    signs = stats.skew(WTS, axis=0)
-    signs /= np.abs(signs)
-    mmix_corrected = mmix * signs
-    WTS *= signs
-    PSC *= signs
-    totvar = (tsoc_B**2).sum()
-    totvar_norm = (WTS**2).sum()
-
-    # compute Betas and means over TEs for TE-dependence analysis
-    betas = get_coeffs(utils.unmask(catd, mask),
-                       mmix_corrected,
-                       np.repeat(mask[:, np.newaxis], len(tes), axis=1),
-                       add_const=True)
-    betas = betas[mask, ...]
-    n_voxels, n_echos, n_components = betas.shape
-    mu = catd.mean(axis=-1, dtype=float)
-    tes = np.reshape(tes, (n_echos, 1))
-    fmin, _, _ = getfbounds(n_echos)
-
-    # set up design matrices
-    X1 = mu.T  # Model 1: TE-independence model
-    X2 = np.tile(tes, (1, n_voxels)) * mu.T  # Model 2: TE-dependence model
-
-    # tables for component selection
-    kappas = np.zeros([n_components])
-    rhos = np.zeros([n_components])
-    varex = np.zeros([n_components])
-    varex_norm = np.zeros([n_components])
-    Z_maps = np.zeros([n_voxels, n_components])
-    F_R2_maps = np.zeros([n_voxels, n_components])
-    F_S0_maps = np.zeros([n_voxels, n_components])
-    if verbose:
-        pred_R2_maps = np.zeros([n_voxels, n_echos, n_components])
-        pred_S0_maps = np.zeros([n_voxels, n_echos, n_components])
-
-    LGR.info('Fitting TE- and S0-dependent models to components')
-    for i_comp in range(n_components):
-        # size of comp_betas is (n_echoes, n_samples)
-        comp_betas = np.atleast_3d(betas)[:, :, i_comp].T
-        alpha = (np.abs(comp_betas)**2).sum(axis=0)
-        varex[i_comp] = (tsoc_B[:, i_comp]**2).sum() / totvar * 100.
-        varex_norm[i_comp] = (WTS[:, i_comp]**2).sum() / totvar_norm
-
-        for j_echo in np.unique(adaptive_mask[adaptive_mask >= 3]):
-            mask_idx = adaptive_mask == j_echo
-            alpha = (np.abs(comp_betas[:j_echo])**2).sum(axis=0)
-
-            # S0 Model
-            # (S,) model coefficient map
-            coeffs_S0 = (comp_betas[:j_echo] * X1[:j_echo, :]).sum(axis=0) /\
-                (X1[:j_echo, :]**2).sum(axis=0)
-            pred_S0 = X1[:j_echo, :] * np.tile(coeffs_S0, (j_echo, 1))
-            SSE_S0 = (comp_betas[:j_echo] - pred_S0)**2
-            SSE_S0 = SSE_S0.sum(axis=0)  # (S,) prediction error map
-            F_S0 = (alpha - SSE_S0) * (j_echo - 1) / (SSE_S0)
-            F_S0_maps[mask_idx[mask], i_comp] = F_S0[mask_idx[mask]]
-
-            # R2 Model
-            coeffs_R2 = (comp_betas[:j_echo] * X2[:j_echo, :]).sum(axis=0) /\
-                (X2[:j_echo, :]**2).sum(axis=0)
-            pred_R2 = X2[:j_echo] * np.tile(coeffs_R2, (j_echo, 1))
-            SSE_R2 = (comp_betas[:j_echo] - pred_R2)**2
-            SSE_R2 = SSE_R2.sum(axis=0)
-            F_R2 = (alpha - SSE_R2) * (j_echo - 1) / (SSE_R2)
-            F_R2_maps[mask_idx[mask], i_comp] = F_R2[mask_idx[mask]]
-
-            if verbose:
-                pred_S0_maps[mask_idx[mask], :j_echo, i_comp] = pred_S0.T[mask_idx[mask], :]
-                pred_R2_maps[mask_idx[mask], :j_echo, i_comp] = pred_R2.T[mask_idx[mask], :]
-
-        # compute weights as Z-values
-        wtsZ = (WTS[:, i_comp] - WTS[:, i_comp].mean()) / WTS[:, i_comp].std()
-        wtsZ[np.abs(wtsZ) > Z_MAX] = (Z_MAX * (np.abs(wtsZ) / wtsZ))[
-            np.abs(wtsZ) > Z_MAX]
-        Z_maps[:, i_comp] = wtsZ
-
-        # compute Kappa and Rho
-        F_S0[F_S0 > F_MAX] = F_MAX
-        F_R2[F_R2 > F_MAX] = F_MAX
-        norm_weights = np.abs(wtsZ ** 2.)
-        kappas[i_comp] = np.average(F_R2, weights=norm_weights)
-        rhos[i_comp] = np.average(F_S0, weights=norm_weights)
-    del SSE_S0, SSE_R2, wtsZ, F_S0, F_R2, norm_weights, comp_betas
-    if algorithm != 'kundu_v3':
-        del WTS, PSC, tsoc_B
-
-    # tabulate component values
-    comptable = np.vstack([kappas, rhos, varex, varex_norm]).T
-    if reindex:
-        # re-index all components in descending Kappa order
-        sort_idx = comptable[:, 0].argsort()[::-1]
-        comptable = comptable[sort_idx, :]
-        mmix_corrected = mmix_corrected[:, sort_idx]
-        betas = betas[..., sort_idx]
-        F_R2_maps = F_R2_maps[:, sort_idx]
-        F_S0_maps = F_S0_maps[:, sort_idx]
-        Z_maps = Z_maps[:, sort_idx]
-        tsoc_Babs = tsoc_Babs[:, sort_idx]
-
-        if verbose:
-            pred_R2_maps = pred_R2_maps[:, :, sort_idx]
-            pred_S0_maps = pred_S0_maps[:, :, sort_idx]
-
-        if algorithm == 'kundu_v3':
-            WTS = WTS[:, sort_idx]
-            PSC = PSC[:, sort_idx]
-            tsoc_B = tsoc_B[:, sort_idx]
-
-    if verbose:
-        # Echo-specific weight maps for each of the ICA components.
-        io.filewrite(utils.unmask(betas, mask),
-                     op.join(out_dir, '{0}betas_catd.nii'.format(label)),
-                     ref_img)
-
-        # Echo-specific maps of predicted values for R2 and S0 models for each
-        # component.
-        io.filewrite(utils.unmask(pred_R2_maps, mask),
-                     op.join(out_dir, '{0}R2_pred.nii'.format(label)), ref_img)
-        io.filewrite(utils.unmask(pred_S0_maps, mask),
-                     op.join(out_dir, '{0}S0_pred.nii'.format(label)), ref_img)
-        # Weight maps used to average metrics across voxels
-        io.filewrite(utils.unmask(Z_maps ** 2., mask),
-                     op.join(out_dir, '{0}metric_weights.nii'.format(label)),
-                     ref_img)
-        del pred_R2_maps, pred_S0_maps
-
-    comptable = pd.DataFrame(comptable,
-                             columns=['kappa', 'rho',
-                                      'variance explained',
-                                      'normalized variance explained'])
-    comptable.index.name = 'component'
-
-    # Generate clustering criteria for component selection
-    if algorithm in ['kundu_v2', 'kundu_v3']:
-        Z_clmaps = np.zeros([n_voxels, n_components], bool)
-        F_R2_clmaps = np.zeros([n_voxels, n_components], bool)
-        F_S0_clmaps = np.zeros([n_voxels, n_components], bool)
-        Br_R2_clmaps = np.zeros([n_voxels, n_components], bool)
-        Br_S0_clmaps = np.zeros([n_voxels, n_components], bool)
-
-        LGR.info('Performing spatial clustering of components')
-        csize = np.max([int(n_voxels * 0.0005) + 5, 20])
-        LGR.debug('Using minimum cluster size: {}'.format(csize))
-        for i_comp in range(n_components):
-            # Cluster-extent threshold and binarize F-maps
-            ccimg = io.new_nii_like(
-                ref_img,
-                np.squeeze(utils.unmask(F_R2_maps[:, i_comp], mask)))
-            F_R2_clmaps[:, i_comp] = utils.threshold_map(
-                ccimg, min_cluster_size=csize, threshold=fmin, mask=mask,
-                binarize=True)
-            countsigFR2 = F_R2_clmaps[:, i_comp].sum()
-
-            ccimg = io.new_nii_like(
-                ref_img,
-                np.squeeze(utils.unmask(F_S0_maps[:, i_comp], mask)))
-            F_S0_clmaps[:, i_comp] = utils.threshold_map(
-                ccimg, min_cluster_size=csize, threshold=fmin, mask=mask,
-                binarize=True)
-            countsigFS0 = F_S0_clmaps[:, i_comp].sum()
-
-            # Cluster-extent threshold and binarize Z-maps with CDT of p < 0.05
-            ccimg = io.new_nii_like(
-                ref_img,
-                np.squeeze(utils.unmask(Z_maps[:, i_comp], mask)))
-            Z_clmaps[:, i_comp] = utils.threshold_map(
-                ccimg, min_cluster_size=csize, threshold=1.95, mask=mask,
-                binarize=True)
-
-            # Cluster-extent threshold and binarize ranked signal-change map
-            ccimg = io.new_nii_like(
-                ref_img,
-                utils.unmask(stats.rankdata(tsoc_Babs[:, i_comp]), mask))
-            Br_R2_clmaps[:, i_comp] = utils.threshold_map(
-                ccimg, min_cluster_size=csize,
-                threshold=(max(tsoc_Babs.shape) - countsigFR2), mask=mask,
-                binarize=True)
-            Br_S0_clmaps[:, i_comp] = utils.threshold_map(
-                ccimg, min_cluster_size=csize,
-                threshold=(max(tsoc_Babs.shape) - countsigFS0), mask=mask,
-                binarize=True)
-        del ccimg, tsoc_Babs
-
-        if algorithm == 'kundu_v2':
-            # WTS, tsoc_B, PSC, and F_S0_maps are not used by Kundu v2.5
-            selvars = ['Z_maps', 'F_R2_maps',
-                       'Z_clmaps', 'F_R2_clmaps', 'F_S0_clmaps',
-                       'Br_R2_clmaps', 'Br_S0_clmaps']
-        elif algorithm == 'kundu_v3':
-            selvars = ['WTS', 'tsoc_B', 'PSC',
-                       'Z_maps', 'F_R2_maps', 'F_S0_maps',
-                       'Z_clmaps', 'F_R2_clmaps', 'F_S0_clmaps',
-                       'Br_R2_clmaps', 'Br_S0_clmaps']
-        elif algorithm is None:
-            selvars = []
-        else:
-            raise ValueError('Algorithm "{0}" not recognized.'.format(algorithm))
-
-        seldict = {}
-        for vv in selvars:
-            seldict[vv] = eval(vv)
-    else:
-        seldict = None
-
-    return comptable, seldict, betas, mmix_corrected
+    model = DependenceModel(catd, tsoc, adaptive_mask, tes, ref_img,
+                            echo_groups=echo_groups, chunk_size=chunk_size,
+                            out_dir=out_dir, n_jobs=n_jobs)
+    return model.score(mmix, mmixN=mmixN, reindex=reindex,
+                       algorithm=algorithm, metric_maps=metric_maps,
+                       label=label, verbose=verbose)
 
 
 def kundu_metrics(comptable, metric_maps):
@@ -330,7 +778,8 @@ def kundu_metrics(comptable, metric_maps):
     metric_maps : :obj:`dict`
         A dictionary with component-specific feature maps used for
         classification. The value for each key is a (S x C) array, where `S` is
-        voxels and `C` is components. Generated by `dependence_metrics`
+        voxels and `C` is components, or :obj:`tedana.utils.PackedMaps` for
+        the binarized cluster maps. Generated by `dependence_metrics`
 
     Returns
     -------
@@ -339,19 +788,20 @@ def kundu_metrics(comptable, metric_maps):
         added.
     """
     Z_maps = metric_maps['Z_maps']
-    Z_clmaps = metric_maps['Z_clmaps']
     F_R2_maps = metric_maps['F_R2_maps']
-    F_S0_clmaps = metric_maps['F_S0_clmaps']
-    F_R2_clmaps = metric_maps['F_R2_clmaps']
-    Br_S0_clmaps = metric_maps['Br_S0_clmaps']
-    Br_R2_clmaps = metric_maps['Br_R2_clmaps']
+    clmaps = {}
+    for name in ['Z_clmaps', 'F_R2_clmaps', 'F_S0_clmaps', 'Br_R2_clmaps',
+                 'Br_S0_clmaps']:
+        clmaps[name] = metric_maps[name]
+        if not isinstance(clmaps[name], utils.PackedMaps):
+            clmaps[name] = utils.PackedMaps(clmaps[name])
 
     """
     Tally number of significant voxels for cluster-extent thresholded R2 and S0
     model F-statistic maps.
     """
-    comptable['countsigFR2'] = F_R2_clmaps.sum(axis=0)
-    comptable['countsigFS0'] = F_S0_clmaps.sum(axis=0)
+    comptable['countsigFR2'] = clmaps['F_R2_clmaps'].count()
+    comptable['countsigFS0'] = clmaps['F_S0_clmaps'].count()
 
     """
     Generate Dice values for R2 and S0 models
@@ -360,16 +810,8 @@ def kundu_metrics(comptable, metric_maps):
     - dice_FS0: Dice value of cluster-extent thresholded maps of S0-model betas
       and F-statistics.
     """
-    comptable['dice_FR2'] = np.zeros(comptable.shape[0])
-    comptable['dice_FS0'] = np.zeros(comptable.shape[0])
-    for i_comp in comptable.index:
-        comptable.loc[i_comp, 'dice_FR2'] = utils.dice(Br_R2_clmaps[:, i_comp],
-                                                       F_R2_clmaps[:, i_comp])
-        comptable.loc[i_comp, 'dice_FS0'] = utils.dice(Br_S0_clmaps[:, i_comp],
-                                                       F_S0_clmaps[:, i_comp])
-
-    comptable.loc[np.isnan(comptable['dice_FR2']), 'dice_FR2'] = 0
-    comptable.loc[np.isnan(comptable['dice_FS0']), 'dice_FS0'] = 0
+    comptable['dice_FR2'] = clmaps['Br_R2_clmaps'].dice(clmaps['F_R2_clmaps'])
+    comptable['dice_FS0'] = clmaps['Br_S0_clmaps'].dice(clmaps['F_S0_clmaps'])
 
     """
     Generate three metrics of component noise:
@@ -380,23 +822,19 @@ def kundu_metrics(comptable, metric_maps):
       in clusters) for R2 model.
     - signal-noise_p: P-value from t-test.
     """
-    comptable['countnoise'] = 0
-    comptable['signal-noise_t'] = 0
-    comptable['signal-noise_p'] = 0
-    for i_comp in comptable.index:
-        # index voxels significantly loading on component but not from clusters
-        comp_noise_sel = ((np.abs(Z_maps[:, i_comp]) > 1.95) &
-                          (Z_clmaps[:, i_comp] == 0))
-        comptable.loc[i_comp, 'countnoise'] = np.array(
-            comp_noise_sel, dtype=np.int).sum()
-        # NOTE: Why only compare distributions of *unique* F-statistics?
-        noise_FR2_Z = np.log10(np.unique(F_R2_maps[comp_noise_sel, i_comp]))
-        signal_FR2_Z = np.log10(np.unique(
-            F_R2_maps[Z_clmaps[:, i_comp] == 1, i_comp]))
-        (comptable.loc[i_comp, 'signal-noise_t'],
-         comptable.loc[i_comp, 'signal-noise_p']) = stats.ttest_ind(
-             signal_FR2_Z, noise_FR2_Z, equal_var=False)
-
+    # index voxels significantly loading on component but not from clusters
+    Z_clmaps = clmaps['Z_clmaps'].unpack()
+    noise_sel = (np.abs(Z_maps) > 1.95) & ~Z_clmaps
+    comptable['countnoise'] = noise_sel.sum(axis=0)
+    # NOTE: Why only compare distributions of *unique* F-statistics?
+    n_noise, mean_noise, var_noise = _unique_log_stats(F_R2_maps, noise_sel)
+    n_signal, mean_signal, var_signal = _unique_log_stats(F_R2_maps, Z_clmaps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        signal_noise_t, signal_noise_p = stats.ttest_ind_from_stats(
+            mean_signal, np.sqrt(var_signal), n_signal,
+            mean_noise, np.sqrt(var_noise), n_noise, equal_var=False)
+    comptable['signal-noise_t'] = signal_noise_t
+    comptable['signal-noise_p'] = signal_noise_p
     comptable.loc[np.isnan(comptable['signal-noise_t']), 'signal-noise_t'] = 0
     comptable.loc[np.isnan(comptable['signal-noise_p']), 'signal-noise_p'] = 0
 
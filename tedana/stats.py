@@ -4,7 +4,7 @@ Statistical functions
 import logging
 
 import numpy as np
-from scipy import stats
+from scipy import linalg, stats
 
 from tedana import utils
 
@@ -158,3 +158,69 @@ def get_coeffs(data, X, mask=None, add_const=False):
         betas = utils.unmask(betas, mask)
 
     return betas
+
+
+def get_coeffs_chunked(data, X, add_const=False, chunk_size=None):
+    """
+    Performs least-squares fit of `X` against already-masked `data`, using a
+    single QR factorization of `X` for all samples
+
+    Parameters
+    ----------
+    data : (S [x E] x T) array_like
+        Array where `S` is samples, `E` is echoes, and `T` is time
+    X : (T [x C]) array_like
+        Array where `T` is time and `C` is predictor variables
+    add_const : bool, optional
+        Add intercept column to `X` before fitting. Default: False
+    chunk_size : int or None, optional
+        Number of samples to fit at once. Peak memory use beyond the output
+        scales with the chunk size. Default is None, which fits all samples
+        at once.
+
+    Returns
+    -------
+    betas : (S [x E] x C) :obj:`numpy.ndarray`
+        Array of `S` sample betas for `C` predictors
+
+    Notes
+    -----
+    With ``X = QR``, the least-squares solution is ``R^-1 Q^T data``, so the
+    (C x T) projection is computed once and applied to each chunk of data.
+    If `X` is rank deficient, the minimum-norm solution is used instead.
+    Unlike :func:`get_coeffs`, no mask is applied, so masked data do not have
+    to be unmasked first.
+    """
+    if data.ndim not in [2, 3]:
+        raise ValueError('Parameter data should be 2d or 3d, not {0}d'.format(data.ndim))
+    elif X.ndim not in [1, 2]:
+        raise ValueError('Parameter X should be 1d or 2d, not {0}d'.format(X.ndim))
+    elif data.shape[-1] != X.shape[0]:
+        raise ValueError('Last dimension (dimension {0}) of data ({1}) does not '
+                         'match first dimension of '
+                         'X ({2})'.format(data.ndim, data.shape[-1], X.shape[0]))
+
+    X = np.reshape(X, (X.shape[0], -1))
+    n_regressors = X.shape[1]
+    if add_const:  # add intercept, if specified
+        X = np.column_stack([X, np.ones((len(X), 1))])
+
+    Q, R = np.linalg.qr(X)
+    diag = np.abs(np.diag(R))
+    if X.shape[0] >= X.shape[1] and diag.min() > diag.max() * max(X.shape) * np.finfo(float).eps:
+        proj = linalg.solve_triangular(R, Q.T)
+    else:
+        # use the minimum-norm solution, as lstsq does, if X is rank deficient
+        proj = np.linalg.pinv(X)
+    # (T x C) projection, without the row for the intercept
+    proj = proj[:n_regressors].T
+
+    if chunk_size is None:
+        chunk_size = data.shape[0]
+    chunk_size = max(chunk_size, 1)
+    betas = np.empty(data.shape[:-1] + (n_regressors,))
+    for start in range(0, data.shape[0], chunk_size):
+        stop = start + chunk_size
+        np.matmul(data[start:stop], proj, out=betas[start:stop])
+
+    return betas
@@ -3,8 +3,9 @@ Tests for tedana.combine
 """
 
 import numpy as np
+import pytest
 
-from tedana import combine
+from tedana import combine, decay
 
 
 def test__combine_t2s():
@@ -68,3 +69,76 @@ def test_make_optcom():
     # Normal STE call
     comb = combine.make_optcom(data, tes, mask, t2s=None, combmode='paid')
     assert comb.shape == (n_voxels, n_trs)
+
+
+def test_normalize_weights_zero(caplog):
+    """
+    Voxels whose weights are all zero should be weighted equally, with a
+    warning.
+    """
+    alpha = np.array([[1., 2., 1.], [0., 0., 0.], [0., 0., 0.]])
+    alpha = combine._normalize_weights(alpha)
+    assert np.allclose(alpha, [[0.25, 0.5, 0.25], [1 / 3] * 3, [1 / 3] * 3])
+    assert '2 voxel(s)' in caplog.text
+
+
+def test_make_optcom_weighted_average():
+    """
+    make_optcom should match a weighted average over the echoes with signal,
+    including when the number of good echoes differs across voxels.
+    """
+    np.random.seed(0)
+    n_voxels, n_echos, n_trs = 20, 4, 10
+    data = np.random.random((n_voxels, n_echos, n_trs)) + 1
+    adaptive_mask = np.random.randint(1, n_echos + 1, size=n_voxels)
+    tes = np.array([10, 20, 30, 40])
+    t2s = np.random.random((n_voxels)) * 50 + 10
+
+    comb = combine.make_optcom(data, tes, adaptive_mask, t2s=t2s, combmode='t2s')
+    for i_vox in range(n_voxels):
+        echo = adaptive_mask[i_vox]
+        if echo < 3:
+            assert np.all(comb[i_vox] == 0)
+            continue
+        alpha = tes[:echo] * np.exp(-tes[:echo] / t2s[i_vox])
+        expected = np.average(data[i_vox, :echo], axis=0, weights=alpha)
+        assert np.allclose(comb[i_vox], expected)
+
+    comb = combine.make_optcom(data, tes, adaptive_mask, combmode='paid')
+    assert comb.shape == (n_voxels, n_trs)
+    assert np.all(np.isfinite(comb))
+
+    # combining into a preallocated array overwrites all of it
+    out = np.ones((n_voxels, n_trs))
+    comb_out = combine.make_optcom(data, tes, adaptive_mask, combmode='paid',
+                                   out=out)
+    assert comb_out is out
+    assert np.array_equal(out, comb)
+
+
+def test_make_optcom_ts():
+    """
+    Test tedana.combine.make_optcom_ts against fitting the T2* timeseries and
+    combining it in separate steps.
+    """
+    np.random.seed(0)
+    n_voxels, n_echos, n_trs = 20, 3, 10
+    data = np.random.random((n_voxels, n_echos, n_trs)) + 1
+    adaptive_mask = np.random.randint(0, n_echos + 1, size=n_voxels)
+    mask = adaptive_mask > 0
+    tes = np.array([10, 20, 30])
+
+    maps = decay.fit_decay_ts(data, tes, mask, adaptive_mask, 'loglin')
+    expected = combine.make_optcom(data, tes, adaptive_mask, t2s=maps[2],
+                                   combmode='t2s')
+    maps_out = [np.empty((n_voxels, n_trs)) for _ in range(4)]
+    comb = combine.make_optcom_ts(data, tes, mask, adaptive_mask, 'loglin',
+                                  maps_out=maps_out, chunk_size=3)
+    assert np.array_equal(comb, expected)
+    for map_out, map_ in zip(maps_out, maps):
+        assert np.array_equal(map_out, map_)
+
+    # Wrong number of output arrays
+    with pytest.raises(ValueError):
+        combine.make_optcom_ts(data, tes, mask, adaptive_mask, 'loglin',
+                               maps_out=maps_out[:3])
@@ -58,6 +58,153 @@ def test_fit_decay_ts(testdata1):
     assert s0vG.ndim == 2
 
 
+def test_fit_decay_ts_chunked(testdata1, tmpdir):
+    """
+    fit_decay_ts should give the same results when fitting in chunks and
+    writing into preallocated memory-mapped outputs.
+    """
+    maps = me.fit_decay_ts(testdata1['data'], testdata1['tes'],
+                           testdata1['mask'], testdata1['adaptive_mask'],
+                           testdata1['fittype'])
+    shape = maps[0].shape
+    out = [np.memmap(str(tmpdir.join('map{}.dat'.format(i))), dtype=float,
+                     mode='w+', shape=shape) for i in range(4)]
+    maps_chunked = me.fit_decay_ts(testdata1['data'], testdata1['tes'],
+                                   testdata1['mask'], testdata1['adaptive_mask'],
+                                   testdata1['fittype'], chunk_size=1000, out=out)
+    for map_, map_chunked, arr in zip(maps, maps_chunked, out):
+        assert map_chunked is arr
+        assert np.array_equal(map_, map_chunked)
+
+    with pytest.raises(ValueError):
+        me.fit_decay_ts(testdata1['data'], testdata1['tes'], testdata1['mask'],
+                        testdata1['adaptive_mask'], testdata1['fittype'],
+                        out=out[:3])
+
+
+def test_fit_decay_n_jobs(testdata1):
+    """
+    Fitting in parallel should give results identical to the serial path.
+    """
+    for fittype in ['loglin', 'curvefit']:
+        maps = me.fit_decay(testdata1['data'], testdata1['tes'],
+                            testdata1['mask'], testdata1['adaptive_mask'],
+                            fittype)
+        maps_parallel = me.fit_decay(testdata1['data'], testdata1['tes'],
+                                     testdata1['mask'], testdata1['adaptive_mask'],
+                                     fittype, n_jobs=2)
+        for map_, map_parallel in zip(maps, maps_parallel):
+            assert np.array_equal(map_, map_parallel)
+
+
+def test_fit_loglinear():
+    """
+    fit_loglinear should match a least-squares fit with the design matrix
+    repeated across volumes.
+    """
+    np.random.seed(0)
+    n_samples, n_echos, n_vols = 50, 4, 10
+    tes = np.array([10., 25., 40., 55.])
+    data = np.random.random((n_samples, n_echos, n_vols)) + 0.5
+    adaptive_mask = np.full(n_samples, n_echos)
+    _, _, t2s_full, s0_full = me.fit_loglinear(data, tes, adaptive_mask,
+                                               report=False)
+
+    x = np.column_stack([np.ones(n_echos), -tes])
+    X = np.repeat(x, n_vols, axis=0)
+    log_data = np.log(np.abs(data.reshape(n_samples, -1).T) + 1)
+    betas = np.linalg.lstsq(X, log_data, rcond=None)[0]
+    assert np.allclose(t2s_full, 1. / betas[1, :])
+    assert np.allclose(s0_full, np.exp(betas[0, :]))
+
+
+def test__fit_monoexponential_lm():
+    """
+    The batched solver should recover known parameters from noiseless data and
+    flag starting points outside of the bounds as failures.
+    """
+    tes = np.array([14.5, 38.5, 62.5])
+    s0_true = np.array([1000., 2500., 800., 1500.])
+    t2s_true = np.array([20., 35., 60., 45.])
+    data = me.monoexponential(tes, s0_true[:, None], t2s_true[:, None])
+    s0_init = s0_true * 1.2
+    t2s_init = t2s_true * 0.7
+    t2s_init[-1] = -10.
+    s0, t2s, converged = me._fit_monoexponential_lm(
+        data, tes, s0_init, t2s_init, s0_min=np.zeros(4))
+    assert np.array_equal(converged, [True, True, True, False])
+    assert np.allclose(s0[:3], s0_true[:3])
+    assert np.allclose(t2s[:3], t2s_true[:3])
+
+    # each voxel's estimate is independent of the voxels fit alongside it
+    s0_single, t2s_single, _ = me._fit_monoexponential_lm(
+        data[1:2], tes, s0_init[1:2], t2s_init[1:2], s0_min=np.zeros(1))
+    assert s0_single[0] == s0[1]
+    assert t2s_single[0] == t2s[1]
+
+
+def test_fit_dictionary(testdata1):
+    """
+    Dictionary matching should recover known parameters from noiseless data
+    and closely match the nonlinear fit on real data.
+    """
+    tes = np.array([14.5, 38.5, 62.5])
+    s0_true = np.array([1000., 2500., 800., 1500.])
+    t2s_true = np.array([20., 35., 60., 45.])
+    data = me.monoexponential(tes, s0_true[:, None], t2s_true[:, None])
+    s0, t2s, matched = me._match_decay_dictionary(data, tes)
+    assert matched.all()
+    assert np.allclose(s0, s0_true, rtol=1e-6)
+    assert np.allclose(t2s, t2s_true, rtol=1e-6)
+
+    # with noise, both fits should find the same bounded least-squares solution
+    rng = np.random.RandomState(0)
+    n_samp = 500
+    s0_true = rng.uniform(500, 3000, n_samp)
+    t2s_true = rng.uniform(15, 80, n_samp)
+    data = me.monoexponential(tes, s0_true[:, None], t2s_true[:, None])
+    data += rng.normal(scale=0.02, size=data.shape) * data[:, :1]
+    s0_min = data.min(axis=1)
+    s0, t2s, matched = me._match_decay_dictionary(data, tes, s0_min=s0_min)
+    s0_lm, t2s_lm, converged = me._fit_monoexponential_lm(
+        data, tes, s0_true, t2s_true, s0_min)
+    both = matched & converged
+    assert both.mean() > 0.95
+    assert np.allclose(s0[both], s0_lm[both], rtol=1e-4)
+    assert np.allclose(t2s[both], t2s_lm[both], rtol=1e-4)
+    assert np.all(s0 >= s0_min)
+
+    args = (testdata1['data'], testdata1['tes'], testdata1['mask'],
+            testdata1['adaptive_mask'])
+    dict_maps = me.fit_decay(*args, fittype='dictionary')
+    curve_maps = me.fit_decay(*args, fittype='curvefit')
+    for dict_map, curve_map in zip(dict_maps, curve_maps):
+        assert dict_map.shape == curve_map.shape
+        assert np.median(np.abs(dict_map - curve_map)) < 1e-2 * np.median(np.abs(curve_map))
+
+
+def test_fit_dictionary_edge():
+    """
+    Voxels whose T2* is beyond the ends of the dictionary should not be
+    matched, and fit_dictionary should use the log-linear estimates for them.
+    """
+    tes = np.array([14.5, 38.5, 62.5])
+    # the dictionary covers 1/20 to 20 times the longest echo time
+    s0_true = np.array([1000., 1000., 1000.])
+    t2s_true = np.array([1., 35., 1e5])
+    data = me.monoexponential(tes, s0_true[:, None], t2s_true[:, None])
+    _, _, matched = me._match_decay_dictionary(data, tes)
+    assert np.array_equal(matched, [False, True, False])
+
+    data_cat = np.repeat(data[:, :, None], 5, axis=2)
+    adaptive_mask = np.full(len(s0_true), len(tes))
+    dict_maps = me.fit_dictionary(data_cat, tes, adaptive_mask)
+    loglin_maps = me.fit_loglinear(data_cat, tes, adaptive_mask)
+    for dict_map, loglin_map in zip(dict_maps, loglin_maps):
+        assert np.array_equal(dict_map[~matched], loglin_map[~matched])
+    assert np.isclose(dict_maps[2][1], t2s_true[1])
+
+
 # SMOKE TESTS
 
 def test_smoke_fit_decay():
@@ -4,10 +4,15 @@ Tests for maPCA
 
 import numpy as np
 import nibabel as nib
+from scipy import stats
+from scipy.signal import fftconvolve
+from sklearn.decomposition import PCA
 from tedana import decomposition
 from pytest import raises
 from tedana.decomposition.ma_pca import _autocorr, _check_order, _parzen_win
 from tedana.decomposition.ma_pca import _subsampling, _kurtn, _icatb_svd, _eigensp_adj
+from tedana.decomposition.ma_pca import _pca_from_svd, _itc_criteria
+from tedana.decomposition.ma_pca import _get_ent_rate_kernel
 
 
 def test_autocorr():
@@ -80,6 +85,68 @@ def test_ent_rate_sp():
     assert 'Incorrect matrix dimensions' in str(errorinfo.value)
 
 
+def _ent_rate_sp_slices(data):
+    """
+    Reference entropy rate, from the slice-by-slice 2D correlations of the
+    original implementation of ent_rate_sp.
+    """
+    dims = data.shape
+    data = data / np.std(data)
+    M = [int(i) for i in np.ceil(np.array(dims) / 10)]
+    parzen_w = []
+    for n, m in zip(dims, M):
+        w = np.zeros((2 * n - 1, ))
+        w[(n - m - 1):(n + m)] = _parzen_win(2 * m + 1)
+        parzen_w.append(w)
+
+    data_corr = np.zeros((2 * dims[0] - 1, 2 * dims[1] - 1, 2 * dims[2] - 1))
+    for m3 in range(dims[2] - 1):
+        temp = np.zeros((2 * dims[0] - 1, 2 * dims[1] - 1))
+        for k in range(dims[2] - m3):
+            temp += fftconvolve(data[:, :, k + m3], data[::-1, ::-1, k])
+        data_corr[:, :, (dims[2] - 1) - m3] = temp
+        data_corr[:, :, (dims[2] - 1) + m3] = temp
+
+    v1 = np.hstack((np.arange(1, dims[0] + 1), np.arange(dims[0] - 1, 0, -1)))
+    v2 = np.hstack((np.arange(1, dims[1] + 1), np.arange(dims[1] - 1, 0, -1)))
+    v3 = np.hstack((np.arange(1, dims[2] + 1), np.arange(dims[2] - 1, 0, -1)))
+    data_corr /= v1[:, None, None] * v2[None, :, None] * v3[None, None, :]
+    data_corr *= (parzen_w[0][:, None, None] * parzen_w[1][None, :, None] *
+                  parzen_w[2][None, None, :])
+
+    data_fft = np.abs(np.fft.fftn(data_corr))
+    data_fft[data_fft < 1e-4] = 1e-4
+    return (0.5 * np.log(2 * np.pi * np.exp(1)) +
+            np.sum(np.log(data_fft)) / 2 / np.sum(data_fft))
+
+
+def test_ent_rate_sp_matches_slices():
+    """
+    The 3D FFT autocorrelation in ent_rate_sp should give the same entropy
+    rates as the slice-by-slice correlations it replaced, for smooth and
+    unsmooth data with odd and even dimensions.
+    """
+    rs = np.random.RandomState(0)
+    for dims in [(7, 8, 5), (12, 9, 2), (20, 16, 13)]:
+        test_data = rs.randn(*dims)
+        smooth_data = test_data + np.roll(test_data, 1, axis=0) + np.roll(test_data, 1, axis=2)
+        for data in [test_data, smooth_data]:
+            assert np.isclose(decomposition.ent_rate_sp(data, 1),
+                              _ent_rate_sp_slices(data))
+
+
+def test_get_ent_rate_kernel_read_only():
+    """
+    The cached kernels are shared between calls, so they should be read-only.
+    """
+    fft_shape, corr_idx, corr_weights, freq_weights = _get_ent_rate_kernel((7, 8, 5), True)
+    assert isinstance(fft_shape, tuple)
+    for arr in corr_idx + (corr_weights, freq_weights):
+        assert not arr.flags.writeable
+        with raises(ValueError):
+            arr[...] = 0
+
+
 def test_subsampling():
     """
     Unit test for subsampling function
@@ -102,6 +169,11 @@ def test_kurtn():
     kurt = _kurtn(test_data)
     assert kurt.shape == (3, 1)
 
+    test_data = np.random.randn(100, 5) ** 3
+    kurt = _kurtn(test_data)
+    expected = np.maximum(stats.kurtosis(test_data, axis=0), 0)[:, np.newaxis]
+    assert np.allclose(kurt, expected)
+
 
 def test_icatb_svd():
     """
@@ -112,6 +184,29 @@ def test_icatb_svd():
     assert np.allclose(np.sum(V, axis=0), np.ones((5,)))
 
 
+def test_pca_from_svd():
+    """
+    Unit test for _pca_from_svd function, which should match sklearn's PCA up
+    to the sign of each component, whose convention depends on the sklearn
+    version
+    """
+    rs = np.random.RandomState(0)
+    test_data = np.dot(rs.randn(300, 4), rs.randn(4, 20)) + rs.randn(300, 20) + 50
+    V, Lambda = _icatb_svd(test_data, 20)
+    u, s, varex_norm, v = _pca_from_svd(test_data, V, Lambda, 5)
+
+    ppca = PCA(n_components=5, svd_solver='full').fit(test_data)
+    signs = np.sign(np.sum(v * ppca.components_.T, axis=0))
+    assert np.allclose(v, ppca.components_.T * signs)
+    assert np.allclose(s, ppca.explained_variance_)
+    assert np.allclose(varex_norm, ppca.explained_variance_ratio_)
+    u_c = np.dot(test_data - test_data.mean(axis=0), v) / s
+    assert np.allclose(u, u_c)
+
+    # the largest absolute weight of each component is positive
+    assert np.all(u_c[np.abs(u_c).argmax(axis=0), np.arange(5)] > 0)
+
+
 def test_eigensp_adj():
     """
     Unit test for eigensp_adj function
@@ -123,6 +218,27 @@ def test_eigensp_adj():
     assert np.allclose(lambd_adj, test_result)
 
 
+def test_itc_criteria():
+    """
+    Unit test for _itc_criteria function, which should match a direct
+    computation from products of eigenvalues, and stay finite for long runs
+    """
+    eigenvalues = np.sort(np.random.rand(20) + 0.1)[::-1]
+    n_samples, p = 1000, 20
+    expected = np.zeros((3, p - 1))
+    for k_idx, k in enumerate(np.arange(1, p)):
+        LH = np.log(np.prod(np.power(eigenvalues[k:], 1 / (p - k))) /
+                    np.mean(eigenvalues[k:]))
+        mlh = 0.5 * n_samples * (p - k) * LH
+        df = 1 + 0.5 * k * (2 * p - k + 1)
+        expected[:, k_idx] = [(-2 * mlh) + (2 * df), (-2 * mlh) + (3 * df),
+                              -mlh + (0.5 * df * np.log(n_samples))]
+    assert np.allclose(_itc_criteria(eigenvalues, n_samples), expected)
+
+    eigenvalues = np.sort(np.random.rand(2000) * 1e-3 + 1e-6)[::-1]
+    assert np.all(np.isfinite(_itc_criteria(eigenvalues, n_samples)))
+
+
 def test_ma_pca():
     """
     Check that ma_pca runs correctly with all three options
@@ -171,3 +287,68 @@ def test_ma_pca():
     assert s.shape[0] == 1
     assert varex_norm.shape[0] == 1
     assert v.shape[0] == timepoints
+
+
+def test_ma_pca_n_jobs():
+    """
+    Estimating the subsampling depth in parallel should not change the
+    results of ma_pca
+    """
+    rs = np.random.RandomState(0)
+    nvox, timepoints = 12, 60
+    test_data = rs.random_sample((nvox, nvox, nvox, timepoints))
+    test_data += np.sin(np.linspace(0, 40 * np.pi, timepoints))
+    xform = np.eye(4) * 2
+    test_img = nib.nifti1.Nifti1Image(test_data, xform)
+    test_mask_img = nib.nifti1.Nifti1Image(np.ones((nvox, nvox, nvox)), xform)
+
+    u, s, varex_norm, v = decomposition.ma_pca(test_img, test_mask_img, 'mdl')
+    u2, s2, varex_norm2, v2 = decomposition.ma_pca(test_img, test_mask_img, 'mdl',
+                                                   n_jobs=2)
+    assert np.allclose(u, u2)
+    assert np.allclose(s, s2)
+    assert np.allclose(varex_norm, varex_norm2)
+    assert np.allclose(v, v2)
+
+
+def test_ma_pca_masked():
+    """
+    ma_pca_masked should match ma_pca on the same voxels, with component maps
+    in the order of the input rows
+    """
+    rs = np.random.RandomState(0)
+    nvox, timepoints = 12, 60
+    test_data = rs.random_sample((nvox, nvox, nvox, timepoints))
+    test_data += np.sin(np.linspace(0, 40 * np.pi, timepoints))
+    test_mask = np.zeros((nvox, nvox, nvox), bool)
+    test_mask[1:-2, 2:, :-1] = True
+    xform = np.eye(4) * 2
+    test_img = nib.nifti1.Nifti1Image(test_data, xform)
+    test_mask_img = nib.nifti1.Nifti1Image(test_mask.astype(int), xform)
+    u, s, varex_norm, v = decomposition.ma_pca(test_img, test_mask_img, 'mdl')
+
+    # rows in row-major order, as in data[mask]
+    u2, s2, varex_norm2, v2 = decomposition.ma_pca_masked(
+        test_data[test_mask], test_mask, criteria='mdl')
+    assert np.allclose(s, s2)
+    assert np.allclose(varex_norm, varex_norm2)
+    assert np.allclose(v, v2)
+    u_vol = np.zeros(test_mask.shape + (u.shape[1],))
+    # ma_pca returns rows in column-major order
+    u_vol[np.unravel_index(np.flatnonzero(test_mask.ravel(order='F')),
+                           test_mask.shape, order='F')] = u
+    assert np.allclose(u_vol[test_mask], u2)
+
+    # rows in any order, given their voxel indices
+    perm = rs.permutation(u2.shape[0])
+    coords = np.vstack(np.nonzero(test_mask)).T[perm]
+    u3, s3, varex_norm3, v3 = decomposition.ma_pca_masked(
+        test_data[test_mask][perm], test_mask, coords=coords, criteria='mdl')
+    assert np.allclose(s2, s3)
+    assert np.allclose(varex_norm2, varex_norm3)
+    assert np.allclose(v2, v3)
+    assert np.allclose(u2[perm], u3)
+
+    with raises(ValueError):
+        decomposition.ma_pca_masked(test_data[test_mask], test_mask,
+                                    coords=np.zeros((3, 3)))
@@ -63,3 +63,129 @@ def test_break_dependence_metrics():
             catd=catd, tsoc=tsoc, mmix=mmix,
             adaptive_mask=adaptive_mask, tes=tes, ref_img=ref_img,
             reindex=False, mmixN=None, algorithm='kundu_v3')
+
+
+def test__fit_te_models():
+    """
+    The batched S0 and R2 models should match per-voxel, per-component
+    least-squares fits through the origin.
+    """
+    rs = np.random.RandomState(0)
+    n_samples, n_echos, n_comps = 50, 4, 6
+    betas = rs.randn(n_samples, n_echos, n_comps)
+    mu = rs.rand(n_samples, n_echos) + 1
+    tes = np.array([15., 30., 45., 60.])
+    X2 = tes * mu
+    F_S0, F_R2, pred_S0, pred_R2 = kundu_fit._fit_te_models(betas, mu, X2)
+    assert F_S0.shape == F_R2.shape == (n_samples, n_comps)
+    assert pred_S0.shape == pred_R2.shape == (n_samples, n_echos, n_comps)
+
+    for i_samp, i_comp in [(0, 0), (10, 3), (49, 5)]:
+        y = betas[i_samp, :, i_comp]
+        for X, F, pred in [(mu, F_S0, pred_S0), (X2, F_R2, pred_R2)]:
+            x = X[i_samp]
+            coeff = np.linalg.lstsq(x[:, None], y, rcond=None)[0][0]
+            sse = ((y - coeff * x) ** 2).sum()
+            assert np.allclose(pred[i_samp, :, i_comp], coeff * x)
+            assert np.allclose(F[i_samp, i_comp],
+                               ((y ** 2).sum() - sse) * (n_echos - 1) / sse)
+
+
+def test_dependence_metrics_chunked():
+    """
+    Computing the metrics in chunks of voxels should match computing them all
+    at once.
+    """
+    rs = np.random.RandomState(0)
+    n_samples, n_echos, n_vols, n_comps = 500, 4, 60, 5
+    tes = np.array([15., 30., 45., 60.])
+    s0 = rs.rand(n_samples, 1, 1) * 1000 + 1000
+    r2s = rs.rand(n_samples, 1, 1) * 0.02 + 0.02
+    mmix = rs.randn(n_vols, n_comps)
+    fluct = 1 + 0.01 * np.dot(rs.randn(n_samples, n_comps), mmix.T)[:, None, :]
+    catd = s0 * np.exp(-r2s * tes[None, :, None]) * fluct
+    tsoc = catd.mean(axis=1)
+    adaptive_mask = rs.randint(2, n_echos + 1, size=n_samples)
+
+    expected = kundu_fit.dependence_metrics(catd, tsoc, mmix, adaptive_mask,
+                                            tes, ref_img='', reindex=True)
+    for chunk_size in [17, 100, 1000]:
+        out = kundu_fit.dependence_metrics(catd, tsoc, mmix, adaptive_mask,
+                                           tes, ref_img='', reindex=True,
+                                           chunk_size=chunk_size)
+        assert np.allclose(out[0].values, expected[0].values)
+        assert np.allclose(out[2], expected[2])
+        assert np.allclose(out[3], expected[3])
+
+    # only the requested maps are returned
+    out = kundu_fit.dependence_metrics(catd, tsoc, mmix, adaptive_mask, tes,
+                                       ref_img='', reindex=True, chunk_size=100,
+                                       metric_maps=['PSC', 'Z_maps'])
+    assert sorted(out[1]) == ['PSC', 'Z_maps']
+    assert np.allclose(out[0].values, expected[0].values)
+
+    with pytest.raises(ValueError):
+        kundu_fit.dependence_metrics(catd, tsoc, mmix, adaptive_mask, tes,
+                                     ref_img='', chunk_size=0)
+    with pytest.raises(ValueError):
+        kundu_fit.dependence_metrics(catd, tsoc, mmix, adaptive_mask, tes,
+                                     ref_img='', algorithm='kundu_v1')
+
+
+def test__update_moments():
+    """
+    Merging the moments of chunks should match the moments of all samples.
+    """
+    rs = np.random.RandomState(0)
+    x = rs.gamma(2., size=(100, 3))
+    moments = None
+    for start in range(0, 100, 30):
+        moments = kundu_fit._update_moments(moments, x[start:start + 30])
+    n, mean, M2, M3 = moments
+    assert n == 100
+    assert np.allclose(mean, x.mean(axis=0))
+    assert np.allclose(M2, ((x - x.mean(axis=0))**2).sum(axis=0))
+    assert np.allclose(M3, ((x - x.mean(axis=0))**3).sum(axis=0))
+
+
+def test_DependenceModel():
+    """
+    A model built once should score several mixing matrices like separate
+    calls to dependence_metrics.
+    """
+    rs = np.random.RandomState(0)
+    n_samples, n_echos, n_vols = 300, 3, 40
+    tes = np.array([15., 30., 45.])
+    catd = rs.rand(n_samples, n_echos, n_vols) + 1
+    tsoc = catd.mean(axis=1)
+    adaptive_mask = rs.randint(2, n_echos + 1, size=n_samples)
+
+    model = kundu_fit.DependenceModel(catd, tsoc, adaptive_mask, tes, ref_img='')
+    for n_comps in [4, 7]:
+        mmix = rs.randn(n_vols, n_comps)
+        out = model.score(mmix, reindex=True)
+        expected = kundu_fit.dependence_metrics(catd, tsoc, mmix, adaptive_mask,
+                                                tes, ref_img='', reindex=True)
+        assert np.allclose(out[0].values, expected[0].values)
+        assert np.allclose(out[2], expected[2])
+        assert np.allclose(out[3], expected[3])
+        # masked copies of the data are not held between calls
+        assert not model._masked
+
+    # mixing matrix does not match the data
+    with pytest.raises(ValueError):
+        model.score(rs.randn(n_vols + 1, 4))
+
+
+def test__resolve_metric_maps():
+    """
+    Requested maps should pull in the maps they are derived from.
+    """
+    required = kundu_fit._resolve_metric_maps(['Br_S0_clmaps'])
+    assert required == {'Br_S0_clmaps', 'tsoc_B', 'F_S0_clmaps', 'F_S0_maps'}
+    assert kundu_fit._resolve_metric_maps([]) == set()
+    for maps in kundu_fit.SELECTION_MAPS.values():
+        assert kundu_fit._resolve_metric_maps(maps) >= set(maps)
+
+    with pytest.raises(ValueError):
+        kundu_fit._resolve_metric_maps(['not_a_map'])
@@ -4,7 +4,9 @@ Tests for tedana.model.fit
 
 import numpy as np
 import pandas as pd
+from scipy import stats
 
+from tedana import utils
 from tedana.metrics import kundu_fit
 
 
@@ -35,3 +37,46 @@ def test_smoke_kundu_metrics():
 
     comptable = kundu_fit.kundu_metrics(comptable, metric_maps)
     assert comptable is not None
+
+
+def test_kundu_metrics():
+    """
+    Metrics computed for all components at once should match those computed
+    for each component separately.
+    """
+    rs = np.random.RandomState(0)
+    n_comps, n_voxels = 6, 500
+    comptable = pd.DataFrame(columns=['kappa', 'rho', 'variance explained',
+                                      'normalized variance explained'],
+                             data=rs.random_sample((n_comps, 4)))
+    metric_maps = {
+        'Z_maps': rs.randn(n_voxels, n_comps) * 2,
+        # rounded F-statistics, so that some values are repeated
+        'F_R2_maps': np.round(rs.gamma(2., 10., (n_voxels, n_comps)), 1),
+    }
+    for name in ['Z_clmaps', 'F_S0_clmaps', 'F_R2_clmaps', 'Br_S0_clmaps',
+                 'Br_R2_clmaps']:
+        metric_maps[name] = rs.randint(low=0, high=2, size=(n_voxels, n_comps))
+    # empty maps and a single signal voxel
+    metric_maps['Br_R2_clmaps'][:, 0] = 0
+    metric_maps['F_R2_clmaps'][:, 0] = 0
+    metric_maps['Z_clmaps'][:, 1] = 0
+    metric_maps['Z_clmaps'][0, 1] = 1
+
+    comptable = kundu_fit.kundu_metrics(comptable, metric_maps)
+    Z_maps, Z_clmaps = metric_maps['Z_maps'], metric_maps['Z_clmaps']
+    F_R2_maps = metric_maps['F_R2_maps']
+    for i_comp in range(n_comps):
+        for model in ['R2', 'S0']:
+            assert comptable.loc[i_comp, 'dice_F{}'.format(model)] == utils.dice(
+                metric_maps['Br_{}_clmaps'.format(model)][:, i_comp],
+                metric_maps['F_{}_clmaps'.format(model)][:, i_comp])
+        noise_sel = (np.abs(Z_maps[:, i_comp]) > 1.95) & (Z_clmaps[:, i_comp] == 0)
+        assert comptable.loc[i_comp, 'countnoise'] == noise_sel.sum()
+        t, p = stats.ttest_ind(
+            np.log10(np.unique(F_R2_maps[Z_clmaps[:, i_comp] == 1, i_comp])),
+            np.log10(np.unique(F_R2_maps[noise_sel, i_comp])), equal_var=False)
+        assert np.isclose(comptable.loc[i_comp, 'signal-noise_t'], np.nan_to_num(t))
+        assert np.isclose(comptable.loc[i_comp, 'signal-noise_p'], np.nan_to_num(p))
+    assert comptable.loc[0, 'dice_FR2'] == 0
+    assert comptable.loc[1, 'signal-noise_t'] == 0
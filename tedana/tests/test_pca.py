@@ -0,0 +1,141 @@
+"""
+Tests for tedana.decomposition.pca
+"""
+
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import stats
+from sklearn.decomposition import PCA
+
+from tedana.decomposition import pca
+from tedana.stats import computefeats2
+
+
+def test_gram_pca():
+    """
+    The Gram-matrix PCA should match sklearn's PCA up to the sign of each
+    component, whose convention depends on the sklearn version, whether or
+    not the data are processed in chunks.
+    """
+    rs = np.random.RandomState(0)
+    n_samples, n_vols = 500, 20
+    data = np.dot(rs.randn(n_samples, 5), rs.randn(5, n_vols)) * 3
+    data += rs.randn(n_samples, n_vols)
+
+    ppca = PCA(n_components=n_vols - 1).fit(data)
+    comp_ts = ppca.components_.T
+    varex = ppca.explained_variance_
+    for chunk_size in [None, 64]:
+        u, s, v = pca.gram_pca(data, chunk_size=chunk_size)
+        signs = np.sign(np.sum(v * comp_ts, axis=0))
+        assert np.allclose(s, varex)
+        assert np.allclose(v, comp_ts * signs)
+        # weights of the centered data, as tedpca's sklearn solver computes
+        # them after PCA(copy=False) centers the data in place
+        voxel_comp_weights = np.dot(data - data.mean(axis=0), v) / varex
+        assert np.allclose(u, voxel_comp_weights)
+        # the largest absolute weight of each component is positive
+        assert np.all(u[np.abs(u).argmax(axis=0), np.arange(n_vols - 1)] > 0)
+
+    u, s, v = pca.gram_pca(data, n_components=3)
+    assert u.shape == (n_samples, 3) and s.shape == (3,) and v.shape == (n_vols, 3)
+    assert np.allclose(np.abs(np.sum(v * comp_ts[:, :3], axis=0)), 1)
+
+    with pytest.raises(ValueError):
+        pca.gram_pca(data, n_components=n_vols + 1)
+    with pytest.raises(ValueError):
+        pca.gram_pca(data, chunk_size=0)
+
+
+def test_stream_pca(tmp_path):
+    """
+    Streaming PCA of memory-mapped data should match the Gram-matrix PCA of
+    the variance-normalized masked data, for any block size.
+    """
+    rs = np.random.RandomState(0)
+    n_samples, n_vols = 300, 15
+    data = np.dot(rs.randn(n_samples, 4), rs.randn(4, n_vols)) + 100
+    data += rs.randn(n_samples, n_vols)
+    mask = rs.rand(n_samples) > 0.2
+    data_mm = np.memmap(str(tmp_path / 'data_oc.dat'), dtype=float, mode='w+',
+                        shape=data.shape)
+    data_mm[:] = data
+
+    data_z = data[mask]
+    data_z = ((data_z.T - data_z.T.mean(axis=0)) / data_z.T.std(axis=0)).T
+    data_z = (data_z - data_z.mean()) / data_z.std()
+    u_ref, s_ref, v_ref = pca.gram_pca(data_z)
+    maps_ref = computefeats2(data, stats.zscore(v_ref, axis=0), mask)
+
+    # a budget of a tiny fraction of a megabyte forces one voxel per block
+    for mem_limit in [None, 0.01, 1e-9]:
+        u, s, v = pca.stream_pca(data_mm, mask, mem_limit=mem_limit,
+                                 out_dir=str(tmp_path))
+        assert isinstance(u, np.memmap)
+        assert np.allclose(s, s_ref)
+        assert np.allclose(v, v_ref)
+        assert np.allclose(u, u_ref)
+        maps = pca._stream_component_maps(
+            data_mm, mask, stats.zscore(v, axis=0), mem_limit=mem_limit,
+            out_dir=str(tmp_path))
+        assert np.allclose(maps, maps_ref)
+
+    assert pca._get_stream_chunk_size(n_vols, 1e-9) == 1
+    with pytest.raises(ValueError):
+        pca.stream_pca(data_mm, mask, mem_limit=0)
+
+
+def test_stream_kept_data(tmp_path):
+    """
+    Reconstructing the kept data in blocks should match the in-memory
+    reconstruction and normalization in tedpca.
+    """
+    rs = np.random.RandomState(0)
+    n_voxels, n_vols, n_comps = 200, 15, 6
+    u = rs.randn(n_voxels, n_comps)
+    varex = rs.rand(n_comps) + 0.5
+    comp_ts = rs.randn(n_vols, n_comps)
+    acc = np.array([0, 2, 3])
+
+    expected = np.dot(u[:, acc] * varex[None, acc], comp_ts[:, acc].T)
+    expected = stats.zscore(expected, axis=1)
+    expected = stats.zscore(expected, axis=None)
+    for mem_limit in [None, 0.01]:
+        kept_data = pca._stream_kept_data(u, varex, comp_ts, acc,
+                                          mem_limit=mem_limit,
+                                          out_dir=str(tmp_path))
+        assert isinstance(kept_data, np.memmap)
+        assert np.allclose(kept_data, expected)
+
+
+def test_tedpca_ma_pca_order(tmp_path):
+    """
+    The MA-PCA weights in tedpca should follow the voxels of the mask in
+    row-major order, like the rest of tedana's masked data.
+    """
+    rs = np.random.RandomState(0)
+    shape, n_vols = (10, 9, 8), 50
+    tes = np.array([14.5, 38.5, 62.5])
+    # an asymmetric mask, so that row-major and column-major orders differ
+    mask_vol = np.zeros(shape, bool)
+    mask_vol[1:-1, 2:, :-2] = True
+    mask = mask_vol.ravel()
+    n_samp = mask.size
+
+    signal = 0.05 * np.dot(rs.randn(n_samp, 3), rs.randn(n_vols, 3).T)
+    data_cat = (1000 * np.exp(-tes / 30.)[None, :, None] *
+                (1 + signal[:, None, :] + 0.005 * rs.randn(n_samp, len(tes), n_vols)))
+    data_oc = data_cat.mean(axis=1)
+    adaptive_mask = np.where(mask, len(tes), 0)
+    t2sG = np.full(n_samp, 30.)
+    ref_img = nib.Nifti1Image(np.zeros(shape + (n_vols,)), np.eye(4))
+
+    kept_data, n_components = pca.tedpca(
+        data_cat, data_oc, 't2s', mask, adaptive_mask, t2sG, ref_img, tes,
+        algorithm='mdl', out_dir=str(tmp_path))
+    assert n_components >= 3
+    # each row of the kept data should reproduce the signal of its voxel
+    corr = np.mean(stats.zscore(kept_data, axis=1) *
+                   stats.zscore(signal[mask], axis=1), axis=1)
+    assert np.median(corr) > 0.9
@@ -7,6 +7,7 @@ import random
 
 from tedana.stats import computefeats2
 from tedana.stats import get_coeffs
+from tedana.stats import get_coeffs_chunked
 from tedana.stats import getfbounds
 
 
@@ -135,6 +136,31 @@ def test_smoke_get_coeffs():
     assert get_coeffs(data_2d, x, add_const=True) is not None
 
 
+def test_get_coeffs_chunked():
+    """
+    Check that chunked QR coefficients match get_coeffs.
+    """
+    rs = np.random.RandomState(0)
+    n_samples, n_echos, n_vols, n_comps = 30, 3, 40, 5
+    data = rs.random_sample((n_samples, n_echos, n_vols))
+    X = rs.random_sample((n_vols, n_comps))
+    mask = np.ones((n_samples, n_echos), dtype=bool)
+
+    for add_const in [False, True]:
+        expected = get_coeffs(data, X, mask=mask, add_const=add_const)
+        betas = get_coeffs_chunked(data, X, add_const=add_const, chunk_size=7)
+        assert betas.shape == (n_samples, n_echos, n_comps)
+        assert np.allclose(betas, expected)
+
+    # 2D data and rank-deficient X use the minimum-norm solution
+    X = rs.random_sample((n_vols, n_vols + 5))
+    assert np.allclose(get_coeffs_chunked(data[:, 0, :], X),
+                       get_coeffs(data[:, 0, :], X))
+
+    with pytest.raises(ValueError):
+        get_coeffs_chunked(data[:, :, :-1], X)
+
+
 def test_getfbounds():
     good_inputs = range(1, 12)
 
@@ -116,6 +116,25 @@ class TestT2smap():
         img = nib.load(op.join(out_dir, 'desc-optcom_bold.nii.gz'))
         assert len(img.shape) == 4
 
+    def test_basic_t2smap5(self):
+        """
+        A very simple test, to confirm that t2smap only writes the optimally
+        combined data when fitmode is set to ts and no_ts_maps is set.
+        """
+        data_dir = get_test_data_path()
+        data = [op.join(data_dir, 'echo1.nii.gz'),
+                op.join(data_dir, 'echo2.nii.gz'),
+                op.join(data_dir, 'echo3.nii.gz')]
+        out_dir = 'TED.echo1.t2smap'
+        workflows.t2smap_workflow(data, [14.5, 38.5, 62.5], combmode='t2s',
+                                  fitmode='ts', no_ts_maps=True, out_dir=out_dir)
+
+        # Check outputs
+        img = nib.load(op.join(out_dir, 'desc-optcom_bold.nii.gz'))
+        assert len(img.shape) == 4
+        assert not op.isfile(op.join(out_dir, 'T2starmap.nii.gz'))
+        assert not op.isfile(op.join(out_dir, 'desc-full_T2starmap.nii.gz'))
+
     def test_t2smap_cli(self):
         """
         Run test_basic_t2smap1, but use the CLI method.
@@ -102,6 +102,113 @@ def test_make_adaptive_mask():
     assert np.allclose(mask, (masksum >= 3).astype(bool))
 
 
+def test_EchoGroups():
+    adaptive_mask = rs.randint(0, 5, size=100)
+    echo_groups = utils.EchoGroups(adaptive_mask)
+    assert echo_groups.n_samples == 100
+    for echo_num, idx in echo_groups:
+        assert np.array_equal(idx, np.where(adaptive_mask == echo_num)[0])
+    assert np.array_equal(np.sort(echo_groups.between(0, 2)),
+                          np.where(adaptive_mask <= 2)[0])
+    assert echo_groups[10].size == 0
+
+    # indices of a subset refer to positions within the subset
+    mask = adaptive_mask >= 2
+    masked_groups = echo_groups.subset(np.where(mask)[0])
+    assert masked_groups.n_samples == mask.sum()
+    assert np.array_equal(masked_groups.echo_counts, [2, 3, 4])
+    for echo_num, idx in masked_groups:
+        assert np.array_equal(idx, np.where(adaptive_mask[mask] == echo_num)[0])
+
+    # indices of a window refer to positions within the window
+    window_groups = masked_groups.window(10, 30)
+    assert window_groups.n_samples == 20
+    for echo_num, idx in window_groups:
+        assert np.array_equal(idx, np.where(adaptive_mask[mask][10:30] == echo_num)[0])
+
+
+def test_threshold_map():
+    img = np.zeros((10, 10, 10))
+    img[1:3, 1:3, 1:3] = 2  # positive cluster of 8 voxels
+    img[5, 5, 5:8] = 3  # positive cluster of 3 voxels
+    img[7:9, 7:9, 7:9] = -2  # negative cluster of 8 voxels
+    img[0, 9, 9] = 0.5  # sub-threshold voxel
+
+    pos, neg = img.ravel() > 0, img.ravel() < 0
+    big = np.isin(img.ravel(), [2, -2])
+    out = utils.threshold_map(img, min_cluster_size=5, threshold=1)
+    assert np.array_equal(out, big)
+    out = utils.threshold_map(img, min_cluster_size=3, threshold=1,
+                              binarize=False, sided='one')
+    assert np.array_equal(out, np.where(img.ravel() > 1, img.ravel(), 0).astype(int))
+    out = utils.threshold_map(img, min_cluster_size=1, sided='two')
+    assert np.array_equal(out, pos | neg)
+
+    # clusters are counted within the mask only
+    mask = np.ones(img.size, bool)
+    mask[np.flatnonzero(img.ravel() == -2)[:4]] = False
+    out = utils.threshold_map(img, min_cluster_size=5, threshold=1, mask=mask)
+    assert np.array_equal(out, (big & pos)[mask])
+
+
+def test_threshold_maps():
+    # batched thresholding should match thresholding each map separately
+    mask = rs.rand(10, 10, 10) > 0.1
+    maps = rs.randn(mask.sum(), 4) * 2
+    threshold = np.array([0.5, 1., 1.5, 2.])
+    for sided in ['bi', 'two', 'one']:
+        out = utils.threshold_maps(maps, 3, mask, threshold=threshold,
+                                   sided=sided)
+        assert out.shape == maps.shape
+        for i_map in range(maps.shape[1]):
+            img = utils.unmask(maps[:, i_map], mask.ravel()).reshape(mask.shape)
+            expected = utils.threshold_map(img, 3, threshold=threshold[i_map],
+                                           mask=mask.ravel(), sided=sided)
+            assert np.array_equal(out[:, i_map], expected)
+
+    # results do not depend on the number of workers
+    out = utils.threshold_maps(maps, 3, mask, threshold=threshold)
+    assert np.array_equal(
+        utils.threshold_maps(maps, 3, mask, threshold=threshold, n_jobs=2), out)
+
+    # packed output holds the same maps
+    packed = utils.threshold_maps(maps, 3, mask, threshold=threshold,
+                                  out=utils.PackedMaps.zeros(maps.shape))
+    assert np.array_equal(packed.unpack(), out)
+
+    # mask does not match maps
+    with pytest.raises(ValueError):
+        utils.threshold_maps(maps[1:], 3, mask)
+
+
+def test_PackedMaps():
+    maps = rs.rand(101, 5) > 0.6
+    other = rs.rand(101, 5) > 0.3
+    maps[:, 0] = other[:, 0] = False
+    packed = utils.PackedMaps(maps)
+    packed_other = utils.PackedMaps(other)
+    assert packed.shape == maps.shape
+    assert packed.bits.shape == (5, 13)
+    assert np.array_equal(packed.unpack(), maps)
+    assert np.array_equal(packed.unpack([1, 3]), maps[:, [1, 3]])
+    assert np.array_equal(packed.count(), maps.sum(axis=0))
+    assert np.array_equal(packed.intersection(packed_other),
+                          (maps & other).sum(axis=0))
+    assert np.array_equal(packed.dice(packed_other),
+                          [utils.dice(maps[:, i], other[:, i]) for i in range(5)])
+
+    # maps are set a block of whole maps at a time
+    packed = utils.PackedMaps.zeros(maps.shape)
+    assert packed.count().sum() == 0
+    packed[:, 2:4] = maps[:, 2:4]
+    assert np.array_equal(packed.unpack()[:, 2:4], maps[:, 2:4])
+    assert packed.count()[[0, 1, 4]].sum() == 0
+    with pytest.raises(IndexError):
+        packed[:10, 2] = maps[:10, 2]
+    with pytest.raises(ValueError):
+        packed.dice(utils.PackedMaps(maps[1:]))
+
+
 # SMOKE TESTS
 
 def test_smoke_load_image():
@@ -2,9 +2,11 @@
 Utilities for tedana package
 """
 import logging
+import tempfile
 
 import numpy as np
 import nibabel as nib
+from joblib import Parallel, delayed, effective_n_jobs
 from scipy import ndimage
 from nilearn._utils import check_niimg
 from sklearn.utils import check_array
@@ -111,6 +113,267 @@ def make_adaptive_mask(data, mask=None, getsum=False):
     return mask
 
 
+class EchoGroups(object):
+    """
+    Index of samples grouped by their number of good echoes.
+
+    The samples are sorted by their adaptive mask value once, so that each
+    group of samples with the same number of good echoes can be retrieved
+    without scanning the adaptive mask again.
+
+    Parameters
+    ----------
+    adaptive_mask : (S,) array_like
+        Valued array indicating the number of echos with sufficient signal in
+        each sample
+
+    Attributes
+    ----------
+    n_samples : :obj:`int`
+        Number of samples in the adaptive mask
+    echo_counts : :obj:`numpy.ndarray`
+        Sorted, unique numbers of good echoes
+    indices : (S,) :obj:`numpy.ndarray`
+        Sample indices sorted by number of good echoes, in ascending order
+        within each group
+    offsets : :obj:`numpy.ndarray`
+        Start of each group in `indices`, followed by the number of samples
+    """
+    def __init__(self, adaptive_mask):
+        adaptive_mask = np.asarray(adaptive_mask).astype(int)
+        self.n_samples = adaptive_mask.shape[0]
+        self.indices = np.argsort(adaptive_mask, kind='stable')
+        self.echo_counts, counts = np.unique(adaptive_mask, return_counts=True)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def __iter__(self):
+        """Iterate over (number of echoes, sample indices) pairs."""
+        for i_group, echo_num in enumerate(self.echo_counts):
+            yield echo_num, self.indices[self.offsets[i_group]:self.offsets[i_group + 1]]
+
+    def __getitem__(self, echo_num):
+        """Get the indices of samples with exactly `echo_num` good echoes."""
+        return self.between(echo_num, echo_num)
+
+    def between(self, low, high):
+        """
+        Get the indices of samples with between `low` and `high` (inclusive)
+        good echoes.
+
+        Parameters
+        ----------
+        low, high : :obj:`int`
+            Bounds on the number of good echoes
+
+        Returns
+        -------
+        idx : :obj:`numpy.ndarray`
+            Sample indices, sorted by number of good echoes
+        """
+        start = self.offsets[np.searchsorted(self.echo_counts, low, side='left')]
+        stop = self.offsets[np.searchsorted(self.echo_counts, high, side='right')]
+        return self.indices[start:stop]
+
+    def subset(self, sample_idx):
+        """
+        Restrict the index to a subset of samples.
+
+        Parameters
+        ----------
+        sample_idx : (N,) array_like
+            Indices of the samples to keep, e.g., ``np.where(mask)[0]``
+
+        Returns
+        -------
+        echo_groups : :obj:`EchoGroups`
+            Index of the N samples, where sample ``i`` refers to
+            ``sample_idx[i]``
+        """
+        sample_idx = np.asarray(sample_idx, dtype=int)
+        position = np.full(self.n_samples, -1)
+        position[sample_idx] = np.arange(sample_idx.shape[0])
+        position = position[self.indices]
+        keep = position >= 0
+
+        out = EchoGroups.__new__(EchoGroups)
+        out.n_samples = sample_idx.shape[0]
+        out.indices = position[keep]
+        if keep.size:
+            counts = np.add.reduceat(keep.astype(int), self.offsets[:-1])
+        else:
+            counts = np.zeros(0, dtype=int)
+        out.echo_counts = self.echo_counts[counts > 0]
+        out.offsets = np.concatenate(([0], np.cumsum(counts[counts > 0])))
+        return out
+
+    def window(self, start, stop):
+        """
+        Restrict the index to a contiguous range of samples.
+
+        Unlike :meth:`subset`, this does not scan all samples, so it is cheap
+        to call for every chunk of a large dataset.
+
+        Parameters
+        ----------
+        start, stop : :obj:`int`
+            Range of samples to keep, as in ``slice(start, stop)``
+
+        Returns
+        -------
+        echo_groups : :obj:`EchoGroups`
+            Index of the samples in the range, where sample ``i`` refers to
+            sample ``start + i``
+        """
+        start, stop = max(start, 0), min(stop, self.n_samples)
+        groups = [idx[np.searchsorted(idx, start):np.searchsorted(idx, stop)]
+                  for _, idx in self]
+        counts = np.array([idx.shape[0] for idx in groups], dtype=int)
+
+        out = EchoGroups.__new__(EchoGroups)
+        out.n_samples = max(stop - start, 0)
+        out.indices = np.concatenate(groups + [np.zeros(0, dtype=int)]) - start
+        out.echo_counts = self.echo_counts[counts > 0]
+        out.offsets = np.concatenate(([0], np.cumsum(counts[counts > 0])))
+        return out
+
+
+# number of set bits in each possible byte
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+class PackedMaps(object):
+    """
+    Boolean maps packed into bits along the voxel axis.
+
+    Each map takes one bit per voxel instead of one byte, and counts,
+    intersections, and Dice values are computed on the packed bytes.
+
+    Parameters
+    ----------
+    maps : (M x C) array_like
+        Maps of `M` voxels for `C` components. Arrays will be binarized.
+
+    Attributes
+    ----------
+    shape : :obj:`tuple`
+        Shape (M, C) of the unpacked maps
+    bits : (C x B) :obj:`numpy.ndarray`
+        Packed maps, with one row of ``B = ceil(M / 8)`` bytes per component
+    """
+    def __init__(self, maps):
+        maps = np.asarray(maps)
+        if maps.ndim != 2:
+            raise ValueError('Maps must be 2D, not {0}D'.format(maps.ndim))
+        self.shape = maps.shape
+        self.bits = np.packbits(maps.T != 0, axis=1)
+
+    @classmethod
+    def zeros(cls, shape):
+        """
+        Create empty packed maps.
+
+        Parameters
+        ----------
+        shape : :obj:`tuple`
+            Shape (M, C) of the unpacked maps
+
+        Returns
+        -------
+        packed : :obj:`PackedMaps`
+            Packed maps with no voxels set
+        """
+        n_voxels, n_maps = shape
+        out = cls.__new__(cls)
+        out.shape = (n_voxels, n_maps)
+        out.bits = np.zeros((n_maps, (n_voxels + 7) // 8), np.uint8)
+        return out
+
+    def __setitem__(self, key, maps):
+        """
+        Pack a block of maps, as in ``packed[:, cols] = maps``.
+
+        Only whole maps can be set, so the voxel index must be ``:``.
+        """
+        voxels, cols = key
+        if not isinstance(voxels, slice) or voxels != slice(None):
+            raise IndexError('Only whole maps can be set in packed maps')
+        self.bits[cols] = np.packbits(np.asarray(maps).T != 0, axis=1)
+
+    def unpack(self, cols=slice(None)):
+        """
+        Unpack maps into a boolean array.
+
+        Parameters
+        ----------
+        cols : :obj:`slice` or array_like, optional
+            Maps to unpack. Default is all maps.
+
+        Returns
+        -------
+        maps : (M x C) :obj:`numpy.ndarray`
+            Boolean maps
+        """
+        return np.unpackbits(self.bits[cols], axis=1, count=self.shape[0]).T.astype(bool)
+
+    def count(self):
+        """Number of voxels set in each map."""
+        return _POPCOUNT[self.bits].sum(axis=1, dtype=int)
+
+    def intersection(self, other):
+        """Number of voxels set in both this and `other`, for each map."""
+        if self.shape != other.shape:
+            raise ValueError('Shape mismatch: {0} and {1}'.format(self.shape, other.shape))
+        return _POPCOUNT[self.bits & other.bits].sum(axis=1, dtype=int)
+
+    def dice(self, other):
+        """
+        Dice's similarity index between each map and the same map in `other`.
+
+        Parameters
+        ----------
+        other : :obj:`PackedMaps`
+            Maps of the same shape
+
+        Returns
+        -------
+        dsi : (C,) :obj:`numpy.ndarray`
+            Dice-Sorenson index of each pair of maps, or 0 if both are empty,
+            as in :func:`dice`
+        """
+        intersection = self.intersection(other)
+        arr_sum = self.count() + other.count()
+        dsi = np.zeros(self.shape[1])
+        nonempty = arr_sum != 0
+        dsi[nonempty] = (2. * intersection[nonempty]) / arr_sum[nonempty]
+        return dsi
+
+
+def spill_array(shape, dtype=float, out_dir=None):
+    """
+    Allocate a zero-filled array backed by an anonymous temporary file.
+
+    Parameters
+    ----------
+    shape : :obj:`tuple`
+        Shape of the array
+    dtype : data-type, optional
+        Data type of the array. Default is float.
+    out_dir : :obj:`str` or None, optional
+        Directory in which to create the temporary file. Default is None,
+        which uses the system's temporary directory.
+
+    Returns
+    -------
+    arr : :obj:`numpy.memmap` or :obj:`numpy.ndarray`
+        Memory-mapped array, whose file is removed once the array is released.
+        Empty arrays cannot be memory-mapped and are held in memory.
+    """
+    if not np.prod(shape):
+        return np.zeros(shape, dtype)
+    return np.memmap(tempfile.TemporaryFile(dir=out_dir), dtype=dtype,
+                     mode='w+', shape=shape)
+
+
 def unmask(data, mask):
     """
     Unmasks `data` using non-zero entries of `mask`
@@ -287,40 +550,29 @@ def threshold_map(img, min_cluster_size, threshold=None, mask=None,
 
     # Positive values (or absolute values) first
     if threshold is not None:
-        thresh_arr = test_arr >= threshold
+        thresh_arrs = [test_arr >= threshold]
     else:
-        thresh_arr = test_arr > 0
-
-    # 6 connectivity
-    struc = ndimage.generate_binary_structure(3, 1)
-    labeled, _ = ndimage.label(thresh_arr, struc)
-    unique, counts = np.unique(labeled, return_counts=True)
-    clust_sizes = dict(zip(unique, counts))
-    clust_sizes = {k: v for k, v in clust_sizes.items() if v >= min_cluster_size}
-    for i_clust in clust_sizes.keys():
-        if np.all(thresh_arr[labeled == i_clust] == 1):
-            if binarize:
-                clust_thresholded[labeled == i_clust] = True
-            else:
-                clust_thresholded[labeled == i_clust] = arr[labeled == i_clust]
+        thresh_arrs = [test_arr > 0]
 
     # Now negative values *if bi-sided*
     if sided == 'bi':
         if threshold is not None:
-            thresh_arr = test_arr <= (-1 * threshold)
+            thresh_arrs.append(test_arr <= (-1 * threshold))
         else:
-            thresh_arr = test_arr < 0
+            thresh_arrs.append(test_arr < 0)
 
+    # 6 connectivity
+    struc = ndimage.generate_binary_structure(3, 1)
+    for thresh_arr in thresh_arrs:
         labeled, _ = ndimage.label(thresh_arr, struc)
-        unique, counts = np.unique(labeled, return_counts=True)
-        clust_sizes = dict(zip(unique, counts))
-        clust_sizes = {k: v for k, v in clust_sizes.items() if v >= min_cluster_size}
-        for i_clust in clust_sizes.keys():
-            if np.all(thresh_arr[labeled == i_clust] == 1):
-                if binarize:
-                    clust_thresholded[labeled == i_clust] = True
-                else:
-                    clust_thresholded[labeled == i_clust] = arr[labeled == i_clust]
+        # look up which clusters are large enough, ignoring the background
+        keep_clust = np.bincount(labeled.ravel()) >= min_cluster_size
+        keep_clust[0] = False
+        clust_mask = keep_clust[labeled]
+        if binarize:
+            clust_thresholded[clust_mask] = True
+        else:
+            clust_thresholded[clust_mask] = arr[clust_mask]
 
     # reshape to (S,)
     clust_thresholded = clust_thresholded.ravel()
@@ -332,6 +584,139 @@ def threshold_map(img, min_cluster_size, threshold=None, mask=None,
     return clust_thresholded
 
 
+def threshold_maps(maps, min_cluster_size, mask, threshold=None, sided='bi',
+                   out=None, n_jobs=1):
+    """
+    Cluster-extent threshold and binarize a stack of masked maps.
+
+    The maps are labelled together as one 4D array, with 6-connectivity
+    within each map and no connectivity across maps, which is equivalent to
+    calling :func:`threshold_map` on each map with `mask`.
+
+    Parameters
+    ----------
+    maps : (M x C) array_like
+        Maps of the `M` voxels in `mask` to be clustered
+    min_cluster_size : int
+        Minimum cluster size (in voxels)
+    mask : (X x Y x Z) array_like
+        Boolean mask of the voxels in `maps`
+    threshold : float, (C,) array_like, or None, optional
+        Cluster-defining threshold for each map. If None (default), assume
+        maps are already thresholded.
+    sided : {'bi', 'two', 'one'}, optional
+        How to apply thresholding. One-sided thresholds on the positive side.
+        Two-sided thresholds positive and negative values together. Bi-sided
+        thresholds positive and negative values separately. Default is 'bi'.
+    out : (M x C) array_like, :obj:`PackedMaps`, or None, optional
+        Boolean array or packed maps in which to place the result. Default is
+        None.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to label batches of maps. -1 uses all
+        available CPUs. Default is 1.
+
+    Returns
+    -------
+    clust_thresholded : (M x C) :obj:`numpy.ndarray` or :obj:`PackedMaps`
+        Cluster-extent thresholded and binarized maps, i.e. `out` if provided.
+    """
+    mask = np.asarray(mask).astype(bool)
+    n_voxels, n_maps = maps.shape
+    if mask.ndim != 3 or mask.sum() != n_voxels:
+        raise ValueError('Number of voxels in mask ({0}) does not match '
+                         'maps ({1})'.format(mask.sum(), n_voxels))
+    if threshold is not None:
+        threshold = np.broadcast_to(threshold, (n_maps,))
+    if out is None:
+        out = np.zeros((n_voxels, n_maps), bool)
+
+    n_workers = effective_n_jobs(n_jobs)
+    # label as many maps at a time as keeps the 4D arrays bounded, spreading
+    # the maps across workers
+    batch_size = min(max(1, 10000000 // mask.size),
+                     max(1, int(np.ceil(n_maps / n_workers))))
+    batches = [slice(start, start + batch_size)
+               for start in range(0, n_maps, batch_size)]
+
+    if n_workers == 1:
+        for batch in batches:
+            out[:, batch] = _threshold_maps_batch(
+                np.asarray(maps[:, batch]), min_cluster_size, mask,
+                None if threshold is None else threshold[batch], sided)
+        return out
+
+    # Workers get a copy of each batch of maps, which joblib memory-maps
+    # rather than pickles, and the results are written in order.
+    with Parallel(n_jobs=n_workers) as parallel:
+        for start in range(0, len(batches), n_workers):
+            group = batches[start:start + n_workers]
+            results = parallel(
+                delayed(_threshold_maps_batch)(
+                    np.array(maps[:, batch]), min_cluster_size, mask,
+                    None if threshold is None else threshold[batch], sided)
+                for batch in group)
+            for batch, clust_thresholded in zip(group, results):
+                out[:, batch] = clust_thresholded
+
+    return out
+
+
+def _threshold_maps_batch(maps, min_cluster_size, mask, threshold, sided):
+    """
+    Cluster-extent threshold and binarize a batch of masked maps.
+
+    Parameters
+    ----------
+    maps : (M x C) :obj:`numpy.ndarray`
+        Maps of the `M` voxels in `mask` to be clustered
+    min_cluster_size : int
+        Minimum cluster size (in voxels)
+    mask : (X x Y x Z) :obj:`numpy.ndarray`
+        Boolean mask of the voxels in `maps`
+    threshold : (C,) :obj:`numpy.ndarray` or None
+        Cluster-defining threshold for each map
+    sided : {'bi', 'two', 'one'}
+        How to apply thresholding
+
+    Returns
+    -------
+    clust_thresholded : (M x C) :obj:`numpy.ndarray`
+        Cluster-extent thresholded and binarized maps.
+    """
+    arr = maps.T
+    if sided == 'two':
+        arr = np.abs(arr)
+
+    # Positive values (or absolute values) first
+    if threshold is not None:
+        thresh_arrs = [arr >= threshold[:, None]]
+    else:
+        thresh_arrs = [arr > 0]
+
+    # Now negative values *if bi-sided*
+    if sided == 'bi':
+        if threshold is not None:
+            thresh_arrs.append(arr <= (-1 * threshold[:, None]))
+        else:
+            thresh_arrs.append(arr < 0)
+
+    # 6 connectivity within, and none across, maps
+    struc = np.zeros((3, 3, 3, 3), bool)
+    struc[1] = ndimage.generate_binary_structure(3, 1)
+    clust_thresholded = np.zeros(arr.shape, bool)
+    thresh_vol = np.zeros((arr.shape[0],) + mask.shape, bool)
+    for thresh_arr in thresh_arrs:
+        thresh_vol[:, mask] = thresh_arr
+        labeled, _ = ndimage.label(thresh_vol, struc)
+        labeled = labeled[:, mask]
+        # look up which clusters are large enough, ignoring the background
+        keep_clust = np.bincount(labeled.ravel()) >= min_cluster_size
+        keep_clust[0] = False
+        clust_thresholded |= keep_clust[labeled]
+
+    return clust_thresholded.T
+
+
 def sec2millisec(arr):
     """
     Convert seconds to milliseconds.
@@ -66,13 +66,15 @@ def _get_parser():
     optional.add_argument('--fittype',
                           dest='fittype',
                           action='store',
-                          choices=['loglin', 'curvefit'],
+                          choices=['loglin', 'curvefit', 'dictionary'],
                           help='Desired Fitting Method'
                                '"loglin" means that a linear model is fit'
                                ' to the log of the data, default'
                                '"curvefit" means that a more computationally'
                                'demanding monoexponential model is fit'
-                               'to the raw data',
+                               'to the raw data'
+                               '"dictionary" means that the raw data are '
+                               'matched against a table of decay curves',
                           default='loglin')
     optional.add_argument('--fitmode',
                           dest='fitmode',
@@ -91,6 +93,15 @@ def _get_parser():
                           help=('Combination scheme for TEs: '
                                 't2s (Posse 1999, default), paid (Poser)'),
                           default='t2s')
+    optional.add_argument('--no-ts-maps',
+                          dest='no_ts_maps',
+                          action='store_true',
+                          help=('Do not keep or write the T2* and S0 '
+                                'timeseries when fitmode is "ts". The data '
+                                'are then fit and optimally combined one '
+                                'chunk of voxels at a time, which reduces '
+                                'memory use.'),
+                          default=False)
     optional.add_argument('--n-threads',
                           dest='n_threads',
                           type=int,
@@ -101,6 +112,14 @@ def _get_parser():
                                 'threads tend to slow down performance on '
                                 'typical datasets. Default is 1.'),
                           default=1)
+    optional.add_argument('--n-jobs',
+                          dest='n_jobs',
+                          type=int,
+                          action='store',
+                          help=('Number of worker processes to use for '
+                                'voxelwise T2*/S0 fitting. Set to -1 to use '
+                                'all available CPUs. Default is 1.'),
+                          default=1)
     optional.add_argument('--debug',
                           dest='debug',
                           help=argparse.SUPPRESS,
@@ -117,7 +136,7 @@ def _get_parser():
 
 def t2smap_workflow(data, tes, out_dir='.', mask=None,
                     fittype='loglin', fitmode='all', combmode='t2s',
-                    debug=False, quiet=False):
+                    no_ts_maps=False, n_jobs=1, debug=False, quiet=False):
     """
     Estimate T2 and S0, and optimally combine data across TEs.
 
@@ -133,12 +152,14 @@ def t2smap_workflow(data, tes, out_dir='.', mask=None,
     mask : :obj:`str`, optional
         Binary mask of voxels to include in TE Dependent ANAlysis. Must be spatially
         aligned with `data`.
-    fittype : {'loglin', 'curvefit'}, optional
+    fittype : {'loglin', 'curvefit', 'dictionary'}, optional
         Monoexponential fitting method.
         'loglin' means to use the the default linear fit to the log of
         the data.
         'curvefit' means to use a monoexponential fit to the raw data,
         which is slightly slower but may be more accurate.
+        'dictionary' means to match the raw data against a table of
+        monoexponential decay curves, which approximates 'curvefit' quickly.
     fitmode : {'all', 'ts'}, optional
         Monoexponential model fitting scheme.
         'all' means that the model is fit, per voxel, across all timepoints.
@@ -146,9 +167,15 @@ def t2smap_workflow(data, tes, out_dir='.', mask=None,
         Default is 'all'.
     combmode : {'t2s', 'paid'}, optional
         Combination scheme for TEs: 't2s' (Posse 1999, default), 'paid' (Poser).
+    no_ts_maps : :obj:`bool`, optional
+        Do not keep or write the T2* and S0 timeseries when ``fitmode`` is
+        'ts'. Default is False.
 
     Other Parameters
     ----------------
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to use for T2*/S0 fitting. -1 uses all
+        available CPUs. Default is 1.
     debug : :obj:`bool`, optional
         Whether to run in debugging mode or not. Default is False.
     quiet : :obj:`bool`, optional
@@ -174,6 +201,9 @@ def t2smap_workflow(data, tes, out_dir='.', mask=None,
     desc-full_S0map.nii.gz        Full S0 map/timeseries.
     desc-optcom_bold.nii.gz       Optimally combined timeseries.
     ==========================    =================================================
+
+    When ``fitmode`` is 'ts', the T2* and S0 outputs are not written if
+    ``no_ts_maps`` is True.
     """
     out_dir = op.abspath(out_dir)
     if not op.isdir(out_dir):
@@ -207,44 +237,55 @@ def t2smap_workflow(data, tes, out_dir='.', mask=None,
         LGR.info('Using user-defined mask')
     mask, masksum = utils.make_adaptive_mask(catd, mask=mask, getsum=True)
 
-    LGR.info('Computing adaptive T2* map')
-    if fitmode == 'all':
-        (t2s_limited, s0_limited,
-         t2s_full, s0_full) = decay.fit_decay(catd, tes, mask, masksum,
-                                              fittype)
+    if fitmode == 'ts':
+        LGR.info('Computing adaptive T2* timeseries and optimal combination')
+        if no_ts_maps:
+            decay_maps = None
+        else:
+            decay_maps = [np.zeros((n_samp, n_vols)) for _ in range(4)]
+        # fit and combine one chunk of voxels at a time
+        OCcatd = combine.make_optcom_ts(catd, tes, mask, masksum, fittype,
+                                        combmode=combmode, maps_out=decay_maps,
+                                        n_jobs=n_jobs)
     else:
-        (t2s_limited, s0_limited,
-         t2s_full, s0_full) = decay.fit_decay_ts(catd, tes, mask, masksum,
-                                                 fittype)
-
-    # set a hard cap for the T2* map/timeseries
-    # anything that is 10x higher than the 99.5 %ile will be reset to 99.5 %ile
-    cap_t2s = stats.scoreatpercentile(t2s_limited.flatten(), 99.5,
-                                      interpolation_method='lower')
-    cap_t2s_sec = utils.millisec2sec(cap_t2s * 10.)
-    LGR.debug('Setting cap on T2* map at {:.5f}s'.format(cap_t2s_sec))
-    t2s_limited[t2s_limited > cap_t2s * 10] = cap_t2s
-
-    LGR.info('Computing optimal combination')
-    # optimally combine data
-    OCcatd = combine.make_optcom(catd, tes, masksum, t2s=t2s_full,
-                                 combmode=combmode)
+        LGR.info('Computing adaptive T2* map')
+        decay_maps = decay.fit_decay(catd, tes, mask, masksum, fittype,
+                                     n_jobs=n_jobs)
+        t2s_full = decay_maps[2]
+
+        LGR.info('Computing optimal combination')
+        # optimally combine data
+        OCcatd = combine.make_optcom(catd, tes, masksum, t2s=t2s_full,
+                                     combmode=combmode)
 
     # clean up numerical errors
-    for arr in (OCcatd, s0_limited, t2s_limited):
-        np.nan_to_num(arr, copy=False)
-
-    s0_limited[s0_limited < 0] = 0
-    t2s_limited[t2s_limited < 0] = 0
-
-    io.filewrite(utils.millisec2sec(t2s_limited),
-                 op.join(out_dir, 'T2starmap.nii.gz'), ref_img)
-    io.filewrite(s0_limited, op.join(out_dir, 'S0map.nii.gz'), ref_img)
-    io.filewrite(utils.millisec2sec(t2s_full),
-                 op.join(out_dir, 'desc-full_T2starmap.nii.gz'), ref_img)
-    io.filewrite(s0_full, op.join(out_dir, 'desc-full_S0map.nii.gz'), ref_img)
-    io.filewrite(OCcatd, op.join(out_dir, 'desc-optcom_bold.nii.gz'), ref_img)
+    np.nan_to_num(OCcatd, copy=False)
+
+    if decay_maps is not None:
+        t2s_limited, s0_limited, t2s_full, s0_full = decay_maps
+
+        # set a hard cap for the T2* map/timeseries
+        # anything that is 10x higher than the 99.5 %ile will be reset to 99.5 %ile
+        cap_t2s = stats.scoreatpercentile(t2s_limited.flatten(), 99.5,
+                                          interpolation_method='lower')
+        cap_t2s_sec = utils.millisec2sec(cap_t2s * 10.)
+        LGR.debug('Setting cap on T2* map at {:.5f}s'.format(cap_t2s_sec))
+        t2s_limited[t2s_limited > cap_t2s * 10] = cap_t2s
+
+        for arr in (s0_limited, t2s_limited):
+            np.nan_to_num(arr, copy=False)
 
+        s0_limited[s0_limited < 0] = 0
+        t2s_limited[t2s_limited < 0] = 0
+
+        io.filewrite(utils.millisec2sec(t2s_limited),
+                     op.join(out_dir, 'T2starmap.nii.gz'), ref_img)
+        io.filewrite(s0_limited, op.join(out_dir, 'S0map.nii.gz'), ref_img)
+        io.filewrite(utils.millisec2sec(t2s_full),
+                     op.join(out_dir, 'desc-full_T2starmap.nii.gz'), ref_img)
+        io.filewrite(s0_full, op.join(out_dir, 'desc-full_S0map.nii.gz'), ref_img)
+
+    io.filewrite(OCcatd, op.join(out_dir, 'desc-optcom_bold.nii.gz'), ref_img)
 
 def _main(argv=None):
     """T2smap entry point"""
@@ -79,13 +79,15 @@ def _get_parser():
     optional.add_argument('--fittype',
                           dest='fittype',
                           action='store',
-                          choices=['loglin', 'curvefit'],
+                          choices=['loglin', 'curvefit', 'dictionary'],
                           help=('Desired T2*/S0 fitting method. '
                                 '"loglin" means that a linear model is fit '
                                 'to the log of the data. '
                                 '"curvefit" means that a more computationally '
                                 'demanding monoexponential model is fit '
                                 'to the raw data. '
+                                '"dictionary" means that the raw data are '
+                                'matched against a table of decay curves. '
                                 'Default is "loglin".'),
                           default='loglin')
     optional.add_argument('--combmode',
@@ -104,6 +106,20 @@ def _get_parser():
                                 'Default=\'mdl\'.'),
                           choices=['kundu', 'kundu-stabilize', 'mdl', 'aic', 'kic'],
                           default='mdl')
+    optional.add_argument('--pca-solver',
+                          dest='pca_solver',
+                          help=('How to decompose the data in TEDPCA with the '
+                                'kundu and kundu-stabilize options. \'gram\' '
+                                'uses the eigendecomposition of the (volumes x '
+                                'volumes) Gram matrix, which gives the same '
+                                'components as \'sklearn\' faster when there '
+                                'are many more voxels than volumes. '
+                                '\'stream\' does the same while reading '
+                                'the data in blocks of voxels, which are '
+                                'memory-mapped with --lowmem. '
+                                'Default=\'sklearn\'.'),
+                          choices=['sklearn', 'gram', 'stream'],
+                          default='sklearn')
     optional.add_argument('--seed',
                           dest='fixed_seed',
                           metavar='INT',
@@ -168,9 +184,23 @@ def _get_parser():
                           dest='low_mem',
                           action='store_true',
                           help=('Enables low-memory processing, including the '
-                                'use of IncrementalPCA. May increase workflow '
-                                'duration.'),
+                                'use of IncrementalPCA and the computation of '
+                                'component metrics in chunks of voxels. The '
+                                'optimally combined data are kept in a '
+                                'memory-mapped file, but are only read in '
+                                'blocks by the \'stream\' PCA solver; the '
+                                'other solvers load the masked data. May '
+                                'increase workflow duration.'),
                           default=False)
+    optional.add_argument('--mem-limit',
+                          dest='mem_limit',
+                          metavar='MB',
+                          type=float,
+                          help=('Approximate memory budget, in megabytes, for '
+                                'the blocks of voxels held in memory by the '
+                                '\'stream\' PCA solver in TEDPCA. Later '
+                                'stages, such as ICA, are not bounded by it.'),
+                          default=None)
     optional.add_argument('--n-threads',
                           dest='n_threads',
                           type=int,
@@ -181,6 +211,16 @@ def _get_parser():
                                 'threads tend to slow down performance on '
                                 'typical datasets. Default is 1.'),
                           default=1)
+    optional.add_argument('--n-jobs',
+                          dest='n_jobs',
+                          type=int,
+                          action='store',
+                          help=('Number of worker processes to use for '
+                                'voxelwise T2*/S0 fitting, dimensionality '
+                                'estimation in TEDPCA, and spatial '
+                                'clustering of components. Set to -1 to use '
+                                'all available CPUs. Default is 1.'),
+                          default=1)
     optional.add_argument('--debug',
                           dest='debug',
                           action='store_true',
@@ -229,10 +269,11 @@ def _get_parser():
 
 def tedana_workflow(data, tes, out_dir='.', mask=None,
                     fittype='loglin', combmode='t2s', tedpca='mdl',
-                    fixed_seed=42, maxit=500, maxrestart=10,
+                    pca_solver='sklearn', fixed_seed=42, maxit=500, maxrestart=10,
                     tedort=False, gscontrol=None,
                     no_png=False, png_cmap='coolwarm',
-                    verbose=False, low_mem=False, debug=False, quiet=False,
+                    verbose=False, low_mem=False, mem_limit=None, n_jobs=1,
+                    debug=False, quiet=False,
                     t2smap=None, mixm=None, ctab=None, manacc=None):
     """
     Run the "canonical" TE-Dependent ANAlysis workflow.
@@ -251,15 +292,23 @@ def tedana_workflow(data, tes, out_dir='.', mask=None,
         spatially aligned with `data`. If an explicit mask is not provided,
         then Nilearn's compute_epi_mask function will be used to derive a mask
         from the first echo's data.
-    fittype : {'loglin', 'curvefit'}, optional
+    fittype : {'loglin', 'curvefit', 'dictionary'}, optional
         Monoexponential fitting method. 'loglin' uses the the default linear
         fit to the log of the data. 'curvefit' uses a monoexponential fit to
         the raw data, which is slightly slower but may be more accurate.
+        'dictionary' matches the raw data against a table of monoexponential
+        decay curves, which approximates 'curvefit' quickly.
         Default is 'loglin'.
     combmode : {'t2s'}, optional
         Combination scheme for TEs: 't2s' (Posse 1999, default).
     tedpca : {'kundu', 'kundu-stabilize', 'mdl', 'aic', 'kic'}, optional
         Method with which to select components in TEDPCA. Default is 'mdl'.
+    pca_solver : {'sklearn', 'gram', 'stream'}, optional
+        How to decompose the data in TEDPCA with the 'kundu' and
+        'kundu-stabilize' options. 'gram' uses the eigendecomposition of the
+        Gram matrix of the data, which gives the same components as 'sklearn'
+        faster. 'stream' does the same while reading the optimally combined
+        data in blocks of voxels. Default is 'sklearn'.
     tedort : :obj:`bool`, optional
         Orthogonalize rejected components w.r.t. accepted ones prior to
         denoising. Default is False.
@@ -302,8 +351,20 @@ def tedana_workflow(data, tes, out_dir='.', mask=None,
         is achieved before maxrestart attempts, ICA will finish early.
         Default is 10.
     low_mem : :obj:`bool`, optional
-        Enables low-memory processing, including the use of IncrementalPCA.
-        May increase workflow duration. Default is False.
+        Enables low-memory processing, including the use of IncrementalPCA and
+        the computation of component metrics in chunks of voxels. May increase
+        workflow duration. The optimally combined data are also kept in a
+        memory-mapped file, which only the 'stream' PCA solver reads in blocks
+        of voxels; the other solvers load the masked data into memory.
+        Default is False.
+    mem_limit : :obj:`float` or None, optional
+        Approximate memory budget, in megabytes, for the blocks of voxels held
+        in memory by the 'stream' PCA solver in TEDPCA. Later stages, such as
+        ICA, are not bounded by it. Default is None.
+    n_jobs : :obj:`int`, optional
+        Number of worker processes to use for T2*/S0 fitting, dimensionality
+        estimation in TEDPCA, and spatial clustering of components. -1 uses
+        all available CPUs. Default is 1.
     debug : :obj:`bool`, optional
         Whether to run in debugging mode or not. Default is False.
     quiet : :obj:`bool`, optional
@@ -467,12 +528,14 @@ def tedana_workflow(data, tes, out_dir='.', mask=None,
 
     mask, masksum = utils.make_adaptive_mask(catd, mask=mask, getsum=True)
     LGR.debug('Retaining {}/{} samples'.format(mask.sum(), n_samp))
+    # group samples by number of good echoes once for all later stages
+    echo_groups = utils.EchoGroups(masksum)
     io.filewrite(masksum, op.join(out_dir, 'adaptive_mask.nii'), ref_img)
 
     if t2smap is None:
         LGR.info('Computing T2* map')
         t2s_limited, s0_limited, t2s_full, s0_full = decay.fit_decay(
-            catd, tes, mask, masksum, fittype)
+            catd, tes, mask, masksum, fittype, n_jobs=n_jobs)
 
         # set a hard cap for the T2* map
         # anything that is 10x higher than the 99.5 %ile will be reset to 99.5 %ile
@@ -489,13 +552,25 @@ def tedana_workflow(data, tes, out_dir='.', mask=None,
             io.filewrite(s0_full, op.join(out_dir, 's0vG.nii'), ref_img)
 
     # optimally combine data
-    data_oc = combine.make_optcom(catd, tes, masksum, t2s=t2s_full, combmode=combmode)
+    # in low-memory mode, keep the optimally combined data on disk so that
+    # the 'stream' PCA solver can read it in blocks of voxels
+    data_oc = combine.make_optcom(catd, tes, masksum, t2s=t2s_full, combmode=combmode,
+                                  echo_groups=echo_groups,
+                                  out=(utils.spill_array((n_samp, n_vols), out_dir=out_dir)
+                                       if low_mem else None))
 
     # regress out global signal unless explicitly not desired
     if 'gsr' in gscontrol:
         catd, data_oc = gsc.gscontrol_raw(catd, data_oc, n_echos, ref_img,
                                           out_dir=out_dir)
 
+    # TE-dependence model used to score the PCA and ICA components, which
+    # streams over chunks of voxels in low-memory mode
+    dependence_model = metrics.DependenceModel(
+        catd, data_oc, masksum, tes, ref_img, echo_groups=echo_groups,
+        chunk_size=(metrics.kundu_fit.LOW_MEM_CHUNK_SIZE if low_mem else None),
+        out_dir=out_dir, n_jobs=n_jobs)
+
     if mixm is None:
         # Identify and remove thermal noise from data
         dd, n_components = decomposition.tedpca(catd, data_oc, combmode, mask,
@@ -504,7 +579,11 @@ def tedana_workflow(data, tes, out_dir='.', mask=None,
                                                 kdaw=10., rdaw=1.,
                                                 out_dir=out_dir,
                                                 verbose=verbose,
-                                                low_mem=low_mem)
+                                                low_mem=low_mem,
+                                                dependence_model=dependence_model,
+                                                pca_solver=pca_solver,
+                                                mem_limit=mem_limit,
+                                                n_jobs=n_jobs)
         mmix_orig = decomposition.tedica(dd, n_components, fixed_seed,
                                          maxit, maxrestart)
 
@@ -516,9 +595,8 @@ def tedana_workflow(data, tes, out_dir='.', mask=None,
         # Estimate betas and compute selection metrics for mixing matrix
         # generated from dimensionally reduced data using full data (i.e., data
         # with thermal noise)
-        comptable, metric_maps, betas, mmix = metrics.dependence_metrics(
-                    catd, data_oc, mmix_orig, masksum, tes,
-                    ref_img, reindex=True, label='meica_', out_dir=out_dir,
+        comptable, metric_maps, betas, mmix = dependence_model.score(
+                    mmix_orig, reindex=True, label='meica_',
                     algorithm='kundu_v2', verbose=verbose)
         comp_names = [io.add_decomp_prefix(comp, prefix='ica', max_value=comptable.index.max())
                       for comp in comptable.index.values]
@@ -536,10 +614,9 @@ def tedana_workflow(data, tes, out_dir='.', mask=None,
         mmix_orig = pd.read_table(op.join(out_dir, 'ica_mixing.tsv')).values
 
         if ctab is None:
-            comptable, metric_maps, betas, mmix = metrics.dependence_metrics(
-                        catd, data_oc, mmix_orig, masksum, tes,
-                        ref_img, label='meica_', out_dir=out_dir,
-                        algorithm='kundu_v2', verbose=verbose)
+            comptable, metric_maps, betas, mmix = dependence_model.score(
+                        mmix_orig, label='meica_', algorithm='kundu_v2',
+                        verbose=verbose)
             comptable = metrics.kundu_metrics(comptable, metric_maps)
             comptable = selection.kundu_selection_v2(comptable, n_echos, n_vols)
         else: